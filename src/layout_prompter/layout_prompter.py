@@ -1,29 +1,74 @@
+import asyncio
+import hashlib
+import json
+from collections import defaultdict
+from concurrent.futures import Future, as_completed
+from contextlib import ExitStack
 from functools import cached_property
 from typing import (
     Any,
+    AsyncIterator,
+    Awaitable,
+    Dict,
+    Iterator,
     List,
+    Literal,
+    Mapping,
     Optional,
+    Sequence,
+    Tuple,
     Type,
+    Union,
     cast,
 )
 
 import pydantic_numpy.typing as pnd
 from langchain_core.language_models import BaseChatModel
-from langchain_core.runnables import RunnableSerializable
-from langchain_core.runnables.config import RunnableConfig
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.output_parsers.openai_tools import PydanticToolsParser
+from langchain_core.outputs import LLMResult
+from langchain_core.prompt_values import PromptValue
+from langchain_core.runnables import (
+    Runnable,
+    RunnableBinding,
+    RunnableLambda,
+    RunnableSerializable,
+)
+from langchain_core.runnables.config import (
+    ContextThreadPoolExecutor,
+    RunnableConfig,
+    get_config_list,
+    get_executor_for_config,
+    run_in_executor,
+)
+from langchain_core.runnables.utils import gather_with_concurrency
+from loguru import logger
 from PIL import Image
-from pydantic import BaseModel
+from pydantic import BaseModel, model_validator
+from typing_extensions import Self
 
-from layout_prompter.models import LayoutSerializedOutputData, ProcessedLayoutData
-from layout_prompter.modules.rankers import LayoutRanker
+from layout_prompter.models import (
+    CanvasSize,
+    LayoutSerializedOutputData,
+    ProcessedLayoutData,
+)
+from layout_prompter.modules.caches import GenerationCache
+from layout_prompter.modules.rankers import LayoutPrompterRanker, LayoutRanker
 from layout_prompter.modules.selectors import (
     ContentAwareSelector,
     ContentAwareSelectorOutput,
     LayoutSelector,
+    LayoutSelectorOutput,
+)
+from layout_prompter.modules.serializers import (
+    LayoutSerializer,
+    LayoutSerializerInput,
+    SerializationFormat,
+    parse_layout,
 )
-from layout_prompter.modules.serializers import LayoutSerializer, LayoutSerializerInput
 from layout_prompter.typehints import PilImage
 from layout_prompter.utils import Configuration
+from layout_prompter.utils.workers import MAX_CONCURRENCY
 
 
 class LayoutPrompterConfiguration(Configuration):
@@ -32,8 +77,42 @@ class LayoutPrompterConfiguration(Configuration):
     output_schema: Type[LayoutSerializedOutputData]
     num_return: int = 10
     return_candidates: bool = False
+
+    # Format of the generated layouts, shared with the serializer of the few-shot
+    # examples. JSON layouts are requested as structured output (tool calls), while
+    # the other formats are requested as plain text and parsed with `parse_layout`.
+    serialization_format: SerializationFormat = "json"
     return_saliency_maps: bool = False
 
+    # How to request the `num_return` layouts from the LLM:
+    # - "fan_out": send `num_return` identical requests, up to `max_concurrency` at once
+    # - "n_completions": request all the completions in a single call with the `n`
+    #   parameter (e.g., OpenAI). If the provider returns fewer completions,
+    #   the missing ones are requested with the fan-out.
+    generation_mode: Literal["fan_out", "n_completions"] = "fan_out"
+    max_concurrency: int = MAX_CONCURRENCY
+
+    # Early exit of the fan-out: the outstanding generations are cancelled as soon as
+    # `early_exit_num_layouts` layouts satisfy the quality thresholds on the
+    # alignment and overlap metrics of `LayoutPrompterRanker` (lower is better).
+    # A threshold of None does not constrain the metric.
+    early_exit_num_layouts: Optional[int] = None
+    early_exit_max_alignment: Optional[float] = None
+    early_exit_max_overlap: Optional[float] = None
+
+    @model_validator(mode="after")
+    def check_early_exit(self) -> Self:
+        if self.early_exit_num_layouts is None:
+            return self
+        if self.generation_mode != "fan_out":
+            raise ValueError("The early exit is only supported by the fan-out.")
+        if not 0 < self.early_exit_num_layouts <= self.num_return:
+            raise ValueError(
+                f"early_exit_num_layouts ({self.early_exit_num_layouts}) must be "
+                f"between 1 and num_return ({self.num_return})."
+            )
+        return self
+
 
 class LayoutPrompterOutput(BaseModel):
     ranked_outputs: List[LayoutSerializedOutputData]
@@ -55,45 +134,62 @@ class LayoutPrompterOutput(BaseModel):
         ]
 
 
+class LayoutPrompterStreamEvent(BaseModel):
+    """Event yielded by `LayoutPrompter.stream` and `LayoutPrompter.astream`.
+
+    Each generated layout is yielded as `generated_output` as soon as its LLM call
+    completes, and the last event holds the ranked layouts as `final_output`.
+    """
+
+    generated_output: Optional[LayoutSerializedOutputData] = None
+    final_output: Optional[LayoutPrompterOutput] = None
+
+    @property
+    def is_final(self) -> bool:
+        return self.final_output is not None
+
+
 class LayoutPrompter(RunnableSerializable):
     selector: LayoutSelector
     serializer: LayoutSerializer
     llm: BaseChatModel
     ranker: LayoutRanker
 
-    def invoke(
-        self,
-        input: ProcessedLayoutData,
-        config: Optional[RunnableConfig] = None,
-        **kwargs: Any,
-    ) -> LayoutPrompterOutput:
-        # Load configuration
-        conf = LayoutPrompterConfiguration.from_runnable_config(config)
+    # Cache of the generated layouts, e.g., to serve evaluation re-runs without LLM calls
+    generation_cache: Optional[GenerationCache] = None
 
+    def _check_configuration(self, conf: LayoutPrompterConfiguration) -> None:
         if isinstance(self.selector, ContentAwareSelector):
             assert conf.return_saliency_maps == self.selector.return_saliency_maps, (
                 "The `return_saliency_maps` configuration must match the selector's setting."
             )
 
-        # Get candidates based on the input query
-        selector_output = self.selector.select_examples(input)
-        candidates = selector_output.selected_examples
-
+    def _build_messages(
+        self,
+        input: ProcessedLayoutData,
+        selector_output: LayoutSelectorOutput,
+        config: Optional[RunnableConfig] = None,
+    ) -> PromptValue:
         # Define the input for the serializer based on the input query and selected candidates
-        serializer_input = LayoutSerializerInput(query=input, candidates=candidates)
-
+        serializer_input = LayoutSerializerInput(
+            query=input,
+            candidates=selector_output.selected_examples,
+            candidate_scores=selector_output.selected_scores,
+        )
         # Construct the few-shot layout examples as prompt messages
-        messages = self.serializer.invoke(input=serializer_input, config=config)
-        batched_messages = [messages] * conf.num_return
+        return self.serializer.invoke(input=serializer_input, config=config)
 
-        # Generate batched layouts
-        outputs = cast(
-            List[LayoutSerializedOutputData],
-            self.llm.with_structured_output(conf.output_schema).batch(batched_messages),
-        )
+    def _build_output(
+        self,
+        input: ProcessedLayoutData,
+        selector_output: LayoutSelectorOutput,
+        outputs: List[LayoutSerializedOutputData],
+        conf: LayoutPrompterConfiguration,
+    ) -> LayoutPrompterOutput:
+        candidates = selector_output.selected_examples
 
         # Rank the generated layouts
-        ranked_outputs = self.ranker.invoke(outputs)
+        ranked_outputs = self.ranker.invoke(outputs, query=input)
 
         if conf.return_saliency_maps:
             assert isinstance(selector_output, ContentAwareSelectorOutput)
@@ -111,3 +207,816 @@ class LayoutPrompter(RunnableSerializable):
             ranked_outputs=ranked_outputs,
             selected_candidates=candidates if conf.return_candidates else None,
         )
+
+    def _get_cache_keys(
+        self, messages: PromptValue, conf: LayoutPrompterConfiguration
+    ) -> List[str]:
+        """Return the cache keys of the `num_return` generations of the prompt."""
+        prompt_key = json.dumps(
+            {
+                "messages": [
+                    [message.type, message.content]
+                    for message in messages.to_messages()
+                ],
+                "model": self.llm._get_llm_string(),
+                "schema": conf.output_schema.model_json_schema(),
+            },
+            sort_keys=True,
+        )
+        digest = hashlib.sha256(prompt_key.encode()).hexdigest()
+        return [f"{digest}:{i}" for i in range(conf.num_return)]
+
+    def _lookup_cache(
+        self, messages: PromptValue, conf: LayoutPrompterConfiguration
+    ) -> Tuple[List[str], List[Optional[LayoutSerializedOutputData]]]:
+        """Return the cache keys and the cached layouts of the prompt, if any."""
+        if self.generation_cache is None:
+            return [], [None] * conf.num_return
+
+        keys = self._get_cache_keys(messages, conf)
+        return keys, [
+            conf.output_schema.model_validate_json(value) if value is not None else None
+            for value in self.generation_cache.lookup(keys)
+        ]
+
+    def _get_uncached_conf(
+        self,
+        conf: LayoutPrompterConfiguration,
+        cached: Sequence[Optional[LayoutSerializedOutputData]],
+        canvas_size: CanvasSize,
+    ) -> Optional[LayoutPrompterConfiguration]:
+        """Return the configuration to generate the layouts missing from the cache,
+        or None if nothing needs to be generated.
+        """
+        num_missing = sum(output is None for output in cached)
+        if num_missing == conf.num_return:
+            return conf
+        if num_missing == 0:
+            return None
+        if conf.early_exit_num_layouts is None:
+            return conf.model_copy(update={"num_return": num_missing})
+
+        # The cached layouts count towards the early exit
+        num_accepted = sum(
+            self._is_acceptable(output, conf, canvas_size)
+            for output in cached
+            if output is not None
+        )
+        num_remaining = conf.early_exit_num_layouts - num_accepted
+        if num_remaining <= 0:
+            return None
+        return conf.model_copy(
+            update={
+                "num_return": num_missing,
+                "early_exit_num_layouts": min(num_remaining, num_missing),
+            }
+        )
+
+    def _merge_cached(
+        self,
+        keys: Sequence[str],
+        cached: Sequence[Optional[LayoutSerializedOutputData]],
+        generated: Sequence[Any],
+    ) -> List[Any]:
+        """Fill the slots missing from the cache with the generated layouts in order,
+        store them in the cache and return all the layouts.
+
+        Failed generations, returned as exceptions, are not cached.
+        """
+        outputs: List[Any] = []
+        items: Dict[str, str] = {}
+        generated_iter = iter(generated)
+        for i, output in enumerate(cached):
+            if output is None:
+                # The early exit may generate fewer layouts than missing
+                output = next(generated_iter, None)
+                if output is None:
+                    continue
+                if keys and not isinstance(output, Exception):
+                    items[keys[i]] = output.model_dump_json()
+            outputs.append(output)
+
+        if self.generation_cache is not None:
+            self.generation_cache.update(items)
+        return outputs
+
+    def _get_generation_llm(self, conf: LayoutPrompterConfiguration) -> Runnable:
+        """Return the LLM that generates a layout in the serialization format."""
+        if conf.serialization_format == "json":
+            return self.llm.with_structured_output(conf.output_schema)
+        return (
+            self.llm
+            | StrOutputParser()
+            | RunnableLambda(
+                lambda text: parse_layout(
+                    text,
+                    schema=conf.output_schema,
+                    serialization_format=conf.serialization_format,
+                )
+            )
+        )
+
+    def _get_completion_kwargs(
+        self, conf: LayoutPrompterConfiguration
+    ) -> Mapping[str, Any]:
+        if conf.serialization_format == "json":
+            return self._get_tool_kwargs(conf.output_schema)
+        return {}
+
+    def _get_tool_kwargs(
+        self, schema: Type[LayoutSerializedOutputData]
+    ) -> Mapping[str, Any]:
+        # Reuse the provider-specific tool formatting of `bind_tools` to force the
+        # structured output, as `with_structured_output` does not forward `n`
+        tool_llm = self.llm.bind_tools([schema], tool_choice=schema.__name__)
+        return tool_llm.kwargs if isinstance(tool_llm, RunnableBinding) else {}
+
+    def _parse_completions(
+        self, result: LLMResult, conf: LayoutPrompterConfiguration
+    ) -> List[LayoutSerializedOutputData]:
+        generations = result.generations[0][: conf.num_return]
+        if conf.serialization_format == "json":
+            parser = PydanticToolsParser(
+                tools=[conf.output_schema], first_tool_only=True
+            )
+            outputs = [parser.parse_result([generation]) for generation in generations]
+        else:
+            outputs = [
+                parse_layout(
+                    generation.text,
+                    schema=conf.output_schema,
+                    serialization_format=conf.serialization_format,
+                )
+                for generation in generations
+            ]
+        if len(outputs) < conf.num_return:
+            logger.warning(
+                f"The LLM returned {len(outputs)} of {conf.num_return} completions. "
+                "The missing completions are requested separately."
+            )
+        return outputs
+
+    def _generate_n_completions(
+        self, messages: PromptValue, conf: LayoutPrompterConfiguration
+    ) -> List[LayoutSerializedOutputData]:
+        """Request all the completions of the prompt in a single LLM call."""
+        result = self.llm.generate(
+            [messages.to_messages()],
+            n=conf.num_return,
+            **self._get_completion_kwargs(conf),
+        )
+        return self._parse_completions(result, conf)
+
+    def _is_acceptable(
+        self,
+        output: LayoutSerializedOutputData,
+        conf: LayoutPrompterConfiguration,
+        canvas_size: CanvasSize,
+    ) -> bool:
+        """Whether a generated layout satisfies the quality thresholds of the early exit.
+
+        The metrics are computed on the bboxes normalized by the canvas size of the query.
+        """
+        if not output.layouts:
+            return False
+
+        ranker = (
+            self.ranker
+            if isinstance(self.ranker, LayoutPrompterRanker)
+            else LayoutPrompterRanker()
+        )
+        ali_score, ove_score = ranker.calculate_metrics(output, canvas_size=canvas_size)
+        return (
+            conf.early_exit_max_alignment is None
+            or ali_score <= conf.early_exit_max_alignment
+        ) and (
+            conf.early_exit_max_overlap is None
+            or ove_score <= conf.early_exit_max_overlap
+        )
+
+    def _generate_until_accepted(
+        self,
+        messages: PromptValue,
+        conf: LayoutPrompterConfiguration,
+        canvas_size: CanvasSize,
+    ) -> List[LayoutSerializedOutputData]:
+        return list(
+            self._generate_until_accepted_as_completed(messages, conf, canvas_size)
+        )
+
+    def _generate_until_accepted_as_completed(
+        self,
+        messages: PromptValue,
+        conf: LayoutPrompterConfiguration,
+        canvas_size: CanvasSize,
+    ) -> Iterator[LayoutSerializedOutputData]:
+        """Run the fan-out until `early_exit_num_layouts` layouts are acceptable,
+        yielding each layout as soon as it is generated, then cancel the outstanding
+        generations.
+        """
+        assert conf.early_exit_num_layouts is not None
+        structured_llm = self._get_generation_llm(conf)
+
+        num_generated = 0
+        num_accepted = 0
+
+        executor = ContextThreadPoolExecutor(max_workers=conf.max_concurrency)
+        futures = [
+            executor.submit(structured_llm.invoke, messages)
+            for _ in range(conf.num_return)
+        ]
+        try:
+            for future in as_completed(futures):
+                output = cast(LayoutSerializedOutputData, future.result())
+                num_generated += 1
+                num_accepted += self._is_acceptable(output, conf, canvas_size)
+                yield output
+                if num_accepted >= conf.early_exit_num_layouts:
+                    break
+        finally:
+            # The generations that have not started yet are cancelled
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        logger.debug(
+            f"Generated {num_generated} of {conf.num_return} layouts, "
+            f"of which {num_accepted} are acceptable."
+        )
+
+    async def _agenerate_until_accepted(
+        self,
+        messages: PromptValue,
+        conf: LayoutPrompterConfiguration,
+        canvas_size: CanvasSize,
+    ) -> List[LayoutSerializedOutputData]:
+        return [
+            output
+            async for output in self._agenerate_until_accepted_as_completed(
+                messages, conf, canvas_size
+            )
+        ]
+
+    async def _agenerate_until_accepted_as_completed(
+        self,
+        messages: PromptValue,
+        conf: LayoutPrompterConfiguration,
+        canvas_size: CanvasSize,
+    ) -> AsyncIterator[LayoutSerializedOutputData]:
+        """Asynchronously run the fan-out until `early_exit_num_layouts` layouts are
+        acceptable, yielding each layout as soon as it is generated, then cancel the
+        outstanding generations.
+        """
+        assert conf.early_exit_num_layouts is not None
+        structured_llm = self._get_generation_llm(conf)
+        semaphore = asyncio.Semaphore(conf.max_concurrency)
+
+        async def generate() -> LayoutSerializedOutputData:
+            async with semaphore:
+                return cast(
+                    LayoutSerializedOutputData, await structured_llm.ainvoke(messages)
+                )
+
+        num_generated = 0
+        num_accepted = 0
+
+        tasks = [asyncio.ensure_future(generate()) for _ in range(conf.num_return)]
+        try:
+            for next_completed in asyncio.as_completed(tasks):
+                output = await next_completed
+                num_generated += 1
+                num_accepted += self._is_acceptable(output, conf, canvas_size)
+                yield output
+                if num_accepted >= conf.early_exit_num_layouts:
+                    break
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        logger.debug(
+            f"Generated {num_generated} of {conf.num_return} layouts, "
+            f"of which {num_accepted} are acceptable."
+        )
+
+    def _generate(
+        self,
+        messages: PromptValue,
+        conf: LayoutPrompterConfiguration,
+        canvas_size: CanvasSize,
+    ) -> List[LayoutSerializedOutputData]:
+        """Generate `num_return` layouts for the prompt."""
+        keys, cached = self._lookup_cache(messages, conf)
+        uncached_conf = self._get_uncached_conf(conf, cached, canvas_size)
+        generated = (
+            self._generate_uncached(messages, uncached_conf, canvas_size)
+            if uncached_conf is not None
+            else []
+        )
+        return self._merge_cached(keys, cached, generated)
+
+    def _generate_uncached(
+        self,
+        messages: PromptValue,
+        conf: LayoutPrompterConfiguration,
+        canvas_size: CanvasSize,
+    ) -> List[LayoutSerializedOutputData]:
+        if conf.early_exit_num_layouts is not None:
+            return self._generate_until_accepted(messages, conf, canvas_size)
+
+        outputs: List[LayoutSerializedOutputData] = []
+        if conf.generation_mode == "n_completions":
+            outputs = self._generate_n_completions(messages, conf)
+
+        num_missing = conf.num_return - len(outputs)
+        if num_missing > 0:
+            outputs += cast(
+                List[LayoutSerializedOutputData],
+                self._get_generation_llm(conf).batch(
+                    [messages] * num_missing,
+                    config={"max_concurrency": conf.max_concurrency},
+                ),
+            )
+        return outputs
+
+    def _generate_batch(
+        self,
+        messages_list: Sequence[PromptValue],
+        confs: Sequence[LayoutPrompterConfiguration],
+        canvas_sizes: Sequence[CanvasSize],
+        configs: Sequence[RunnableConfig],
+        return_exceptions: bool = False,
+    ) -> List[List[Any]]:
+        """Generate the layouts of multiple prompts, returning a list per prompt.
+
+        Only the layouts missing from the cache are generated.
+        """
+        lookups = [
+            self._lookup_cache(messages, conf)
+            for messages, conf in zip(messages_list, confs)
+        ]
+        uncached_confs = [
+            self._get_uncached_conf(conf, cached, canvas_size)
+            for conf, (_, cached), canvas_size in zip(confs, lookups, canvas_sizes)
+        ]
+        uncached_indices = [
+            i for i, conf in enumerate(uncached_confs) if conf is not None
+        ]
+
+        generated_list: List[List[Any]] = [[] for _ in messages_list]
+        if uncached_indices:
+            outputs_list = self._generate_batch_uncached(
+                [messages_list[i] for i in uncached_indices],
+                [
+                    cast(LayoutPrompterConfiguration, uncached_confs[i])
+                    for i in uncached_indices
+                ],
+                [canvas_sizes[i] for i in uncached_indices],
+                [configs[i] for i in uncached_indices],
+                return_exceptions=return_exceptions,
+            )
+            for i, outputs in zip(uncached_indices, outputs_list):
+                generated_list[i] = outputs
+
+        return [
+            self._merge_cached(keys, cached, generated)
+            for (keys, cached), generated in zip(lookups, generated_list)
+        ]
+
+    def _generate_batch_uncached(
+        self,
+        messages_list: Sequence[PromptValue],
+        confs: Sequence[LayoutPrompterConfiguration],
+        canvas_sizes: Sequence[CanvasSize],
+        configs: Sequence[RunnableConfig],
+        return_exceptions: bool = False,
+    ) -> List[List[Any]]:
+        """Generate the layouts of multiple prompts without the cache.
+
+        The fan-out requests of all the prompts are flattened into a single LLM batch
+        per output schema, serialization format and `max_concurrency`, so that each
+        prompt is rate-limited by its own configuration.
+        If `return_exceptions` is True, failed generations are returned as exceptions.
+        """
+        outputs_list: List[List[Any]] = [[] for _ in messages_list]
+
+        # Each prompt in the n-completions mode is a single call and each prompt with
+        # the early exit runs its own fan-out, so they are generated concurrently
+        individual_indices = [
+            i
+            for i, conf in enumerate(confs)
+            if conf.generation_mode == "n_completions"
+            or conf.early_exit_num_layouts is not None
+        ]
+
+        def generate_individually(i: int) -> List[Any]:
+            try:
+                if confs[i].early_exit_num_layouts is not None:
+                    return self._generate_until_accepted(
+                        messages_list[i], confs[i], canvas_sizes[i]
+                    )
+                return self._generate_n_completions(messages_list[i], confs[i])
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                return [e] * confs[i].num_return
+
+        # One executor per distinct `max_concurrency` of the runnable configs
+        executor_indices: Dict[Optional[int], List[int]] = defaultdict(list)
+        for i in individual_indices:
+            executor_indices[configs[i].get("max_concurrency")].append(i)
+        with ExitStack() as stack:
+            futures: Dict[int, Future[List[Any]]] = {}
+            for indices in executor_indices.values():
+                executor = stack.enter_context(
+                    get_executor_for_config(configs[indices[0]])
+                )
+                for i in indices:
+                    futures[i] = executor.submit(generate_individually, i)
+            for i, future in futures.items():
+                outputs_list[i] = future.result()
+
+        # Flatten the remaining requests of all the prompts
+        requests: Dict[
+            Tuple[Type[LayoutSerializedOutputData], SerializationFormat, int],
+            List[int],
+        ] = defaultdict(list)
+        for i, conf in enumerate(confs):
+            if conf.early_exit_num_layouts is not None:
+                continue
+            num_missing = conf.num_return - len(outputs_list[i])
+            key = (conf.output_schema, conf.serialization_format, conf.max_concurrency)
+            requests[key].extend([i] * num_missing)
+
+        for (_, _, max_concurrency), indices in requests.items():
+            if not indices:
+                continue
+            outputs = self._get_generation_llm(confs[indices[0]]).batch(
+                [messages_list[i] for i in indices],
+                config={"max_concurrency": max_concurrency},
+                return_exceptions=return_exceptions,
+            )
+            # Regroup the outputs by prompt
+            for i, output in zip(indices, outputs):
+                outputs_list[i].append(output)
+
+        return outputs_list
+
+    def _generate_as_completed(
+        self,
+        messages: PromptValue,
+        conf: LayoutPrompterConfiguration,
+        canvas_size: CanvasSize,
+    ) -> Iterator[LayoutSerializedOutputData]:
+        """Yield each of the `num_return` layouts as soon as its LLM call completes.
+
+        The cached layouts are yielded first.
+        """
+        keys, cached = self._lookup_cache(messages, conf)
+        yield from (output for output in cached if output is not None)
+
+        uncached_conf = self._get_uncached_conf(conf, cached, canvas_size)
+        if uncached_conf is None:
+            return
+        missing_keys = iter(
+            [key for key, output in zip(keys, cached) if output is None]
+        )
+
+        for output in self._generate_as_completed_uncached(
+            messages, uncached_conf, canvas_size
+        ):
+            key = next(missing_keys, None)
+            if key is not None and self.generation_cache is not None:
+                self.generation_cache.update({key: output.model_dump_json()})
+            yield output
+
+    def _generate_as_completed_uncached(
+        self,
+        messages: PromptValue,
+        conf: LayoutPrompterConfiguration,
+        canvas_size: CanvasSize,
+    ) -> Iterator[LayoutSerializedOutputData]:
+        if conf.early_exit_num_layouts is not None:
+            yield from self._generate_until_accepted_as_completed(
+                messages, conf, canvas_size
+            )
+            return
+
+        num_completed = 0
+        if conf.generation_mode == "n_completions":
+            for output in self._generate_n_completions(messages, conf):
+                num_completed += 1
+                yield output
+
+        num_missing = conf.num_return - num_completed
+        if num_missing > 0:
+            for _, generated in self._get_generation_llm(conf).batch_as_completed(
+                [messages] * num_missing,
+                config={"max_concurrency": conf.max_concurrency},
+            ):
+                yield cast(LayoutSerializedOutputData, generated)
+
+    async def _agenerate_n_completions(
+        self, messages: PromptValue, conf: LayoutPrompterConfiguration
+    ) -> List[LayoutSerializedOutputData]:
+        result = await self.llm.agenerate(
+            [messages.to_messages()],
+            n=conf.num_return,
+            **self._get_completion_kwargs(conf),
+        )
+        return self._parse_completions(result, conf)
+
+    async def _agenerate(
+        self,
+        messages: PromptValue,
+        conf: LayoutPrompterConfiguration,
+        canvas_size: CanvasSize,
+    ) -> List[LayoutSerializedOutputData]:
+        """Asynchronously generate `num_return` layouts for the prompt."""
+        keys, cached = self._lookup_cache(messages, conf)
+        uncached_conf = self._get_uncached_conf(conf, cached, canvas_size)
+        generated = (
+            await self._agenerate_uncached(messages, uncached_conf, canvas_size)
+            if uncached_conf is not None
+            else []
+        )
+        return self._merge_cached(keys, cached, generated)
+
+    async def _agenerate_uncached(
+        self,
+        messages: PromptValue,
+        conf: LayoutPrompterConfiguration,
+        canvas_size: CanvasSize,
+    ) -> List[LayoutSerializedOutputData]:
+        if conf.early_exit_num_layouts is not None:
+            return await self._agenerate_until_accepted(messages, conf, canvas_size)
+
+        outputs: List[LayoutSerializedOutputData] = []
+        if conf.generation_mode == "n_completions":
+            outputs = await self._agenerate_n_completions(messages, conf)
+
+        num_missing = conf.num_return - len(outputs)
+        if num_missing > 0:
+            outputs += cast(
+                List[LayoutSerializedOutputData],
+                await self._get_generation_llm(conf).abatch(
+                    [messages] * num_missing,
+                    config={"max_concurrency": conf.max_concurrency},
+                ),
+            )
+        return outputs
+
+    def invoke(
+        self,
+        input: ProcessedLayoutData,
+        config: Optional[RunnableConfig] = None,
+        **kwargs: Any,
+    ) -> LayoutPrompterOutput:
+        # Load configuration
+        conf = LayoutPrompterConfiguration.from_runnable_config(config)
+        self._check_configuration(conf)
+
+        # Get candidates based on the input query
+        selector_output = self.selector.select_examples(input)
+
+        # Generate `num_return` layouts and rank them
+        messages = self._build_messages(input, selector_output, config=config)
+        outputs = self._generate(messages, conf, input.canvas_size)
+        return self._build_output(input, selector_output, outputs, conf)
+
+    def batch(
+        self,
+        inputs: List[ProcessedLayoutData],
+        config: Optional[Union[RunnableConfig, List[RunnableConfig]]] = None,
+        *,
+        return_exceptions: bool = False,
+        **kwargs: Any,
+    ) -> List[LayoutPrompterOutput]:
+        if not inputs:
+            return []
+
+        configs = get_config_list(config, len(inputs))
+        confs = [LayoutPrompterConfiguration.from_runnable_config(c) for c in configs]
+        for conf in confs:
+            self._check_configuration(conf)
+
+        # Select the candidates of all the queries in a single batched pass
+        selector_outputs = self.selector.select_examples_batch(inputs)
+
+        # Build all the prompts and generate the layouts in a single LLM batch
+        messages_list = [
+            self._build_messages(input, selector_output, config=c)
+            for input, selector_output, c in zip(inputs, selector_outputs, configs)
+        ]
+        outputs_list = self._generate_batch(
+            messages_list,
+            confs,
+            [input.canvas_size for input in inputs],
+            configs,
+            return_exceptions=return_exceptions,
+        )
+
+        results: List[Any] = []
+        for input, selector_output, outputs, conf in zip(
+            inputs, selector_outputs, outputs_list, confs
+        ):
+            # A query fails if any of its generations fails
+            error = next((o for o in outputs if isinstance(o, Exception)), None)
+            results.append(
+                error
+                if error is not None
+                else self._build_output(input, selector_output, outputs, conf)
+            )
+        return results
+
+    async def _agenerate_as_completed(
+        self,
+        messages: PromptValue,
+        conf: LayoutPrompterConfiguration,
+        canvas_size: CanvasSize,
+    ) -> AsyncIterator[LayoutSerializedOutputData]:
+        """Asynchronously yield each layout as soon as its LLM call completes.
+
+        The cached layouts are yielded first.
+        """
+        keys, cached = self._lookup_cache(messages, conf)
+        for output in cached:
+            if output is not None:
+                yield output
+
+        uncached_conf = self._get_uncached_conf(conf, cached, canvas_size)
+        if uncached_conf is None:
+            return
+        missing_keys = iter(
+            [key for key, output in zip(keys, cached) if output is None]
+        )
+
+        async for output in self._agenerate_as_completed_uncached(
+            messages, uncached_conf, canvas_size
+        ):
+            key = next(missing_keys, None)
+            if key is not None and self.generation_cache is not None:
+                self.generation_cache.update({key: output.model_dump_json()})
+            yield output
+
+    async def _agenerate_as_completed_uncached(
+        self,
+        messages: PromptValue,
+        conf: LayoutPrompterConfiguration,
+        canvas_size: CanvasSize,
+    ) -> AsyncIterator[LayoutSerializedOutputData]:
+        if conf.early_exit_num_layouts is not None:
+            async for output in self._agenerate_until_accepted_as_completed(
+                messages, conf, canvas_size
+            ):
+                yield output
+            return
+
+        num_completed = 0
+        if conf.generation_mode == "n_completions":
+            for output in await self._agenerate_n_completions(messages, conf):
+                num_completed += 1
+                yield output
+
+        num_missing = conf.num_return - num_completed
+        if num_missing > 0:
+            async for _, generated in self._get_generation_llm(
+                conf
+            ).abatch_as_completed(
+                [messages] * num_missing,
+                config={"max_concurrency": conf.max_concurrency},
+            ):
+                yield cast(LayoutSerializedOutputData, generated)
+
+    def stream(  # type: ignore[override]
+        self,
+        input: ProcessedLayoutData,
+        config: Optional[RunnableConfig] = None,
+        **kwargs: Any,
+    ) -> Iterator[LayoutPrompterStreamEvent]:
+        """Yield each generated layout as soon as it is parsed, then the ranked output."""
+        conf = LayoutPrompterConfiguration.from_runnable_config(config)
+        self._check_configuration(conf)
+
+        selector_output = self.selector.select_examples(input)
+        messages = self._build_messages(input, selector_output, config=config)
+
+        outputs: List[LayoutSerializedOutputData] = []
+        for output in self._generate_as_completed(messages, conf, input.canvas_size):
+            outputs.append(output)
+            yield LayoutPrompterStreamEvent(generated_output=output)
+
+        yield LayoutPrompterStreamEvent(
+            final_output=self._build_output(input, selector_output, outputs, conf)
+        )
+
+    async def astream(  # type: ignore[override]
+        self,
+        input: ProcessedLayoutData,
+        config: Optional[RunnableConfig] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[LayoutPrompterStreamEvent]:
+        """Asynchronously yield each generated layout as soon as it is parsed,
+        then the ranked output.
+        """
+        conf = LayoutPrompterConfiguration.from_runnable_config(config)
+        self._check_configuration(conf)
+
+        selector_output = await run_in_executor(
+            config, self.selector.select_examples, input
+        )
+        messages = self._build_messages(input, selector_output, config=config)
+
+        outputs: List[LayoutSerializedOutputData] = []
+        async for output in self._agenerate_as_completed(
+            messages, conf, input.canvas_size
+        ):
+            outputs.append(output)
+            yield LayoutPrompterStreamEvent(generated_output=output)
+
+        yield LayoutPrompterStreamEvent(
+            final_output=self._build_output(input, selector_output, outputs, conf)
+        )
+
+    async def _ainvoke_selected(
+        self,
+        input: ProcessedLayoutData,
+        selector_output: LayoutSelectorOutput,
+        config: Optional[RunnableConfig] = None,
+    ) -> LayoutPrompterOutput:
+        conf = LayoutPrompterConfiguration.from_runnable_config(config)
+        messages = self._build_messages(input, selector_output, config=config)
+        outputs = await self._agenerate(messages, conf, input.canvas_size)
+        return self._build_output(input, selector_output, outputs, conf)
+
+    async def ainvoke(
+        self,
+        input: ProcessedLayoutData,
+        config: Optional[RunnableConfig] = None,
+        **kwargs: Any,
+    ) -> LayoutPrompterOutput:
+        conf = LayoutPrompterConfiguration.from_runnable_config(config)
+        self._check_configuration(conf)
+
+        # The selection is CPU-bound, so it is run in an executor not to block the event loop
+        selector_output = await run_in_executor(
+            config, self.selector.select_examples, input
+        )
+        return await self._ainvoke_selected(input, selector_output, config=config)
+
+    async def abatch(
+        self,
+        inputs: List[ProcessedLayoutData],
+        config: Optional[Union[RunnableConfig, List[RunnableConfig]]] = None,
+        *,
+        return_exceptions: bool = False,
+        **kwargs: Any,
+    ) -> List[LayoutPrompterOutput]:
+        if not inputs:
+            return []
+
+        configs = get_config_list(config, len(inputs))
+        for c in configs:
+            self._check_configuration(
+                LayoutPrompterConfiguration.from_runnable_config(c)
+            )
+
+        # Select the candidates of all the queries in a single batched pass
+        selector_outputs = await run_in_executor(
+            configs[0], self.selector.select_examples_batch, inputs
+        )
+
+        # The generations of all the queries are driven by the event loop, with one
+        # semaphore per distinct `max_concurrency` of the runnable configs
+        coros = [
+            self._ainvoke_selected(input, selector_output, config=c)
+            for input, selector_output, c in zip(inputs, selector_outputs, configs)
+        ]
+        group_indices: Dict[Optional[int], List[int]] = defaultdict(list)
+        for i, c in enumerate(configs):
+            group_indices[c.get("max_concurrency")].append(i)
+        group_results = await asyncio.gather(
+            *(
+                gather_with_concurrency(
+                    max_concurrency,
+                    *(
+                        self._return_exceptions(coros[i])
+                        if return_exceptions
+                        else coros[i]
+                        for i in indices
+                    ),
+                )
+                for max_concurrency, indices in group_indices.items()
+            )
+        )
+
+        results: List[Any] = [None] * len(inputs)
+        for indices, group_result in zip(group_indices.values(), group_results):
+            for i, result in zip(indices, group_result):
+                results[i] = result
+        return results
+
+    @staticmethod
+    async def _return_exceptions(coro: Awaitable[Any]) -> Any:
+        try:
+            return await coro
+        except Exception as e:
+            return e
@@ -1,4 +1,5 @@
-from .rankers import LayoutPrompterRanker, LayoutRanker
+from .caches import GenerationCache, SQLiteGenerationCache
+from .rankers import ContentAwareRanker, LayoutPrompterRanker, LayoutRanker
 from .selectors import ContentAwareSelector, LayoutSelector
 from .serializers import ContentAwareSerializer, LayoutSerializer
 
@@ -12,4 +13,8 @@ __all__ = [
     # Rankers
     "LayoutRanker",
     "LayoutPrompterRanker",
+    "ContentAwareRanker",
+    # Caches
+    "GenerationCache",
+    "SQLiteGenerationCache",
 ]
@@ -0,0 +1,7 @@
+from .base import GenerationCache
+from .sqlite_cache import SQLiteGenerationCache
+
+__all__ = [
+    "GenerationCache",
+    "SQLiteGenerationCache",
+]
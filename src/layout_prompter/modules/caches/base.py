@@ -0,0 +1,56 @@
+import abc
+from typing import Dict, List, Mapping, Optional, Sequence
+
+from pydantic import BaseModel, PrivateAttr
+
+
+class GenerationCache(BaseModel, abc.ABC):
+    """Base class for caches of the serialized layouts generated by the LLM.
+
+    The keys identify a single generation, i.e., a prompt, a model, an output schema
+    and the index of the sample among the `num_return` generations of the prompt.
+    """
+
+    _hits: int = PrivateAttr(default=0)
+    _misses: int = PrivateAttr(default=0)
+
+    @property
+    def hits(self) -> int:
+        return self._hits
+
+    @property
+    def misses(self) -> int:
+        return self._misses
+
+    @property
+    def hit_rate(self) -> float:
+        num_lookups = self._hits + self._misses
+        return self._hits / num_lookups if num_lookups > 0 else 0.0
+
+    def lookup(self, keys: Sequence[str]) -> List[Optional[str]]:
+        """Look up the serialized generations of the keys, None for the missing ones."""
+        found = self._lookup(keys)
+        values = [found.get(key) for key in keys]
+
+        num_hits = sum(value is not None for value in values)
+        self._hits += num_hits
+        self._misses += len(values) - num_hits
+        return values
+
+    @abc.abstractmethod
+    def _lookup(self, keys: Sequence[str]) -> Dict[str, str]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def update(self, items: Mapping[str, str]) -> None:
+        """Store serialized generations by key."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def clear(self) -> None:
+        """Remove all the generations. The hit/miss counters are kept."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def __len__(self) -> int:
+        raise NotImplementedError
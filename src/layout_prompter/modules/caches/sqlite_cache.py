@@ -0,0 +1,119 @@
+import pathlib
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Mapping, Optional, Sequence, Union
+
+from pydantic import PrivateAttr
+
+from .base import GenerationCache
+
+# Maximum number of parameters of a single SQLite statement in old versions
+MAX_VARIABLES = 999
+
+
+class SQLiteGenerationCache(GenerationCache):
+    """Generation cache stored in an SQLite database on disk.
+
+    The least recently used generations are evicted when the number of entries
+    exceeds `max_entries`.
+    """
+
+    database_path: Union[str, pathlib.Path]
+    max_entries: int = 100_000
+
+    _connection: Optional[sqlite3.Connection] = PrivateAttr(default=None)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    # Running number of entries, so that writes do not count the whole table
+    _num_entries: int = PrivateAttr(default=0)
+
+    def model_post_init(self, __context: Any) -> None:
+        pathlib.Path(self.database_path).parent.mkdir(parents=True, exist_ok=True)
+        # The connection is shared by the threads of the fan-out under the lock
+        self._connection = sqlite3.connect(
+            self.database_path, check_same_thread=False, isolation_level=None
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS generations ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, accessed_at INTEGER NOT NULL)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS generations_accessed_at "
+            "ON generations (accessed_at)"
+        )
+        (self._num_entries,) = self._connection.execute(
+            "SELECT COUNT(*) FROM generations"
+        ).fetchone()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        assert self._connection is not None
+        return self._connection
+
+    def _lookup(self, keys: Sequence[str]) -> Dict[str, str]:
+        found: Dict[str, str] = {}
+        with self._lock:
+            for start in range(0, len(keys), MAX_VARIABLES):
+                chunk = list(keys[start : start + MAX_VARIABLES])
+                placeholders = ",".join("?" * len(chunk))
+                found.update(
+                    self.connection.execute(
+                        f"SELECT key, value FROM generations WHERE key IN ({placeholders})",
+                        chunk,
+                    ).fetchall()
+                )
+                # Mark the generations found as recently used
+                self.connection.execute(
+                    f"UPDATE generations SET accessed_at = ? WHERE key IN ({placeholders})",
+                    [time.time_ns(), *chunk],
+                )
+        return found
+
+    def update(self, items: Mapping[str, str]) -> None:
+        if not items:
+            return
+
+        accessed_at = time.time_ns()
+        with self._lock:
+            self.connection.execute("BEGIN")
+            # Update the existing keys first, so that the insert only counts new rows
+            self.connection.executemany(
+                "UPDATE generations SET value = ?, accessed_at = ? WHERE key = ?",
+                [(value, accessed_at, key) for key, value in items.items()],
+            )
+            num_added = self.connection.executemany(
+                "INSERT OR IGNORE INTO generations (key, value, accessed_at) "
+                "VALUES (?, ?, ?)",
+                [(key, value, accessed_at) for key, value in items.items()],
+            ).rowcount
+            self._num_entries += num_added
+
+            # Evict the least recently used generations beyond the size cap
+            num_excess = self._num_entries - self.max_entries
+            if num_added > 0 and num_excess > 0:
+                self._num_entries -= self.connection.execute(
+                    "DELETE FROM generations WHERE rowid IN ("
+                    "SELECT rowid FROM generations ORDER BY accessed_at ASC LIMIT ?)",
+                    (num_excess,),
+                ).rowcount
+            self.connection.execute("COMMIT")
+
+    def clear(self) -> None:
+        with self._lock:
+            self.connection.execute("DELETE FROM generations")
+            self._num_entries = 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            (count,) = self.connection.execute(
+                "SELECT COUNT(*) FROM generations"
+            ).fetchone()
+        return count
+
+    def close(self) -> None:
+        """Close the connection to the database."""
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
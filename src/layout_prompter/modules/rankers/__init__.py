@@ -1,7 +1,9 @@
 from .base import LayoutRanker
+from .content_aware import ContentAwareRanker
 from .layout_prompter import LayoutPrompterRanker
 
 __all__ = [
     "LayoutRanker",
     "LayoutPrompterRanker",
+    "ContentAwareRanker",
 ]
@@ -1,6 +1,7 @@
 import abc
-from typing import Any, List, Optional
+from typing import Any, List, Optional, Sequence, Tuple
 
+import numpy as np
 from langchain_core.runnables import RunnableSerializable
 from langchain_core.runnables.config import RunnableConfig
 
@@ -18,3 +19,33 @@ class LayoutRanker(RunnableSerializable):
         **kwargs: Any,
     ) -> List[LayoutSerializedOutputData]:
         raise NotImplementedError
+
+    def _pad_layouts(
+        self, layouts_list: Sequence[Sequence[Any]]
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Pad the elements of the layouts into (bboxes, labels, padding mask) arrays
+        of shapes (B, N, 4), (B, N) and (B, N).
+        """
+        max_num_elements = max(len(layouts) for layouts in layouts_list)
+
+        bboxes = np.zeros((len(layouts_list), max_num_elements, 4), dtype=np.int64)
+        labels = np.full((len(layouts_list), max_num_elements), None, dtype=object)
+        padmsk = np.zeros((len(layouts_list), max_num_elements), dtype=bool)
+        for i, layouts in enumerate(layouts_list):
+            bboxes[i, : len(layouts)] = [layout.bbox.to_ltrb() for layout in layouts]
+            labels[i, : len(layouts)] = [layout.class_name for layout in layouts]
+            padmsk[i, : len(layouts)] = True
+        return bboxes, labels, padmsk
+
+    def _min_max_scale(self, values: np.ndarray) -> np.ndarray:
+        """Scale each column of the values to [0, 1]. Constant columns are scaled to 0,
+        so that they do not affect the ranking.
+        """
+        min_vals = np.min(values, axis=0, keepdims=True)
+        ranges = np.max(values, axis=0, keepdims=True) - min_vals
+        return np.divide(
+            values - min_vals,
+            ranges,
+            out=np.zeros(values.shape, dtype=np.float64),
+            where=ranges > 0,
+        )
@@ -0,0 +1,208 @@
+from typing import Any, List, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+from langchain_core.runnables.config import RunnableConfig
+from pydantic import model_validator
+from typing_extensions import Self
+
+from layout_prompter.models import (
+    Bbox,
+    CanvasSize,
+    LayoutSerializedOutputData,
+    ProcessedLayoutData,
+)
+
+from .base import LayoutRanker
+
+
+def _to_axis_masks(
+    bboxes: np.ndarray, canvas_size: CanvasSize
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Rasterize (..., N, 4) LTRB bboxes into the rows (..., N, H) and the columns
+    (..., N, W) of the canvas they cover, following the half-open pixel convention.
+    """
+    ys = np.arange(canvas_size.height)
+    xs = np.arange(canvas_size.width)
+    in_y = (bboxes[..., 1, None] <= ys) & (ys < bboxes[..., 3, None])
+    in_x = (bboxes[..., 0, None] <= xs) & (xs < bboxes[..., 2, None])
+    return in_y.astype(np.float32), in_x.astype(np.float32)
+
+
+def _to_union_masks(
+    in_y: np.ndarray, in_x: np.ndarray, elemmsk: np.ndarray
+) -> np.ndarray:
+    """Compute the (B, H, W) masks of the union of the elements selected by the (B, N)
+    element mask, without materializing the (B, N, H, W) masks of each element.
+    """
+    counts = np.einsum("bnh,bnw->bhw", in_y * elemmsk[..., None], in_x)
+    return (counts > 0).astype(np.float32)
+
+
+class ContentAwareRanker(LayoutRanker):
+    """Rank the layouts with the content-aware metrics of PosterLayout, computed
+    against the content (salient) regions of the query, i.e., `invoke(outputs,
+    query=query)`.
+    """
+
+    name: str = "content-aware-ranker"
+
+    # Weights of the metrics:
+    # - occlusion: the ratio of the salient region covered by the elements (lower is better)
+    # - utility: the ratio of the non-salient region covered by the elements (higher is better)
+    # - underlay: how well each underlay contains a non-underlay element (higher is better)
+    # - readability: the image gradient behind the text elements (lower is better)
+    lam_occ: float = 0.4
+    lam_uti: float = 0.2
+    lam_und: float = 0.2
+    lam_rea: float = 0.2
+
+    underlay_labels: List[str] = ["underlay"]
+    text_labels: List[str] = ["text"]
+
+    # Number of layouts whose metrics are computed at once in `calculate_metrics_batch`,
+    # which bounds the memory of the (batch_size, H, W) union masks
+    batch_size: int = 64
+
+    @model_validator(mode="after")
+    def check_lambda_params(self) -> Self:
+        assert np.isclose(
+            self.lam_occ + self.lam_uti + self.lam_und + self.lam_rea, 1.0
+        ), self
+        return self
+
+    def _get_saliency_map(self, query: ProcessedLayoutData) -> np.ndarray:
+        """Get the (H, W) binary saliency map of the content bboxes of the query."""
+        content_bboxes: Sequence[Bbox] = query.discrete_content_bboxes or []
+        if not content_bboxes:
+            return np.zeros(
+                (query.canvas_size.height, query.canvas_size.width), dtype=np.float32
+            )
+        in_y, in_x = _to_axis_masks(
+            np.array([bbox.to_ltrb() for bbox in content_bboxes]), query.canvas_size
+        )
+        return (np.einsum("nh,nw->hw", in_y, in_x) > 0).astype(np.float32)
+
+    def _get_gradient_map(self, query: ProcessedLayoutData) -> Optional[np.ndarray]:
+        """Get the (H, W) gradient magnitude of the content image of the query in
+        [0, 1], or None if the query has no image.
+        """
+        if query.encoded_image is None:
+            return None
+        canvas_size = query.canvas_size
+        image = query.content_image.convert("L").resize(
+            (canvas_size.width, canvas_size.height)
+        )
+        gray = np.asarray(image, dtype=np.float32) / 255.0
+        grad_x = cv2.Sobel(gray, cv2.CV_32F, 1, 0, ksize=3)
+        grad_y = cv2.Sobel(gray, cv2.CV_32F, 0, 1, ksize=3)
+        # The maximum magnitude of the 3x3 Sobel filter on [0, 1] images is 4 * sqrt(2)
+        return np.hypot(grad_x, grad_y) / (4 * np.sqrt(2))
+
+    def _compute_underlay_effectiveness(
+        self, bboxes: np.ndarray, labels: np.ndarray, padmsk: np.ndarray
+    ) -> np.ndarray:
+        """For each underlay, take the largest ratio of a non-underlay element that
+        it contains, and average it over the underlays of the layout.
+        """
+        is_underlay = np.isin(labels, self.underlay_labels) & padmsk
+        is_other = ~np.isin(labels, self.underlay_labels) & padmsk
+
+        # (B, N, N) intersection of each underlay (rows) with each element (columns)
+        l1, t1, r1, b1 = (bboxes[:, :, None, i] for i in range(4))
+        l2, t2, r2, b2 = (bboxes[:, None, :, i] for i in range(4))
+        inter = np.clip(np.minimum(r1, r2) - np.maximum(l1, l2), 0, None) * np.clip(
+            np.minimum(b1, b2) - np.maximum(t1, t2), 0, None
+        )
+        area = (bboxes[..., 2] - bboxes[..., 0]) * (bboxes[..., 3] - bboxes[..., 1])
+        ratio = np.divide(
+            inter,
+            area[:, None, :],
+            out=np.zeros(inter.shape, dtype=np.float64),
+            where=area[:, None, :] > 0,
+        )
+        max_ratio = (ratio * is_other[:, None, :]).max(axis=-1, initial=0.0)
+
+        num_underlays = is_underlay.sum(axis=-1)
+        # Layouts without underlays have no ineffective underlay
+        return np.where(
+            num_underlays > 0,
+            (max_ratio * is_underlay).sum(axis=-1) / np.maximum(num_underlays, 1),
+            1.0,
+        )
+
+    def calculate_metrics_batch(
+        self,
+        data_list: Sequence[LayoutSerializedOutputData],
+        query: ProcessedLayoutData,
+    ) -> np.ndarray:
+        """Calculate the content-aware metrics of multiple layouts at once.
+
+        Returns:
+            np.ndarray: The (occlusion, utility, underlay, readability) metrics of
+                shape (len(data_list), 4). The readability is 0 if the query has
+                no image.
+        """
+        layouts_list = [data.layouts for data in data_list]
+        if any(not layouts for layouts in layouts_list):
+            raise ValueError("Cannot calculate metrics for empty layouts")
+
+        saliency_map = self._get_saliency_map(query)
+        gradient_map = self._get_gradient_map(query)
+        salient_area = saliency_map.sum()
+        non_salient_area = saliency_map.size - salient_area
+
+        metrics = []
+        for start in range(0, len(layouts_list), self.batch_size):
+            bboxes, labels, padmsk = self._pad_layouts(
+                layouts_list[start : start + self.batch_size]
+            )
+            in_y, in_x = _to_axis_masks(bboxes, query.canvas_size)
+            union = _to_union_masks(in_y, in_x, padmsk)
+
+            covered_salient_area = (union * saliency_map).sum(axis=(1, 2))
+            occ = covered_salient_area / max(salient_area, 1)
+            uti = (union.sum(axis=(1, 2)) - covered_salient_area) / max(
+                non_salient_area, 1
+            )
+            und = self._compute_underlay_effectiveness(bboxes, labels, padmsk)
+
+            if gradient_map is None:
+                rea = np.zeros(len(bboxes))
+            else:
+                text_union = _to_union_masks(
+                    in_y, in_x, np.isin(labels, self.text_labels) & padmsk
+                )
+                text_area = text_union.sum(axis=(1, 2))
+                rea = (text_union * gradient_map).sum(axis=(1, 2)) / np.maximum(
+                    text_area, 1
+                )
+
+            metrics.append(np.stack([occ, uti, und, rea], axis=-1))
+        return np.concatenate(metrics)
+
+    def invoke(
+        self,
+        input: List[LayoutSerializedOutputData],
+        config: Optional[RunnableConfig] = None,
+        **kwargs: Any,
+    ) -> List[LayoutSerializedOutputData]:
+        query: Optional[ProcessedLayoutData] = kwargs.get("query")
+        if query is None:
+            raise ValueError(
+                "ContentAwareRanker requires the query, e.g., "
+                "`invoke(outputs, query=query)`"
+            )
+        scaled_metrics = self._min_max_scale(self.calculate_metrics_batch(input, query))
+
+        # Lower is better, so the utility and the underlay effectiveness are inverted
+        quality = (
+            scaled_metrics[:, 0] * self.lam_occ
+            + (1 - scaled_metrics[:, 1]) * self.lam_uti
+            + (1 - scaled_metrics[:, 2]) * self.lam_und
+            + scaled_metrics[:, 3] * self.lam_rea
+        )
+
+        # Sort the input based on the quality scores
+        sorted_input = sorted(zip(input, quality), key=lambda x: x[1])
+        return [item[0] for item in sorted_input]
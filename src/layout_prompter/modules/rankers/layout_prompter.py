@@ -1,14 +1,23 @@
-from typing import Any, List, Optional, Tuple
+from typing import Any, List, Literal, Optional, Sequence, Tuple
 
 import numpy as np
 from langchain_core.runnables.config import RunnableConfig
 from pydantic import model_validator
 from typing_extensions import Self
 
-from layout_prompter.models import LayoutSerializedOutputData
+from layout_prompter.models import (
+    Bbox,
+    CanvasSize,
+    LayoutSerializedOutputData,
+    ProcessedLayoutData,
+)
 from layout_prompter.utils import (
+    AlignmentMethod,
     compute_alignment,
+    compute_alignment_batch,
     compute_overlap,
+    compute_overlap_batch,
+    compute_pairwise_iou,
 )
 
 from .base import LayoutRanker
@@ -21,42 +30,230 @@ class LayoutPrompterRanker(LayoutRanker):
     lam_ove: float = 0.2
     lam_iou: float = 0.6
 
+    # Number of layouts whose metrics are computed at once in `calculate_metrics_batch`,
+    # which bounds the memory of the (batch_size, N, 6, N) pairwise arrays
+    batch_size: int = 256
+
+    # Implementation of the alignment metric, "sorted" scales to large layouts
+    alignment_method: AlignmentMethod = "pairwise"
+
+    # If given, the overlap metric computes the pairs of elements for this many
+    # elements at a time, which bounds its memory for large layouts
+    overlap_block_size: Optional[int] = None
+
+    # Reference bboxes of the IoU term, e.g., `invoke(outputs, query=query)`:
+    # - "content": the content bboxes of the query, i.e., the salient regions of the
+    #   canvas. A higher IoU means more occlusion, which is worse.
+    # - "reference": the gold bboxes of `reference_layouts`, e.g., a validation set as
+    #   in the original LayoutPrompter. The maximum IoU over them is used.
+    # - "gold": the gold bboxes of the query itself. This is the ground truth of the
+    #   query, so only use it for oracle analyses, never for evaluation.
+    # - "auto": "content" for content-aware queries, otherwise "reference" if
+    #   `reference_layouts` is given, otherwise no IoU term
+    iou_target: Literal["auto", "content", "reference", "gold"] = "auto"
+    reference_layouts: Optional[List[ProcessedLayoutData]] = None
+
     @model_validator(mode="after")
     def check_lambda_params(self) -> Self:
         assert self.lam_ali + self.lam_ove + self.lam_iou == 1.0, self
         return self
 
-    def calculate_metrics(self, data: LayoutSerializedOutputData) -> Tuple[float, ...]:
+    @model_validator(mode="after")
+    def check_reference_layouts(self) -> Self:
+        assert self.iou_target != "reference" or self.reference_layouts, (
+            "`reference_layouts` must be given for the reference IoU target"
+        )
+        return self
+
+    def calculate_metrics(
+        self,
+        data: LayoutSerializedOutputData,
+        canvas_size: Optional[CanvasSize] = None,
+    ) -> Tuple[float, ...]:
+        """Calculate the (alignment, overlap) metrics of a layout.
+
+        The alignment compares the distances between the elements with 1, so the
+        bboxes should be normalized to [0, 1] by passing the `canvas_size` to compare
+        the metrics with absolute thresholds.
+        """
         if not data.layouts:
             raise ValueError("Cannot calculate metrics for empty layouts")
         bboxes = np.array([layout.bbox.to_ltrb() for layout in data.layouts])
+        if canvas_size is not None:
+            bboxes = bboxes / np.array(
+                [canvas_size.width, canvas_size.height] * 2, dtype=np.float64
+            )
         labels = np.array([layout.class_name for layout in data.layouts])
 
         bboxes, labels = bboxes[None, :, :], labels[None, :]
         padmsk = np.ones_like(labels, dtype=bool)
 
-        ali_score = compute_alignment(bboxes, padmsk)
-        ove_score = compute_overlap(bboxes, padmsk)
+        ali_score = compute_alignment(bboxes, padmsk, method=self.alignment_method)
+        ove_score = compute_overlap(bboxes, padmsk, block_size=self.overlap_block_size)
         return (ali_score, ove_score)
 
+    def calculate_metrics_batch(
+        self, data_list: Sequence[LayoutSerializedOutputData]
+    ) -> np.ndarray:
+        """Calculate the metrics of multiple layouts at once.
+
+        The layouts are padded into a (batch_size, N, 4) array with a padding mask.
+
+        Returns:
+            np.ndarray: The (alignment, overlap) scores of shape (len(data_list), 2),
+                equal to those of `calculate_metrics` for each layout.
+        """
+        layouts_list = [data.layouts for data in data_list]
+        if any(not layouts for layouts in layouts_list):
+            raise ValueError("Cannot calculate metrics for empty layouts")
+
+        metrics = []
+        for start in range(0, len(layouts_list), self.batch_size):
+            bboxes, _, padmsk = self._pad_layouts(
+                layouts_list[start : start + self.batch_size]
+            )
+            metrics.append(
+                np.stack(
+                    [
+                        compute_alignment_batch(
+                            bboxes, padmsk, method=self.alignment_method
+                        ),
+                        compute_overlap_batch(
+                            bboxes, padmsk, block_size=self.overlap_block_size
+                        ),
+                    ],
+                    axis=1,
+                )
+            )
+        return np.concatenate(metrics).reshape(-1, 2)
+
+    def _resolve_iou_target(
+        self, query: Optional[ProcessedLayoutData]
+    ) -> Optional[Literal["content", "reference", "gold"]]:
+        if self.iou_target != "auto":
+            return self.iou_target
+        if query is not None and query.discrete_content_bboxes:
+            return "content"
+        return "reference" if self.reference_layouts else None
+
+    def _get_gold_bboxes(
+        self, data: ProcessedLayoutData
+    ) -> Tuple[Sequence[Bbox], Optional[Sequence[str]]]:
+        bboxes = data.discrete_gold_bboxes or []
+        # The labels can only be matched if they correspond to the gold bboxes
+        labels = data.labels if len(data.labels or ()) == len(bboxes) else None
+        return bboxes, labels
+
+    def _calculate_max_iou(
+        self,
+        data_list: Sequence[LayoutSerializedOutputData],
+        references: Sequence[Tuple[Sequence[Bbox], Optional[Sequence[str]]]],
+    ) -> np.ndarray:
+        """For each layout, average the maximum IoU of its elements with the bboxes of
+        each reference (of the same label, if given), and take the best reference.
+        """
+        scores = np.zeros(len(data_list))
+        for start in range(0, len(data_list), self.batch_size):
+            bboxes, labels, padmsk = self._pad_layouts(
+                [data.layouts for data in data_list[start : start + self.batch_size]]
+            )
+            chunk_scores = np.zeros(len(bboxes))
+            for ref_start in range(0, len(references), self.batch_size):
+                chunk = references[ref_start : ref_start + self.batch_size]
+                ref_ltrb = np.array(
+                    [bbox.to_ltrb() for ref_bboxes, _ in chunk for bbox in ref_bboxes]
+                )
+                ref_starts = np.cumsum(
+                    [0] + [len(ref_bboxes) for ref_bboxes, _ in chunk]
+                )
+                # The bboxes of the references without labels match any label
+                ref_labels = np.array(
+                    [
+                        label
+                        for ref_bboxes, labels_or_none in chunk
+                        for label in (labels_or_none or [""] * len(ref_bboxes))
+                    ]
+                )
+                any_label = np.array(
+                    [
+                        labels_or_none is None
+                        for ref_bboxes, labels_or_none in chunk
+                        for _ in ref_bboxes
+                    ]
+                )
+
+                # (B, N, M) IoU of each generated element with each reference bbox
+                iou = compute_pairwise_iou(bboxes, ref_ltrb[None])
+                iou = iou * (
+                    (labels[:, :, None] == ref_labels[None, None, :])
+                    | any_label[None, None, :]
+                )
+                # (B, N, R) maximum IoU with the bboxes of each reference
+                max_iou = np.maximum.reduceat(iou, ref_starts[:-1], axis=-1)
+                mean_iou = (max_iou * padmsk[:, :, None]).sum(axis=1) / np.maximum(
+                    padmsk.sum(axis=-1, keepdims=True), 1
+                )
+                chunk_scores = np.maximum(chunk_scores, mean_iou.max(axis=-1))
+            scores[start : start + len(bboxes)] = chunk_scores
+        return scores
+
+    def calculate_iou_batch(
+        self,
+        data_list: Sequence[LayoutSerializedOutputData],
+        query: Optional[ProcessedLayoutData] = None,
+    ) -> Optional[np.ndarray]:
+        """Calculate the IoU term of multiple layouts against the reference bboxes of
+        the IoU target.
+
+        For each generated element, the maximum IoU with the reference bboxes is
+        taken, then averaged over the elements of the layout. For the "reference"
+        target, the best of the reference layouts is used.
+
+        Returns:
+            Optional[np.ndarray]: The IoU scores of shape (len(data_list),), or None
+                if there are no reference bboxes.
+        """
+        target = self._resolve_iou_target(query)
+        if target == "reference":
+            assert self.reference_layouts is not None
+            references = [
+                self._get_gold_bboxes(data) for data in self.reference_layouts
+            ]
+        elif target == "content" and query is not None:
+            references = [(query.discrete_content_bboxes or [], None)]
+        elif target == "gold" and query is not None:
+            references = [self._get_gold_bboxes(query)]
+        else:
+            return None
+
+        references = [reference for reference in references if reference[0]]
+        if not references:
+            return None
+        return self._calculate_max_iou(data_list, references)
+
     def invoke(
         self,
         input: List[LayoutSerializedOutputData],
         config: Optional[RunnableConfig] = None,
         **kwargs: Any,
     ) -> List[LayoutSerializedOutputData]:
-        metrics_arr = np.array([self.calculate_metrics(data) for data in input])
-
-        min_vals = np.min(metrics_arr, axis=0, keepdims=True)
-        max_vals = np.max(metrics_arr, axis=0, keepdims=True)
-
-        scaled_metrics = (metrics_arr - min_vals) / (max_vals - min_vals)
+        scaled_metrics = self._min_max_scale(self.calculate_metrics_batch(input))
 
         # Calculate the quality score based on the weighted sum of the metrics
         quality = (
             scaled_metrics[:, 0] * self.lam_ali + scaled_metrics[:, 1] * self.lam_ove
         )
 
+        # The content IoU term requires the query, e.g., `invoke(outputs, query=query)`
+        query: Optional[ProcessedLayoutData] = kwargs.get("query")
+        iou = self.calculate_iou_batch(input, query) if self.lam_iou > 0 else None
+        if iou is not None:
+            scaled_iou = self._min_max_scale(iou)
+            # Lower is better, so the IoU with the gold bboxes is inverted
+            if self._resolve_iou_target(query) != "content":
+                scaled_iou = 1 - scaled_iou
+            quality = quality + scaled_iou * self.lam_iou
+
         # Sort the input based on the quality scores
         sorted_input = sorted(zip(input, quality), key=lambda x: x[1])
 
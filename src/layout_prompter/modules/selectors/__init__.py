@@ -1,3 +1,4 @@
+from .ann import ANNBackend, IVFBackend
 from .base import LayoutSelector, LayoutSelectorOutput
 from .content_aware_selector import ContentAwareSelector, ContentAwareSelectorOutput
 
@@ -6,4 +7,6 @@ __all__ = [
     "LayoutSelectorOutput",
     "ContentAwareSelector",
     "ContentAwareSelectorOutput",
+    "ANNBackend",
+    "IVFBackend",
 ]
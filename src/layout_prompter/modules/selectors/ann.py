@@ -0,0 +1,191 @@
+import abc
+from typing import Optional, Tuple
+
+import numpy as np
+from pydantic import BaseModel, Field, PrivateAttr
+
+
+def compute_occupancy_descriptors(
+    binary_images: np.ndarray, grid_size: int
+) -> np.ndarray:
+    """Downsample binary images into fixed-size occupancy grid descriptors.
+
+    Args:
+        binary_images (np.ndarray): Binary images of shape (N, height, width).
+        grid_size (int): Number of grid cells along each side of the canvas.
+
+    Returns:
+        np.ndarray: The fraction of salient pixels in each grid cell, of shape (N, grid_size * grid_size).
+    """
+    num_images, height, width = binary_images.shape
+    assert grid_size <= min(height, width), (
+        f"grid_size ({grid_size}) must not exceed the canvas size ({width}x{height})."
+    )
+
+    rows = np.linspace(0, height, grid_size + 1).astype(np.int64)
+    cols = np.linspace(0, width, grid_size + 1).astype(np.int64)
+
+    occupancy = (binary_images > 0).astype(np.float32)
+    occupancy = np.add.reduceat(occupancy, rows[:-1], axis=1)
+    occupancy = np.add.reduceat(occupancy, cols[:-1], axis=2)
+    occupancy /= np.diff(rows)[:, None] * np.diff(cols)[None, :]
+
+    return occupancy.reshape(num_images, -1)
+
+
+def compute_squared_distances(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """Compute the pairwise squared Euclidean distances between the rows of x and y."""
+    distances = (
+        np.sum(x**2, axis=1)[:, None] - 2 * x @ y.T + np.sum(y**2, axis=1)[None, :]
+    )
+    return np.maximum(distances, 0.0)
+
+
+class ANNBackend(BaseModel, abc.ABC):
+    """Base class for approximate nearest neighbour backends used to shortlist examples.
+
+    A backend indexes a fixed-size descriptor of the saliency map of each example.
+    The selector re-ranks the returned shortlist with the exact IoU.
+    """
+
+    grid_size: int = Field(
+        default=16,
+        description="Number of grid cells along each side of the occupancy descriptor.",
+    )
+    shortlist_size: int = Field(
+        default=256,
+        description="Number of examples re-ranked with the exact IoU. Larger values improve recall at the cost of latency.",
+    )
+
+    def embed(self, binary_images: np.ndarray) -> np.ndarray:
+        """Compute the descriptors of binary images of shape (N, height, width)."""
+        return compute_occupancy_descriptors(binary_images, grid_size=self.grid_size)
+
+    @abc.abstractmethod
+    def add(self, descriptors: np.ndarray) -> None:
+        """Append the descriptors of examples to the index."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def search(self, query_descriptor: np.ndarray, k: int) -> np.ndarray:
+        """Return the indices of (approximately) the k nearest examples."""
+        raise NotImplementedError
+
+
+class IVFBackend(ANNBackend):
+    """Inverted file index with k-means coarse quantization, implemented in NumPy.
+
+    The descriptors are clustered into `num_lists` inverted lists. A query only
+    visits the examples of its `num_probes` nearest lists.
+    """
+
+    num_lists: int = Field(
+        default=64,
+        description="Number of inverted lists (k-means clusters).",
+    )
+    num_probes: int = Field(
+        default=8,
+        description="Number of inverted lists visited per query. Larger values improve recall at the cost of latency.",
+    )
+    num_iterations: int = Field(
+        default=10,
+        description="Number of k-means iterations for training the coarse quantizer.",
+    )
+    seed: int = 0
+
+    _descriptors: np.ndarray = PrivateAttr(
+        default_factory=lambda: np.zeros((0, 0), dtype=np.float32)
+    )
+    _centroids: Optional[np.ndarray] = PrivateAttr(default=None)
+    _assignments: np.ndarray = PrivateAttr(
+        default_factory=lambda: np.zeros((0,), dtype=np.int64)
+    )
+    # Examples sorted by their inverted list, and the offsets of each list
+    _list_order: Optional[np.ndarray] = PrivateAttr(default=None)
+    _list_offsets: Optional[np.ndarray] = PrivateAttr(default=None)
+
+    def __len__(self) -> int:
+        return len(self._descriptors)
+
+    @property
+    def is_trained(self) -> bool:
+        return self._centroids is not None
+
+    def add(self, descriptors: np.ndarray) -> None:
+        descriptors = descriptors.astype(np.float32)
+        self._descriptors = (
+            np.concatenate([self._descriptors, descriptors])
+            if len(self._descriptors) > 0
+            else descriptors
+        )
+
+        if self._centroids is None:
+            return
+
+        # After training, new examples are assigned to their nearest list
+        self._assignments = np.concatenate(
+            [self._assignments, self._assign(descriptors)]
+        )
+        self._list_order = self._list_offsets = None
+
+    def train(self) -> None:
+        """Cluster all the indexed descriptors into the inverted lists with k-means."""
+        assert len(self._descriptors) > 0, "Please add descriptors before training."
+
+        rng = np.random.default_rng(self.seed)
+        num_lists = min(self.num_lists, len(self._descriptors))
+        init_indices = rng.choice(len(self._descriptors), num_lists, replace=False)
+        centroids = self._descriptors[init_indices].copy()
+
+        for _ in range(self.num_iterations):
+            assignments = compute_squared_distances(
+                self._descriptors, centroids
+            ).argmin(axis=1)
+            counts = np.bincount(assignments, minlength=num_lists)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, self._descriptors)
+
+            # Re-seed empty lists with random descriptors
+            is_empty = counts == 0
+            centroids[~is_empty] = sums[~is_empty] / counts[~is_empty, None]
+            centroids[is_empty] = self._descriptors[
+                rng.choice(len(self._descriptors), is_empty.sum())
+            ]
+
+        self._centroids = centroids
+        self._assignments = self._assign(self._descriptors)
+        self._list_order = self._list_offsets = None
+
+    def search(self, query_descriptor: np.ndarray, k: int) -> np.ndarray:
+        if len(self._descriptors) == 0:
+            return np.zeros((0,), dtype=np.int64)
+        if self._centroids is None:
+            self.train()
+        assert self._centroids is not None
+
+        query = query_descriptor.astype(np.float32).reshape(1, -1)
+        num_probes = min(self.num_probes, len(self._centroids))
+        list_distances = compute_squared_distances(query, self._centroids)[0]
+        probed_lists = np.argpartition(list_distances, num_probes - 1)[:num_probes]
+
+        order, offsets = self._get_inverted_lists()
+        candidates = np.concatenate(
+            [order[offsets[i] : offsets[i + 1]] for i in probed_lists]
+        )
+        if len(candidates) <= k:
+            return candidates
+
+        distances = compute_squared_distances(query, self._descriptors[candidates])[0]
+        return candidates[np.argpartition(distances, k - 1)[:k]]
+
+    def _assign(self, descriptors: np.ndarray) -> np.ndarray:
+        assert self._centroids is not None
+        return compute_squared_distances(descriptors, self._centroids).argmin(axis=1)
+
+    def _get_inverted_lists(self) -> Tuple[np.ndarray, np.ndarray]:
+        if self._list_order is None or self._list_offsets is None:
+            assert self._centroids is not None
+            self._list_order = np.argsort(self._assignments, kind="stable")
+            counts = np.bincount(self._assignments, minlength=len(self._centroids))
+            self._list_offsets = np.concatenate([[0], np.cumsum(counts)])
+        return self._list_order, self._list_offsets
@@ -1,17 +1,53 @@
 import abc
+import pathlib
 import random
-from typing import List, Optional, Tuple
+from typing import Any, List, Optional, Sequence, Tuple, Union
 
+import numpy as np
 from langchain_core.example_selectors.base import BaseExampleSelector
 from loguru import logger
-from pydantic import BaseModel, model_validator
+from pydantic import BaseModel, PrivateAttr
 from typing_extensions import Self, override
 
 from layout_prompter.models import ProcessedLayoutData
 
+from .persistence import (
+    INDEX_FORMAT_VERSION,
+    LazyExamples,
+    load_array,
+    load_metadata,
+    save_array,
+    save_examples,
+    save_metadata,
+)
+
+
+def select_top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """Select the indices of the top-k scores by partial selection in O(n).
+
+    The indices are ordered by descending score. As with a stable sort,
+    ties are broken in favor of the smaller index.
+    """
+    k = min(k, len(scores))
+    if k == 0:
+        return np.zeros((0,), dtype=np.int64)
+
+    # Find the k-th largest score by partial selection instead of a full sort
+    kth = len(scores) - k
+    kth_score = scores[np.argpartition(scores, kth)[kth]]
+
+    above = np.flatnonzero(scores > kth_score)
+    ties = np.flatnonzero(scores == kth_score)[: k - len(above)]
+    top_k = np.concatenate([above, ties])
+
+    # Only the selected k scores are sorted
+    return top_k[np.lexsort((top_k, -scores[top_k]))]
+
 
 class LayoutSelectorOutput(BaseModel):
     selected_examples: List[ProcessedLayoutData]
+    # Scores of the selected examples, in the same (possibly shuffled) order
+    selected_scores: Optional[List[float]] = None
 
 
 class LayoutSelector(BaseExampleSelector, BaseModel):
@@ -20,18 +56,49 @@ class LayoutSelector(BaseExampleSelector, BaseModel):
     candidate_size: Optional[int] = None
     is_shuffle: bool = True
 
-    @model_validator(mode="after")
-    def post_int(self) -> Self:
-        if self.candidate_size is None:
-            return self
-
-        logger.debug(
-            f"Selecting {self.candidate_size} candidates from {len(self.examples)} examples."
-        )
-        random.shuffle(self.examples)
-        self.examples = self.examples[: self.candidate_size]
-
-        return self
+    # Number of queries (and candidates, if applicable) scored at once in
+    # `select_examples_batch`, which bounds the memory of the score matrix.
+    batch_block_size: int = 256
+
+    # Whether each example passes `_is_filter`, evaluated once when it is registered.
+    _valid_flags: List[bool] = PrivateAttr(default_factory=list)
+    _valid_mask: Optional[np.ndarray] = PrivateAttr(default=None)
+
+    def model_post_init(self, __context: Any) -> None:
+        # Unlike the "after" model validators, which also run when the selector is
+        # validated as a field of another model, this runs once per instance
+        if self.candidate_size is not None:
+            logger.debug(
+                f"Selecting {self.candidate_size} candidates from {len(self.examples)} examples."
+            )
+            random.shuffle(self.examples)
+            del self.examples[self.candidate_size :]
+
+        self._register_examples(self.examples)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        super().__setattr__(name, value)
+        # The indices of the previous examples no longer apply
+        if name == "examples":
+            self._rebuild_index()
+
+    def _rebuild_index(self) -> None:
+        """Rebuild the indices of all the examples from scratch."""
+        logger.debug(f"Rebuilding the index of {len(self.examples)} examples.")
+        self._reset_index()
+        self._register_examples(self.examples)
+
+    def _reset_index(self) -> None:
+        """Hook called to drop the indices of the registered examples."""
+        self._valid_flags = []
+        self._valid_mask = None
+
+    def _check_index(self) -> None:
+        """Rebuild the indices if `examples` was mutated in place, e.g., appended to
+        directly instead of with `add_example`.
+        """
+        if len(self._valid_flags) != len(self.examples):
+            self._rebuild_index()
 
     @override
     @abc.abstractmethod
@@ -40,12 +107,100 @@ class LayoutSelector(BaseExampleSelector, BaseModel):
     ) -> LayoutSelectorOutput:
         raise NotImplementedError
 
+    def select_examples_batch(
+        self, queries: Sequence[ProcessedLayoutData]
+    ) -> List[LayoutSelectorOutput]:
+        """Select examples for multiple queries, returning one output per query."""
+        return [self.select_examples(query) for query in queries]
+
     @override
     def add_example(  # type: ignore[override]
         self,
         example: ProcessedLayoutData,
     ) -> None:
         self.examples.append(example)
+        self._register_examples([example])
+
+    def _register_examples(self, examples: Sequence[ProcessedLayoutData]) -> None:
+        """Hook called when examples are added to the pool, e.g., to index them once."""
+        self._valid_flags.extend(not self._is_filter(example) for example in examples)
+        self._valid_mask = None
+
+    @property
+    def valid_mask(self) -> np.ndarray:
+        """Boolean vector indicating which examples can be selected."""
+        if self._valid_mask is None:
+            self._valid_mask = np.array(self._valid_flags, dtype=bool)
+        return self._valid_mask
+
+    def save_index(self, path: Union[str, pathlib.Path]) -> None:
+        """Save the examples and their precomputed index to a directory of flat arrays.
+
+        The index can be loaded with `load_index` without re-processing the examples.
+        """
+        directory = pathlib.Path(path)
+        directory.mkdir(parents=True, exist_ok=True)
+
+        vocabulary = save_examples(directory, self.examples)
+        save_array(directory, "valid_mask", self.valid_mask)
+        self._save_index_arrays(directory)
+        save_metadata(
+            directory,
+            {
+                "format_version": INDEX_FORMAT_VERSION,
+                "selector": type(self).__name__,
+                "num_examples": len(self.examples),
+                "labels": vocabulary,
+            },
+        )
+        logger.debug(
+            f"Saved the index of {len(self.examples)} examples to {directory}."
+        )
+
+    @classmethod
+    def load_index(cls, path: Union[str, pathlib.Path], **kwargs: Any) -> Self:
+        """Load a selector from an index saved with `save_index`.
+
+        The arrays are memory-mapped and the examples are only materialized when
+        selected, so that loading does not depend on the number of examples.
+        """
+        if kwargs.get("candidate_size") is not None:
+            raise ValueError(
+                "`candidate_size` is not supported when loading an index. "
+                "Subsample the examples before saving the index instead."
+            )
+
+        directory = pathlib.Path(path)
+        metadata = load_metadata(directory)
+        if metadata.get("selector") != cls.__name__:
+            raise ValueError(
+                f"The index at {directory} was saved by {metadata.get('selector')}, "
+                f"not by {cls.__name__}."
+            )
+
+        selector = cls(examples=[], **kwargs)
+        # The saved indices are restored below instead of being rebuilt on assignment
+        selector.__dict__["examples"] = LazyExamples(
+            directory, vocabulary=metadata["labels"]
+        )
+        if len(selector.examples) != metadata["num_examples"]:
+            raise ValueError(
+                f"The index at {directory} has {len(selector.examples)} examples, "
+                f"but its metadata records {metadata['num_examples']}."
+            )
+
+        valid_mask = load_array(directory, "valid_mask")
+        selector._valid_flags = valid_mask.tolist()
+        selector._valid_mask = valid_mask
+        selector._load_index_arrays(directory)
+
+        return selector
+
+    def _save_index_arrays(self, directory: pathlib.Path) -> None:
+        """Hook called by `save_index` to save the index arrays of the subclass."""
+
+    def _load_index_arrays(self, directory: pathlib.Path) -> None:
+        """Hook called by `load_index` to restore the index arrays of the subclass."""
 
     def _is_filter(self, data: ProcessedLayoutData) -> bool:
         """Filtering function to exclude data with bboxes that have width or height of 0."""
@@ -57,19 +212,20 @@ class LayoutSelector(BaseExampleSelector, BaseModel):
         )
         return num_invalid_bboxes > 0
 
+    def _select_top_k(self, scores: np.ndarray, k: int) -> np.ndarray:
+        """Select the indices of the valid examples with the top-k scores in O(n)."""
+        valid_indices = np.flatnonzero(self.valid_mask)
+        return valid_indices[select_top_k_indices(scores[valid_indices], k=k)]
+
     def _retrieve_examples(
-        self, scores: List[Tuple[int, float]], return_indices: bool = False
+        self, scores: np.ndarray
     ) -> List[Tuple[int, ProcessedLayoutData]]:
-        scores = sorted(scores, key=lambda x: x[1], reverse=True)
         assert len(scores) == len(self.examples)
 
-        candidates: List[Tuple[int, ProcessedLayoutData]] = []
-        for idx, _ in scores:
-            candidate = self.examples[idx]
-            if not self._is_filter(candidate):
-                candidates.append((idx, candidate))
-                if len(candidates) == self.num_prompt:
-                    break
+        candidates: List[Tuple[int, ProcessedLayoutData]] = [
+            (idx, self.examples[idx])
+            for idx in self._select_top_k(scores, k=self.num_prompt).tolist()
+        ]
 
         if self.is_shuffle:
             random.shuffle(candidates)
@@ -1,15 +1,25 @@
-from typing import List, Optional, Sequence, Tuple
+import pathlib
+import random
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable, List, Literal, Optional, Sequence
 
 import cv2
 import numpy as np
 import pydantic_numpy.typing as pnd
 from loguru import logger
-from tqdm.auto import tqdm
-from typing_extensions import override
+from pydantic import PrivateAttr, model_validator
+from typing_extensions import Self, override
 
 from layout_prompter.models import Bbox, CanvasSize, ProcessedLayoutData
+from layout_prompter.utils import get_num_workers
+from layout_prompter.utils.workers import MAX_CONCURRENCY
 
+from .ann import ANNBackend
 from .base import LayoutSelector, LayoutSelectorOutput
+from .persistence import load_array, save_array
+from .saliency_index import ContentBboxIndex, SaliencyMaskIndex
+from .sharding import ShardedMaskScorer
 
 
 class ContentAwareSelectorOutput(LayoutSelectorOutput):
@@ -29,6 +39,48 @@ def calculate_iou(
 class ContentAwareSelector(LayoutSelector):
     return_saliency_maps: bool = False
 
+    # How to compute the IoU between the content of the query and the candidates:
+    # - "mask": compare the rasterized saliency maps (bit-packed for vectorized scoring)
+    # - "analytic": compute the exact IoU of the unions of content bboxes geometrically
+    iou_method: Literal["mask", "analytic"] = "mask"
+
+    # Approximate nearest neighbour backend to shortlist the examples before scoring
+    # them with the exact IoU. If None, all the examples are scored exhaustively.
+    ann_backend: Optional[ANNBackend] = None
+
+    # How to execute the exhaustive mask-based scoring:
+    # - "serial": score all the examples in the current process
+    # - "process": shard the examples across a process pool of up to `max_workers`
+    #   workers, with the masks placed in shared memory
+    execution: Literal["serial", "process"] = "serial"
+    max_workers: int = MAX_CONCURRENCY
+
+    # Maximum number of outputs memoized per query content (LRU). 0 disables the cache.
+    cache_size: int = 128
+
+    # Indices of the examples, built once when they are registered.
+    _saliency_index: Optional[SaliencyMaskIndex] = PrivateAttr(default=None)
+    _content_bbox_index: Optional[ContentBboxIndex] = PrivateAttr(default=None)
+    _sharded_scorer: Optional[ShardedMaskScorer] = PrivateAttr(default=None)
+
+    # Outputs memoized by the content of the query, cleared when examples are added.
+    _output_cache: "OrderedDict[Hashable, ContentAwareSelectorOutput]" = PrivateAttr(
+        default_factory=OrderedDict
+    )
+    _output_cache_lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    _cache_hits: int = PrivateAttr(default=0)
+    _cache_misses: int = PrivateAttr(default=0)
+
+    @model_validator(mode="after")
+    def check_execution(self) -> Self:
+        if self.execution == "process" and (
+            self.iou_method != "mask" or self.ann_backend is not None
+        ):
+            raise ValueError(
+                "The process execution only supports the exhaustive mask-based scoring."
+            )
+        return self
+
     def _to_binary_image(
         self, content_bboxes: Sequence[Bbox], canvas_size: CanvasSize
     ) -> np.ndarray:
@@ -46,57 +98,414 @@ class ContentAwareSelector(LayoutSelector):
             )
         return binary_image
 
+    def _get_content_bboxes(self, data: ProcessedLayoutData) -> Sequence[Bbox]:
+        content_bboxes = data.discrete_content_bboxes
+        assert content_bboxes is not None
+        return content_bboxes
+
+    def _get_saliency_map(self, data: ProcessedLayoutData) -> np.ndarray:
+        return self._to_binary_image(
+            self._get_content_bboxes(data), canvas_size=data.canvas_size
+        )
+
+    def _check_canvas_size(
+        self, data: ProcessedLayoutData, canvas_size: CanvasSize
+    ) -> None:
+        if data.canvas_size != canvas_size:
+            raise ValueError(
+                f"The canvas size of the data ({data.canvas_size}) must match "
+                f"that of the indexed examples ({canvas_size})."
+            )
+
     @override
-    def select_examples(  # type: ignore[override]
-        self,
-        input_variables: ProcessedLayoutData,
-    ) -> ContentAwareSelectorOutput:
-        logger.debug(
-            f"Selecting {self.num_prompt} candidates from {len(self.examples)} examples."
+    def _register_examples(self, examples: Sequence[ProcessedLayoutData]) -> None:
+        super()._register_examples(examples)
+        if len(examples) == 0:
+            return
+
+        # The memoized outputs may no longer be the top-k examples
+        self.clear_cache()
+
+        # The shared memory of the workers no longer reflects the examples
+        self.close()
+
+        canvas_size = examples[0].canvas_size
+        if self.iou_method == "analytic":
+            if self._content_bbox_index is None:
+                self._content_bbox_index = ContentBboxIndex(canvas_size=canvas_size)
+            for example in examples:
+                self._check_canvas_size(example, self._content_bbox_index.canvas_size)
+            self._content_bbox_index.add(
+                [self._get_content_bboxes(example) for example in examples]
+            )
+        elif self._saliency_index is None:
+            self._saliency_index = SaliencyMaskIndex(canvas_size=canvas_size)
+
+        if self.iou_method != "mask" and self.ann_backend is None:
+            return
+
+        # The saliency maps are rasterized `batch_block_size` examples at a time, so
+        # that the memory does not grow with the number of examples
+        for start in range(0, len(examples), self.batch_block_size):
+            saliency_maps = [
+                self._get_saliency_map(example)
+                for example in examples[start : start + self.batch_block_size]
+            ]
+            if self._saliency_index is not None and self.iou_method == "mask":
+                self._saliency_index.add(saliency_maps)
+            if self.ann_backend is not None:
+                self.ann_backend.add(self.ann_backend.embed(np.stack(saliency_maps)))
+
+    @override
+    def _reset_index(self) -> None:
+        super()._reset_index()
+        self.clear_cache()
+        self.close()
+        self._saliency_index = None
+        self._content_bbox_index = None
+        if self.ann_backend is not None:
+            # A fresh backend with the same settings and no indexed examples
+            self.ann_backend = type(self.ann_backend).model_validate(
+                self.ann_backend.model_dump()
+            )
+
+    @override
+    def _save_index_arrays(self, directory: pathlib.Path) -> None:
+        if len(self.examples) == 0:
+            return
+
+        # Both indices are saved, so that the index can be loaded with any `iou_method`
+        canvas_size = self.examples[0].canvas_size
+        saliency_index = self._saliency_index
+        if saliency_index is None:
+            saliency_index = SaliencyMaskIndex(canvas_size=canvas_size)
+            saliency_index.add(
+                [self._get_saliency_map(example) for example in self.examples]
+            )
+        content_bbox_index = self._content_bbox_index
+        if content_bbox_index is None:
+            content_bbox_index = ContentBboxIndex(canvas_size=canvas_size)
+            content_bbox_index.add(
+                [self._get_content_bboxes(example) for example in self.examples]
+            )
+
+        save_array(directory, "saliency_masks", saliency_index.masks)
+        save_array(directory, "saliency_areas", saliency_index.areas)
+        save_array(directory, "content_rects", content_bbox_index.rects)
+        save_array(directory, "content_areas", content_bbox_index.areas)
+
+    @override
+    def _load_index_arrays(self, directory: pathlib.Path) -> None:
+        if len(self.examples) == 0:
+            return
+
+        canvas_size = self.examples[0].canvas_size
+        masks = load_array(directory, "saliency_masks")
+        if self.iou_method == "analytic":
+            self._content_bbox_index = ContentBboxIndex.from_arrays(
+                canvas_size,
+                rects=load_array(directory, "content_rects"),
+                areas=load_array(directory, "content_areas"),
+            )
+        else:
+            self._saliency_index = SaliencyMaskIndex.from_arrays(
+                canvas_size, masks=masks, areas=load_array(directory, "saliency_areas")
+            )
+
+        if self.ann_backend is not None:
+            # The descriptors are computed from the saved masks, without rasterizing
+            num_pixels = canvas_size.width * canvas_size.height
+            for start in range(0, len(masks), self.batch_block_size):
+                binary_images = np.unpackbits(
+                    masks[start : start + self.batch_block_size],
+                    axis=1,
+                    count=num_pixels,
+                ).reshape(-1, canvas_size.height, canvas_size.width)
+                self.ann_backend.add(self.ann_backend.embed(binary_images))
+
+    def _score_examples(
+        self, query: ProcessedLayoutData, indices: Optional[np.ndarray] = None
+    ) -> np.ndarray:
+        """Compute the exact IoU between the content of the query and the examples.
+
+        If `indices` is given, only the examples at these indices are scored.
+        """
+        if self.iou_method == "analytic":
+            if self._content_bbox_index is None:
+                return np.zeros((0,), dtype=np.float64)
+            self._check_canvas_size(query, self._content_bbox_index.canvas_size)
+            return self._content_bbox_index.score(
+                self._get_content_bboxes(query), indices=indices
+            )
+
+        if self._saliency_index is None:
+            return np.zeros((0,), dtype=np.float64)
+        return self._saliency_index.score(
+            self._get_saliency_map(query), indices=indices
         )
 
-        query = input_variables
-        query_content_bboxes = query.discrete_content_bboxes
-        assert query_content_bboxes is not None
-        query_saliency_map = self._to_binary_image(
-            query_content_bboxes, canvas_size=query.canvas_size
+    def _score_shortlist(self, query: ProcessedLayoutData) -> np.ndarray:
+        """Score the examples shortlisted by the ANN backend with the exact IoU.
+
+        The examples out of the shortlist get a score of -inf. If the shortlist has
+        fewer valid examples than are selected, all the examples are scored instead.
+        """
+        assert self.ann_backend is not None
+
+        query_descriptor = self.ann_backend.embed(self._get_saliency_map(query)[None])
+        shortlist = self.ann_backend.search(
+            query_descriptor[0], k=max(self.ann_backend.shortlist_size, self.num_prompt)
         )
 
-        scores: List[Tuple[int, float]] = []
-        candidate_saliency_maps: List[np.ndarray] = []
+        num_valid = int(self.valid_mask.sum())
+        if self.valid_mask[shortlist].sum() < min(self.num_prompt, num_valid):
+            logger.debug(
+                f"The shortlist has fewer than {self.num_prompt} valid examples, "
+                "falling back to the exhaustive scoring."
+            )
+            return self._score_examples(query)
+
+        scores = np.full((len(self.examples),), -np.inf, dtype=np.float64)
+        scores[shortlist] = self._score_examples(query, indices=shortlist)
+        return scores
 
-        it = tqdm(
-            self.examples,
-            desc="Calculating scores for selecting candidate examples",
+    def _get_sharded_scorer(self) -> ShardedMaskScorer:
+        assert self._saliency_index is not None
+        if self._sharded_scorer is None:
+            self._sharded_scorer = ShardedMaskScorer(
+                masks=self._saliency_index.masks,
+                areas=self._saliency_index.areas,
+                valid_mask=self.valid_mask,
+                num_pixels=self._saliency_index.num_pixels,
+                num_workers=get_num_workers(max_concurrency=self.max_workers),
+            )
+        return self._sharded_scorer
+
+    def _score_examples_sharded(
+        self, queries: Sequence[ProcessedLayoutData]
+    ) -> np.ndarray:
+        """Score the queries on the process pool.
+
+        Only the top-k examples of each query are scored and the others get -inf,
+        which is sufficient for `_retrieve_examples`.
+        """
+        scores = np.full((len(queries), len(self.examples)), -np.inf)
+        if self._saliency_index is None:
+            return scores
+
+        top_k_outputs = self._get_sharded_scorer().score_top_k(
+            np.stack(
+                [
+                    self._saliency_index.pack(self._get_saliency_map(query))
+                    for query in queries
+                ]
+            ),
+            k=self.num_prompt,
+            block_size=self.batch_block_size,
         )
-        for idx, candidate in enumerate(it):
-            candidate_content_bboxes = candidate.discrete_content_bboxes
-            assert candidate_content_bboxes is not None
-            candidate_saliency_map = self._to_binary_image(
-                candidate_content_bboxes, canvas_size=candidate.canvas_size
+        for query_scores, (indices, top_k_scores) in zip(scores, top_k_outputs):
+            query_scores[indices] = top_k_scores
+        return scores
+
+    def _compute_scores(self, query: ProcessedLayoutData) -> np.ndarray:
+        if self.ann_backend is not None:
+            return self._score_shortlist(query)
+        if self.execution == "process":
+            return self._score_examples_sharded([query])[0]
+        return self._score_examples(query)
+
+    @property
+    def cache_hits(self) -> int:
+        return self._cache_hits
+
+    @property
+    def cache_misses(self) -> int:
+        return self._cache_misses
+
+    def clear_cache(self) -> None:
+        """Clear the memoized outputs. The hit/miss counters are kept."""
+        with self._output_cache_lock:
+            self._output_cache.clear()
+
+    def _get_cache_key(self, query: ProcessedLayoutData) -> Hashable:
+        """The selection depends on the content bboxes and the canvas size of the query,
+        and on the settings of the selector that change the output.
+        """
+        ann_config = (
+            None
+            if self.ann_backend is None
+            else (
+                type(self.ann_backend).__name__,
+                tuple(sorted(self.ann_backend.model_dump().items())),
             )
-            candidate_saliency_maps.append(candidate_saliency_map)
+        )
+        return (
+            query.canvas_size.width,
+            query.canvas_size.height,
+            tuple(bbox.to_ltwh() for bbox in self._get_content_bboxes(query)),
+            self.num_prompt,
+            self.return_saliency_maps,
+            self.iou_method,
+            ann_config,
+        )
+
+    def _get_cached_output(
+        self, query: ProcessedLayoutData
+    ) -> Optional[ContentAwareSelectorOutput]:
+        if self.cache_size <= 0:
+            return None
+
+        key = self._get_cache_key(query)
+        with self._output_cache_lock:
+            output = self._output_cache.get(key)
+            if output is None:
+                self._cache_misses += 1
+                return None
+
+            self._cache_hits += 1
+            self._output_cache.move_to_end(key)
+        return self._copy_output(output)
+
+    def _set_cached_output(
+        self, query: ProcessedLayoutData, output: ContentAwareSelectorOutput
+    ) -> None:
+        if self.cache_size <= 0:
+            return
+
+        # The cached output must not share its arrays with the returned one
+        key, output = (
+            self._get_cache_key(query),
+            self._copy_output(output, shuffle=False),
+        )
+        with self._output_cache_lock:
+            self._output_cache[key] = output
+            while len(self._output_cache) > self.cache_size:
+                self._output_cache.popitem(last=False)
+
+    def _copy_output(
+        self, output: ContentAwareSelectorOutput, shuffle: bool = True
+    ) -> ContentAwareSelectorOutput:
+        """Copy an output with its saliency maps, re-shuffling the examples as a fresh
+        retrieval would if `shuffle` is True.
+        """
+        order = list(range(len(output.selected_examples)))
+        if shuffle and self.is_shuffle:
+            random.shuffle(order)
+
+        def permute(values: Optional[List[Any]]) -> Optional[List[Any]]:
+            return [values[i] for i in order] if values is not None else None
+
+        candidate_saliency_maps = permute(output.candidate_saliency_maps)
+        return output.model_copy(
+            update={
+                "selected_examples": permute(output.selected_examples),
+                "selected_scores": permute(output.selected_scores),
+                "query_saliency_map": (
+                    output.query_saliency_map.copy()
+                    if output.query_saliency_map is not None
+                    else None
+                ),
+                "candidate_saliency_maps": (
+                    [saliency_map.copy() for saliency_map in candidate_saliency_maps]
+                    if candidate_saliency_maps is not None
+                    else None
+                ),
+            }
+        )
+
+    def close(self) -> None:
+        """Shut down the process pool of the process execution, if any."""
+        if self._sharded_scorer is not None:
+            self._sharded_scorer.close()
+            self._sharded_scorer = None
+
+    def _score_examples_batch(
+        self, queries: Sequence[ProcessedLayoutData]
+    ) -> np.ndarray:
+        """Compute the IoU matrix of shape (num_queries, num_examples)."""
+        if self.execution == "process":
+            return self._score_examples_sharded(queries)
 
-            iou = calculate_iou(
-                query_saliency_map=query_saliency_map,
-                candidate_saliency_map=candidate_saliency_map,
+        if self.iou_method == "mask" and self.ann_backend is None:
+            if self._saliency_index is None:
+                return np.zeros((len(queries), 0), dtype=np.float64)
+            return self._saliency_index.score_batch(
+                [self._get_saliency_map(query) for query in queries],
+                block_size=self.batch_block_size,
             )
-            scores.append((idx, iou))
 
-        candidates = self._retrieve_examples(
-            scores, return_indices=self.return_saliency_maps
+        return np.stack([self._compute_scores(query) for query in queries]).reshape(
+            len(queries), len(self.examples)
         )
+
+    def _build_output(
+        self, query: ProcessedLayoutData, scores: np.ndarray
+    ) -> ContentAwareSelectorOutput:
+        candidates = self._retrieve_examples(scores)
         candidate_indices = [idx for idx, _ in candidates]
         candidate_examples = [example for _, example in candidates]
+        candidate_scores = [float(scores[idx]) for idx in candidate_indices]
+
+        if not self.return_saliency_maps:
+            return ContentAwareSelectorOutput(
+                selected_examples=candidate_examples,
+                selected_scores=candidate_scores,
+            )
 
         return ContentAwareSelectorOutput(
             selected_examples=candidate_examples,
-            query_saliency_map=query_saliency_map
-            if self.return_saliency_maps
-            else None,
+            selected_scores=candidate_scores,
+            query_saliency_map=self._get_saliency_map(query),
             candidate_saliency_maps=[
-                candidate_saliency_maps[idx] for idx in candidate_indices
-            ]
-            if self.return_saliency_maps
-            else None,
+                self._saliency_index.unpack(idx)
+                if self._saliency_index is not None
+                else self._get_saliency_map(self.examples[idx])
+                for idx in candidate_indices
+            ],
         )
+
+    @override
+    def select_examples(  # type: ignore[override]
+        self,
+        input_variables: ProcessedLayoutData,
+    ) -> ContentAwareSelectorOutput:
+        self._check_index()
+        logger.debug(
+            f"Selecting {self.num_prompt} candidates from {len(self.examples)} examples."
+        )
+
+        output = self._get_cached_output(input_variables)
+        if output is not None:
+            return output
+
+        output = self._build_output(
+            input_variables, self._compute_scores(input_variables)
+        )
+        self._set_cached_output(input_variables, output)
+        return output
+
+    @override
+    def select_examples_batch(  # type: ignore[override]
+        self, queries: Sequence[ProcessedLayoutData]
+    ) -> List[ContentAwareSelectorOutput]:
+        self._check_index()
+        logger.debug(
+            f"Selecting {self.num_prompt} candidates from {len(self.examples)} examples "
+            f"for {len(queries)} queries."
+        )
+
+        outputs: List[Optional[ContentAwareSelectorOutput]] = [
+            self._get_cached_output(query) for query in queries
+        ]
+        missed = [i for i, output in enumerate(outputs) if output is None]
+
+        # Only the queries missing from the cache are scored
+        for start in range(0, len(missed), self.batch_block_size):
+            block = missed[start : start + self.batch_block_size]
+            scores = self._score_examples_batch([queries[i] for i in block])
+            for i, query_scores in zip(block, scores):
+                output = self._build_output(queries[i], query_scores)
+                self._set_cached_output(queries[i], output)
+                outputs[i] = output
+
+        return [output for output in outputs if output is not None]
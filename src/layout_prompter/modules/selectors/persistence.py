@@ -0,0 +1,234 @@
+import json
+import pathlib
+from collections.abc import MutableSequence
+from typing import Any, Dict, Final, Iterable, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from layout_prompter.models import Bbox, CanvasSize, NormalizedBbox, ProcessedLayoutData
+
+INDEX_FORMAT_VERSION: Final[int] = 1
+METADATA_FILE_NAME: Final[str] = "metadata.json"
+
+# Bbox fields of `ProcessedLayoutData` stored as flat (num_bboxes, 4) arrays in LTWH
+NORMALIZED_BBOX_FIELDS: Final[Tuple[str, ...]] = (
+    "bboxes",
+    "gold_bboxes",
+    "orig_bboxes",
+    "content_bboxes",
+)
+DISCRETE_BBOX_FIELDS: Final[Tuple[str, ...]] = (
+    "discrete_bboxes",
+    "discrete_gold_bboxes",
+    "discrete_content_bboxes",
+)
+LABEL_FIELDS: Final[Tuple[str, ...]] = (
+    "labels",
+    "orig_labels",
+)
+
+
+def save_array(directory: pathlib.Path, name: str, array: np.ndarray) -> None:
+    np.save(directory / f"{name}.npy", np.ascontiguousarray(array))
+
+
+def load_array(directory: pathlib.Path, name: str) -> np.ndarray:
+    """Load an array as a read-only memory map, so that it is shared via the page cache."""
+    return np.load(directory / f"{name}.npy", mmap_mode="r")
+
+
+def save_metadata(directory: pathlib.Path, metadata: Dict[str, Any]) -> None:
+    with (directory / METADATA_FILE_NAME).open("w") as wf:
+        json.dump(metadata, wf)
+
+
+def load_metadata(directory: pathlib.Path) -> Dict[str, Any]:
+    with (directory / METADATA_FILE_NAME).open("r") as rf:
+        metadata = json.load(rf)
+
+    if metadata.get("format_version") != INDEX_FORMAT_VERSION:
+        raise ValueError(
+            f"Unsupported index format version: {metadata.get('format_version')}. "
+            f"Expected {INDEX_FORMAT_VERSION}."
+        )
+    return metadata
+
+
+def _flatten(
+    sequences: Sequence[Optional[Sequence[Any]]], to_row: Any, num_columns: int, dtype
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Flatten optional sequences into (values, offsets, is_present) arrays."""
+    rows = [to_row(item) for items in sequences if items is not None for item in items]
+    values = np.array(rows, dtype=dtype).reshape(-1, num_columns)
+    lengths = [len(items) if items is not None else 0 for items in sequences]
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    is_present = np.array([items is not None for items in sequences], dtype=bool)
+    return values, offsets, is_present
+
+
+def save_examples(
+    directory: pathlib.Path, examples: Sequence[ProcessedLayoutData]
+) -> List[str]:
+    """Save the examples as flat arrays and return the label vocabulary.
+
+    The encoded images are not stored, as they are not needed for the selection.
+    """
+    save_array(
+        directory,
+        "idx",
+        np.array(
+            [example.idx if example.idx is not None else -1 for example in examples],
+            dtype=np.int64,
+        ),
+    )
+    for name in ("canvas_size", "orig_canvas_size"):
+        save_array(
+            directory,
+            name,
+            np.array(
+                [
+                    (getattr(example, name).width, getattr(example, name).height)
+                    for example in examples
+                ],
+                dtype=np.int64,
+            ).reshape(-1, 2),
+        )
+
+    vocabulary = sorted(
+        {
+            label
+            for example in examples
+            for name in LABEL_FIELDS
+            for label in (getattr(example, name) or [])
+        }
+    )
+    label_ids = {label: i for i, label in enumerate(vocabulary)}
+
+    fields: Iterable[Tuple[str, Any, int, Any]] = (
+        *(
+            (name, lambda bbox: bbox.to_ltwh(), 4, np.float64)
+            for name in NORMALIZED_BBOX_FIELDS
+        ),
+        *(
+            (name, lambda bbox: bbox.to_ltwh(), 4, np.int64)
+            for name in DISCRETE_BBOX_FIELDS
+        ),
+        *(
+            (name, lambda label: (label_ids[label],), 1, np.int64)
+            for name in LABEL_FIELDS
+        ),
+    )
+    for name, to_row, num_columns, dtype in fields:
+        values, offsets, is_present = _flatten(
+            [getattr(example, name) for example in examples],
+            to_row=to_row,
+            num_columns=num_columns,
+            dtype=dtype,
+        )
+        save_array(directory, f"{name}.values", values)
+        save_array(directory, f"{name}.offsets", offsets)
+        save_array(directory, f"{name}.is_present", is_present)
+
+    return vocabulary
+
+
+class LazyExamples(MutableSequence):
+    """Examples backed by memory-mapped flat arrays, materialized on first access.
+
+    Loading is independent of the number of examples, as only the examples that are
+    actually selected are converted into `ProcessedLayoutData`.
+    """
+
+    def __init__(self, directory: pathlib.Path, vocabulary: Sequence[str]) -> None:
+        self.directory = directory
+        self.vocabulary = list(vocabulary)
+
+        self._idx = load_array(directory, "idx")
+        self._canvas_sizes = load_array(directory, "canvas_size")
+        self._orig_canvas_sizes = load_array(directory, "orig_canvas_size")
+        self._fields = {
+            name: (
+                load_array(directory, f"{name}.values"),
+                load_array(directory, f"{name}.offsets"),
+                load_array(directory, f"{name}.is_present"),
+            )
+            for name in (*NORMALIZED_BBOX_FIELDS, *DISCRETE_BBOX_FIELDS, *LABEL_FIELDS)
+        }
+
+        self._num_stored = len(self._idx)
+        self._materialized: Dict[int, ProcessedLayoutData] = {}
+        # Examples inserted after loading are kept in memory
+        self._items: List[Union[int, ProcessedLayoutData]] = list(
+            range(self._num_stored)
+        )
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __getitem__(self, index):  # type: ignore[override]
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        item = self._items[index]
+        if isinstance(item, ProcessedLayoutData):
+            return item
+        if item not in self._materialized:
+            self._materialized[item] = self._materialize(item)
+        return self._materialized[item]
+
+    def __setitem__(self, index, value) -> None:  # type: ignore[override]
+        self._items[index] = value
+
+    def __delitem__(self, index) -> None:  # type: ignore[override]
+        del self._items[index]
+
+    def insert(self, index: int, value: ProcessedLayoutData) -> None:
+        self._items.insert(index, value)
+
+    def _get_field(self, name: str, i: int) -> Optional[np.ndarray]:
+        values, offsets, is_present = self._fields[name]
+        if not is_present[i]:
+            return None
+        return values[offsets[i] : offsets[i + 1]]
+
+    def _materialize(self, i: int) -> ProcessedLayoutData:
+        data: Dict[str, Any] = {
+            "idx": int(self._idx[i]) if self._idx[i] >= 0 else None,
+            "canvas_size": CanvasSize(
+                width=int(self._canvas_sizes[i, 0]),
+                height=int(self._canvas_sizes[i, 1]),
+            ),
+            "orig_canvas_size": CanvasSize(
+                width=int(self._orig_canvas_sizes[i, 0]),
+                height=int(self._orig_canvas_sizes[i, 1]),
+            ),
+            "encoded_image": None,
+        }
+        for name in NORMALIZED_BBOX_FIELDS:
+            rows = self._get_field(name, i)
+            data[name] = (
+                [
+                    NormalizedBbox(left=left, top=top, width=width, height=height)
+                    for left, top, width, height in rows.tolist()
+                ]
+                if rows is not None
+                else None
+            )
+        for name in DISCRETE_BBOX_FIELDS:
+            rows = self._get_field(name, i)
+            data[name] = (
+                [
+                    Bbox(left=left, top=top, width=width, height=height)
+                    for left, top, width, height in rows.tolist()
+                ]
+                if rows is not None
+                else None
+            )
+        for name in LABEL_FIELDS:
+            rows = self._get_field(name, i)
+            data[name] = (
+                [self.vocabulary[label_id] for label_id in rows[:, 0].tolist()]
+                if rows is not None
+                else None
+            )
+        return ProcessedLayoutData(**data)
@@ -0,0 +1,347 @@
+import math
+from typing import Final, Optional, Sequence
+
+import numpy as np
+
+from layout_prompter.models import Bbox, CanvasSize
+from layout_prompter.utils import compute_union_areas
+
+# Number of set bits for every possible byte value.
+# This is used to count the pixels of bit-packed masks without unpacking them.
+POPCOUNT_TABLE: Final[np.ndarray] = (
+    np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1)
+    .sum(axis=1)
+    .astype(np.uint8)
+)
+
+# Number of candidate masks scored at once, to bound the size of the temporary arrays.
+SCORE_CHUNK_SIZE: Final[int] = 4096
+
+# Maximum number of elements of the temporary coverage arrays in analytic scoring.
+MAX_COVERAGE_ELEMENTS: Final[int] = 2**24
+
+
+def count_bits(packed_masks: np.ndarray) -> np.ndarray:
+    """Count the number of set bits along the last axis of bit-packed masks."""
+    return POPCOUNT_TABLE[packed_masks].sum(axis=-1, dtype=np.int64)
+
+
+def iou_from_counts(
+    intersections: np.ndarray, unions: np.ndarray, pixel_value: int = 255
+) -> np.ndarray:
+    """Compute the smoothed IoU from pixel counts.
+
+    The counts are weighted by `pixel_value` so that the score is identical to
+    `calculate_iou`, which sums the 255-valued pixels of the rasterized saliency maps.
+    """
+    return (intersections * pixel_value + 1) / (unions * pixel_value + 1)
+
+
+def score_packed_masks(
+    masks: np.ndarray, areas: np.ndarray, query: np.ndarray
+) -> np.ndarray:
+    """Compute the IoU between a bit-packed query and bit-packed masks."""
+    query_area = count_bits(query)
+
+    scores = np.empty((len(masks),), dtype=np.float64)
+    for start in range(0, len(masks), SCORE_CHUNK_SIZE):
+        end = min(start + SCORE_CHUNK_SIZE, len(masks))
+        intersections = count_bits(masks[start:end] & query)
+        unions = query_area + areas[start:end] - intersections
+        scores[start:end] = iou_from_counts(intersections, unions)
+
+    return scores
+
+
+def score_packed_masks_batch(
+    masks: np.ndarray,
+    areas: np.ndarray,
+    queries: np.ndarray,
+    num_pixels: int,
+    block_size: int,
+) -> np.ndarray:
+    """Compute the IoU matrix of shape (num_queries, num_masks) between bit-packed
+    queries and bit-packed masks.
+
+    The masks are unpacked `block_size` at a time and the intersections of all
+    the queries are counted at once with a matrix product.
+    """
+    query_bits = np.unpackbits(queries, axis=1, count=num_pixels).astype(np.float32)
+    query_areas = count_bits(queries)
+
+    scores = np.empty((len(queries), len(masks)), dtype=np.float64)
+    for start in range(0, len(masks), block_size):
+        end = min(start + block_size, len(masks))
+        mask_bits = np.unpackbits(masks[start:end], axis=1, count=num_pixels)
+        mask_bits = mask_bits.astype(np.float32)
+
+        # The counts are exact in float32 as long as num_pixels < 2**24
+        intersections = (query_bits @ mask_bits.T).astype(np.int64)
+        unions = query_areas[:, None] + areas[None, start:end] - intersections
+        scores[:, start:end] = iou_from_counts(intersections, unions)
+
+    return scores
+
+
+def bboxes_to_pixel_rects(
+    bboxes: Sequence[Bbox], canvas_size: CanvasSize
+) -> np.ndarray:
+    """Convert bboxes to the half-open pixel rectangles they cover on the canvas.
+
+    The right and bottom edges are included and everything is clipped to the canvas,
+    matching the pixels filled by `cv2.rectangle(..., thickness=-1)`.
+    """
+    rects = np.array([bbox.to_ltrb() for bbox in bboxes], dtype=np.int64).reshape(-1, 4)
+    rects[:, 2:] += 1
+    rects[:, 0::2] = np.minimum(rects[:, 0::2], canvas_size.width)
+    rects[:, 1::2] = np.minimum(rects[:, 1::2], canvas_size.height)
+    return rects
+
+
+class SaliencyMaskIndex:
+    """Bit-packed saliency masks of candidate examples that share a canvas size.
+
+    All the masks are stored in a single `(num_masks, num_bytes)` uint8 array, so that
+    a query can be scored against the whole pool in one vectorized pass.
+    """
+
+    def __init__(self, canvas_size: CanvasSize) -> None:
+        self.canvas_size = canvas_size
+        self._masks = np.zeros((0, self.num_bytes), dtype=np.uint8)
+        self._areas = np.zeros((0,), dtype=np.int64)
+        self._size = 0
+
+    @classmethod
+    def from_arrays(
+        cls, canvas_size: CanvasSize, masks: np.ndarray, areas: np.ndarray
+    ) -> "SaliencyMaskIndex":
+        """Wrap existing bit-packed masks and their areas, e.g., memory-mapped ones.
+
+        The arrays are not copied until new masks are added to the index.
+        """
+        index = cls(canvas_size=canvas_size)
+        if masks.shape[1:] != (index.num_bytes,) or len(areas) != len(masks):
+            raise ValueError(
+                f"The masks must be of shape (N, {index.num_bytes}) with N areas, "
+                f"but got {masks.shape} and {areas.shape}."
+            )
+        index._masks, index._areas, index._size = masks, areas, len(masks)
+        return index
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def num_pixels(self) -> int:
+        return self.canvas_size.width * self.canvas_size.height
+
+    @property
+    def num_bytes(self) -> int:
+        return math.ceil(self.num_pixels / 8)
+
+    @property
+    def masks(self) -> np.ndarray:
+        """Bit-packed masks of shape (num_masks, num_bytes)."""
+        return self._masks[: self._size]
+
+    @property
+    def areas(self) -> np.ndarray:
+        """Number of salient pixels of each mask."""
+        return self._areas[: self._size]
+
+    def pack(self, binary_image: np.ndarray) -> np.ndarray:
+        """Pack a binary image of the canvas size into a flat bit array."""
+        expected_shape = (self.canvas_size.height, self.canvas_size.width)
+        if binary_image.shape != expected_shape:
+            raise ValueError(
+                f"The binary image must be of shape {expected_shape}, "
+                f"but got {binary_image.shape}."
+            )
+        return np.packbits(binary_image.reshape(-1) > 0)
+
+    def unpack(self, idx: int, pixel_value: int = 255) -> np.ndarray:
+        """Restore the binary image of the mask at `idx`."""
+        bits = np.unpackbits(self.masks[idx], count=self.num_pixels)
+        binary_image = bits.reshape(self.canvas_size.height, self.canvas_size.width)
+        return binary_image * np.uint8(pixel_value)
+
+    def add(self, binary_images: Sequence[np.ndarray]) -> None:
+        """Append the masks of the given binary images to the index."""
+        if len(binary_images) == 0:
+            return
+
+        packed = np.stack([self.pack(binary_image) for binary_image in binary_images])
+        self._reserve(self._size + len(packed))
+
+        start, end = self._size, self._size + len(packed)
+        self._masks[start:end] = packed
+        self._areas[start:end] = count_bits(packed)
+        self._size = end
+
+    def score(
+        self, query_image: np.ndarray, indices: Optional[np.ndarray] = None
+    ) -> np.ndarray:
+        """Compute the IoU between the query image and the masks in the index.
+
+        If `indices` is given, only the masks at these indices are scored.
+        """
+        masks, areas = (
+            (self.masks, self.areas)
+            if indices is None
+            else (self.masks[indices], self.areas[indices])
+        )
+        return score_packed_masks(masks, areas, query=self.pack(query_image))
+
+    def score_batch(
+        self, query_images: Sequence[np.ndarray], block_size: int
+    ) -> np.ndarray:
+        """Compute the IoU matrix of shape (num_queries, num_masks) between the
+        query images and every mask in the index, `block_size` masks at a time.
+        """
+        return score_packed_masks_batch(
+            self.masks,
+            self.areas,
+            queries=np.stack([self.pack(query_image) for query_image in query_images]),
+            num_pixels=self.num_pixels,
+            block_size=block_size,
+        )
+
+    def _reserve(self, capacity: int) -> None:
+        """Grow the underlying buffers geometrically to hold at least `capacity` masks."""
+        if capacity <= len(self._masks):
+            return
+
+        new_capacity = max(capacity, 2 * len(self._masks))
+        masks = np.zeros((new_capacity, self.num_bytes), dtype=np.uint8)
+        areas = np.zeros((new_capacity,), dtype=np.int64)
+        masks[: self._size] = self.masks
+        areas[: self._size] = self.areas
+        self._masks, self._areas = masks, areas
+
+
+class ContentBboxIndex:
+    """Content bboxes of candidate examples for exact geometric IoU scoring.
+
+    The pixel rectangles of every candidate are stored zero-padded in a single
+    `(num_candidates, max_num_rects, 4)` array. The IoU between unions of rectangles
+    is computed analytically, without rasterizing any image.
+    """
+
+    def __init__(self, canvas_size: CanvasSize) -> None:
+        self.canvas_size = canvas_size
+        self._rects = np.zeros((0, 0, 4), dtype=np.int64)
+        self._areas = np.zeros((0,), dtype=np.int64)
+        self._size = 0
+
+    @classmethod
+    def from_arrays(
+        cls, canvas_size: CanvasSize, rects: np.ndarray, areas: np.ndarray
+    ) -> "ContentBboxIndex":
+        """Wrap existing padded rectangles and their union areas, e.g., memory-mapped ones.
+
+        The arrays are not copied until new candidates are added to the index.
+        """
+        if rects.ndim != 3 or rects.shape[2] != 4 or len(areas) != len(rects):
+            raise ValueError(
+                f"The rectangles must be of shape (N, K, 4) with N areas, "
+                f"but got {rects.shape} and {areas.shape}."
+            )
+        index = cls(canvas_size=canvas_size)
+        index._rects, index._areas, index._size = rects, areas, len(rects)
+        return index
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def rects(self) -> np.ndarray:
+        """Zero-padded pixel rectangles of shape (num_candidates, max_num_rects, 4)."""
+        return self._rects[: self._size]
+
+    @property
+    def areas(self) -> np.ndarray:
+        """Area of the union of the rectangles of each candidate."""
+        return self._areas[: self._size]
+
+    def to_rects(self, bboxes: Sequence[Bbox]) -> np.ndarray:
+        return bboxes_to_pixel_rects(bboxes, canvas_size=self.canvas_size)
+
+    def add(self, bboxes_list: Sequence[Sequence[Bbox]]) -> None:
+        """Append the content bboxes of candidates to the index."""
+        if len(bboxes_list) == 0:
+            return
+
+        rects_list = [self.to_rects(bboxes) for bboxes in bboxes_list]
+        max_num_rects = max(
+            [self._rects.shape[1]] + [len(rects) for rects in rects_list]
+        )
+
+        padded = np.zeros((len(rects_list), max_num_rects, 4), dtype=np.int64)
+        for i, rects in enumerate(rects_list):
+            padded[i, : len(rects)] = rects
+
+        self._reserve(self._size + len(padded), max_num_rects)
+
+        start, end = self._size, self._size + len(padded)
+        self._rects[start:end] = padded
+        self._areas[start:end] = compute_union_areas(padded)
+        self._size = end
+
+    def score(
+        self, query_bboxes: Sequence[Bbox], indices: Optional[np.ndarray] = None
+    ) -> np.ndarray:
+        """Compute the IoU between the query bboxes and the bboxes of the candidates.
+
+        If `indices` is given, only the candidates at these indices are scored.
+        """
+        query_rects = self.to_rects(query_bboxes)
+        query_area = compute_union_areas(query_rects)
+
+        rects, areas = (
+            (self.rects, self.areas)
+            if indices is None
+            else (self.rects[indices], self.areas[indices])
+        )
+
+        num_rects = len(query_rects) + rects.shape[1]
+        if num_rects == 0:
+            # Both saliency maps are empty, as in the smoothed IoU of the masks
+            return iou_from_counts(np.zeros(len(rects)), np.zeros(len(rects)))
+        chunk_size = max(1, MAX_COVERAGE_ELEMENTS // (num_rects * (2 * num_rects) ** 2))
+
+        scores = np.empty((len(rects),), dtype=np.float64)
+        for start in range(0, len(rects), chunk_size):
+            end = min(start + chunk_size, len(rects))
+            candidate_rects = rects[start:end]
+            pair_rects = np.concatenate(
+                [
+                    np.broadcast_to(
+                        query_rects, (len(candidate_rects), *query_rects.shape)
+                    ),
+                    candidate_rects,
+                ],
+                axis=1,
+            )
+            unions = compute_union_areas(pair_rects)
+            intersections = query_area + areas[start:end] - unions
+            scores[start:end] = iou_from_counts(intersections, unions)
+
+        return scores
+
+    def _reserve(self, capacity: int, num_rects: int) -> None:
+        """Grow the underlying buffers geometrically to hold at least `capacity`
+        candidates of up to `num_rects` rectangles.
+        """
+        if capacity <= len(self._rects) and num_rects <= self._rects.shape[1]:
+            return
+
+        new_capacity = (
+            max(capacity, 2 * len(self._rects))
+            if capacity > len(self._rects)
+            else len(self._rects)
+        )
+        rects = np.zeros((new_capacity, num_rects, 4), dtype=np.int64)
+        areas = np.zeros((new_capacity,), dtype=np.int64)
+        rects[: self._size, : self._rects.shape[1]] = self.rects
+        areas[: self._size] = self.areas
+        self._rects, self._areas = rects, areas
@@ -0,0 +1,162 @@
+import itertools
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from .base import select_top_k_indices
+from .saliency_index import score_packed_masks, score_packed_masks_batch
+
+
+@dataclass(frozen=True)
+class SharedArraySpec:
+    """Specification to attach to a NumPy array placed in shared memory."""
+
+    name: str
+    shape: Tuple[int, ...]
+    dtype: str
+
+
+def share_array(array: np.ndarray) -> Tuple[SharedMemory, SharedArraySpec]:
+    """Copy an array into a new shared memory block."""
+    shm = SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+    shared[...] = array
+    return shm, SharedArraySpec(name=shm.name, shape=array.shape, dtype=array.dtype.str)
+
+
+def attach_array(spec: SharedArraySpec) -> Tuple[SharedMemory, np.ndarray]:
+    """Attach to an array placed in shared memory without copying it."""
+    shm = SharedMemory(name=spec.name)
+    return shm, np.ndarray(spec.shape, dtype=np.dtype(spec.dtype), buffer=shm.buf)
+
+
+# The arrays attached by each worker process in `_init_worker`
+_worker_shms: List[SharedMemory] = []
+_worker_arrays: Dict[str, np.ndarray] = {}
+
+
+def _init_worker(specs: Dict[str, SharedArraySpec]) -> None:
+    for key, spec in specs.items():
+        shm, array = attach_array(spec)
+        _worker_shms.append(shm)
+        _worker_arrays[key] = array
+
+
+def _score_shard(
+    queries: np.ndarray,
+    start: int,
+    end: int,
+    k: int,
+    num_pixels: int,
+    block_size: int,
+) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """Score the queries against a shard and return the top-k (indices, scores) of each."""
+    masks = _worker_arrays["masks"][start:end]
+    areas = _worker_arrays["areas"][start:end]
+    valid_indices = np.flatnonzero(_worker_arrays["valid_mask"][start:end])
+
+    scores = (
+        score_packed_masks_batch(
+            masks, areas, queries, num_pixels=num_pixels, block_size=block_size
+        )
+        if len(queries) > 1
+        else score_packed_masks(masks, areas, query=queries[0])[None]
+    )
+
+    outputs = []
+    for query_scores in scores:
+        valid_scores = query_scores[valid_indices]
+        top_k = select_top_k_indices(valid_scores, k=k)
+        outputs.append((valid_indices[top_k] + start, valid_scores[top_k]))
+    return outputs
+
+
+def _release(executor: ProcessPoolExecutor, shms: List[SharedMemory]) -> None:
+    executor.shutdown(wait=True, cancel_futures=True)
+    for shm in shms:
+        shm.close()
+        shm.unlink()
+
+
+class ShardedMaskScorer:
+    """Score queries against bit-packed masks sharded across a process pool.
+
+    The masks are placed in shared memory once, so the workers do not receive the
+    pool of examples with every query. Each worker returns the top-k examples of its
+    shard, which are merged in the main process.
+    """
+
+    def __init__(
+        self,
+        masks: np.ndarray,
+        areas: np.ndarray,
+        valid_mask: np.ndarray,
+        num_pixels: int,
+        num_workers: int,
+    ) -> None:
+        self.num_examples = len(masks)
+        self.num_pixels = num_pixels
+
+        shms, specs = [], {}
+        for key, array in (
+            ("masks", masks),
+            ("areas", areas),
+            ("valid_mask", valid_mask),
+        ):
+            shm, spec = share_array(np.ascontiguousarray(array))
+            shms.append(shm)
+            specs[key] = spec
+
+        # Split the examples into contiguous shards, one per worker
+        boundaries = np.linspace(0, self.num_examples, num_workers + 1).astype(int)
+        self.shards = [
+            (start, end)
+            for start, end in itertools.pairwise(boundaries.tolist())
+            if start < end
+        ]
+
+        self._executor = ProcessPoolExecutor(
+            max_workers=num_workers,
+            initializer=_init_worker,
+            initargs=(specs,),
+        )
+        self._finalizer = weakref.finalize(self, _release, self._executor, shms)
+
+    def close(self) -> None:
+        """Shut down the process pool and release the shared memory."""
+        self._finalizer()
+
+    def score_top_k(
+        self, queries: np.ndarray, k: int, block_size: int
+    ) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """Return the top-k (indices, scores) among the valid examples for each query."""
+        futures = [
+            self._executor.submit(
+                _score_shard,
+                queries,
+                start,
+                end,
+                k,
+                self.num_pixels,
+                block_size,
+            )
+            for start, end in self.shards
+        ]
+        shard_outputs = [future.result() for future in futures]
+
+        outputs = []
+        for i in range(len(queries)):
+            indices = np.concatenate(
+                [shard_output[i][0] for shard_output in shard_outputs]
+            )
+            scores = np.concatenate(
+                [shard_output[i][1] for shard_output in shard_outputs]
+            )
+            # The shards are in index order, so ties are still broken by the smaller index
+            top_k = select_top_k_indices(scores, k=k)
+            outputs.append((indices[top_k], scores[top_k]))
+        return outputs
@@ -1,5 +1,6 @@
 from .base import LayoutSerializer, LayoutSerializerConfig, LayoutSerializerInput
 from .content_aware_serializer import ContentAwareSerializer
+from .formats import SerializationFormat, parse_layout, serialize_layout
 from .gen_type_serializer import GenTypeSerializer
 
 __all__ = [
@@ -8,4 +9,7 @@ __all__ = [
     "LayoutSerializerInput",
     "GenTypeSerializer",
     "ContentAwareSerializer",
+    "SerializationFormat",
+    "serialize_layout",
+    "parse_layout",
 ]
@@ -1,16 +1,29 @@
 import abc
-import json
-from typing import Any, Final, List, Optional, Type
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Final, Hashable, List, Literal, Optional, Tuple, Type
 
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
+from langchain_core.prompt_values import ChatPromptValue
+from langchain_core.prompts import (
+    ChatPromptTemplate,
+    HumanMessagePromptTemplate,
+    MessagesPlaceholder,
+    SystemMessagePromptTemplate,
+)
 from langchain_core.runnables import RunnableSerializable
 from langchain_core.runnables.config import RunnableConfig
-from pydantic import BaseModel, Field
+from loguru import logger
+from pydantic import BaseModel, Field, PrivateAttr
 
 from layout_prompter.models import (
     LayoutSerializedData,
     ProcessedLayoutData,
 )
-from layout_prompter.utils import Configuration
+from layout_prompter.utils import Configuration, estimate_num_tokens
+from layout_prompter.utils.tokens import TOKENS_PER_MESSAGE
+
+from .formats import SerializationFormat, serialize_layout
 
 SYSTEM_PROMPT: Final[str] = """\
 Please generate a layout based on the given information. You need to ensure that the generated layout looks realistic, with elements well aligned and avoiding unnecessary overlap.
@@ -25,13 +38,43 @@ Please generate a layout based on the given information. You need to ensure that
 ## Canvas Size
 {canvas_width}px x {canvas_height}px"""
 
+# System prompt without the query-dependent canvas size, for the prefix-cache ordering
+PREFIX_CACHE_SYSTEM_PROMPT: Final[str] = """\
+Please generate a layout based on the given information. You need to ensure that the generated layout looks realistic, with elements well aligned and avoiding unnecessary overlap.
+
+# Preamble
+## Task Description
+{task_description}
+
+## Layout Domain
+{layout_domain} layout"""
+
+# Prepended to the query constraints in the prefix-cache ordering
+QUERY_CANVAS_SIZE: Final[str] = """\
+# Canvas Size
+{canvas_width}px x {canvas_height}px
+
+"""
+
+SERIALIZED_LAYOUT: Final[str] = """\
+{serialized_layout}"""
+
 UNK_TOKEN: Final[str] = "<unk>"
 
+# Name of the placeholder of the few-shot example messages in the prompt template
+FEW_SHOT_EXAMPLES_KEY: Final[str] = "few_shot_examples"
+
 
 class LayoutSerializerConfig(Configuration):
     """Base class for all layout serializers."""
 
     input_schema: Type[LayoutSerializedData]
+    serialization_format: SerializationFormat = "json"
+
+    # Approximate token budget of the whole prompt. When set, the highest-scoring
+    # candidates are greedily packed as few-shot examples while the prompt fits,
+    # so `num_prompt` of the selector becomes the maximum number of examples.
+    token_budget: Optional[int] = None
 
 
 class LayoutSerializerInput(BaseModel):
@@ -39,6 +82,10 @@ class LayoutSerializerInput(BaseModel):
 
     query: ProcessedLayoutData
     candidates: List[ProcessedLayoutData]
+    # Scores of the candidates from the selector, used to prioritize them when packing
+    # the few-shot examples into a token budget. The candidates are assumed to be in
+    # descending order of relevance if not given.
+    candidate_scores: Optional[List[float]] = None
 
 
 class LayoutSerializer(RunnableSerializable):
@@ -61,6 +108,50 @@ class LayoutSerializer(RunnableSerializable):
     add_sep_token: bool = True
     add_unk_token: bool = False
 
+    # How to build the prompt messages:
+    # - "template": format the LangChain prompt templates
+    # - "direct": build the messages directly with `str.format`, which skips the
+    #   template machinery and renders identical messages
+    render_mode: Literal["template", "direct"] = "template"
+
+    # Order of the contents of the prompt:
+    # - "default": the system message with the canvas size, then the candidates in
+    #   the given (possibly shuffled) order
+    # - "prefix_cache": the query-independent contents first, so that providers with
+    #   prompt caching can reuse the leading tokens across queries. The canvas size
+    #   moves to the query message and the examples are ordered canonically, so that
+    #   the same examples always render the same prompt.
+    prompt_ordering: Literal["default", "prefix_cache"] = "default"
+    prefix_system_prompt: str = Field(
+        description="System prompt without query-dependent variables, used by the prefix-cache ordering.",
+        default=PREFIX_CACHE_SYSTEM_PROMPT,
+    )
+    example_frequencies: Optional[Dict[int, int]] = Field(
+        description=(
+            "Frozen selection frequency of the examples by their `idx`, e.g., counted "
+            "over the selections of a validation set. In the prefix-cache ordering, "
+            "the most frequent examples come first so that more prompts share them."
+        ),
+        default=None,
+    )
+
+    # Maximum number of few-shot examples whose serialized fragments are cached (LRU).
+    # 0 disables the cache.
+    fragment_cache_size: int = 4096
+
+    # The parsed prompt templates, keyed by the template strings they were parsed from,
+    # so that changing e.g. `system_prompt` or `prompt_ordering` parses them again
+    _prompt_templates: Optional[
+        Tuple[Tuple[str, ...], ChatPromptTemplate, ChatPromptTemplate]
+    ] = PrivateAttr(default=None)
+
+    # Serialized (and escaped) fragments of the few-shot examples, which are selected
+    # over and over from the same pool of candidates
+    _fragment_cache: "OrderedDict[Hashable, Dict[str, str]]" = PrivateAttr(
+        default_factory=OrderedDict
+    )
+    _fragment_cache_lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
     def _convert_to_double_bracket(self, s: str) -> str:
         """Convert a string to double bracket format.
 
@@ -76,6 +167,7 @@ class LayoutSerializer(RunnableSerializable):
         self,
         data: ProcessedLayoutData,
         schema: Type[LayoutSerializedData],
+        serialization_format: SerializationFormat = "json",
     ) -> str:
         assert data.labels is not None and data.discrete_bboxes is not None
 
@@ -85,7 +177,297 @@ class LayoutSerializer(RunnableSerializable):
             schema(class_name=class_name, bbox=bbox)
             for class_name, bbox in zip(labels, discrete_gold_bboxes)
         ]
-        return json.dumps([d.model_dump() for d in serialized_data_list])
+        return serialize_layout(
+            serialized_data_list, serialization_format=serialization_format
+        )
+
+    @abc.abstractmethod
+    def _get_constraint_template(self) -> str:
+        """Return the template of the constraints of a layout (query or example)."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def _get_constraint_variables(self, data: ProcessedLayoutData) -> Dict[str, str]:
+        """Return the variables of the constraint template for a layout."""
+        raise NotImplementedError
+
+    def _get_fragment_cache_key(
+        self,
+        data: ProcessedLayoutData,
+        schema: Type[LayoutSerializedData],
+        serialization_format: SerializationFormat = "json",
+    ) -> Hashable:
+        """Key the fragments by the content of the layout rather than by its `idx`,
+        which is not unique across datasets and splits.
+        """
+        return (
+            schema,
+            serialization_format,
+            tuple(data.labels or ()),
+            tuple(bbox.to_ltwh() for bbox in data.discrete_bboxes or ()),
+            tuple(bbox.to_ltwh() for bbox in data.discrete_content_bboxes or ()),
+            data.canvas_size.width,
+            data.canvas_size.height,
+        )
+
+    def _get_example_variables(
+        self,
+        data: ProcessedLayoutData,
+        schema: Type[LayoutSerializedData],
+        serialization_format: SerializationFormat = "json",
+    ) -> Dict[str, str]:
+        """Return the variables of the example template for a few-shot example."""
+        if self.fragment_cache_size <= 0:
+            return {
+                **self._get_constraint_variables(data),
+                "serialized_layout": self._get_serialized_layout(
+                    data, schema=schema, serialization_format=serialization_format
+                ),
+            }
+
+        key = self._get_fragment_cache_key(data, schema, serialization_format)
+        with self._fragment_cache_lock:
+            variables = self._fragment_cache.get(key)
+            if variables is not None:
+                self._fragment_cache.move_to_end(key)
+                return variables
+
+        variables = {
+            **self._get_constraint_variables(data),
+            "serialized_layout": self._get_serialized_layout(
+                data, schema=schema, serialization_format=serialization_format
+            ),
+        }
+        with self._fragment_cache_lock:
+            self._fragment_cache[key] = variables
+            while len(self._fragment_cache) > self.fragment_cache_size:
+                self._fragment_cache.popitem(last=False)
+        return variables
+
+    def _get_system_template(self) -> str:
+        if self.prompt_ordering == "prefix_cache":
+            return self.prefix_system_prompt
+        return self.system_prompt
+
+    def _get_query_template(self) -> str:
+        if self.prompt_ordering == "prefix_cache":
+            return QUERY_CANVAS_SIZE + self._get_constraint_template()
+        return self._get_constraint_template()
+
+    def _get_prompt_templates(self) -> Tuple[ChatPromptTemplate, ChatPromptTemplate]:
+        """Return the templates of a few-shot example and of the whole prompt."""
+        constraint_template = self._get_constraint_template()
+        system_template = self._get_system_template()
+        query_template = self._get_query_template()
+        key = (constraint_template, system_template, query_template)
+
+        # Read once, as the cache may be replaced by another thread
+        cached = self._prompt_templates
+        if cached is not None and cached[0] == key:
+            return cached[1], cached[2]
+
+        example_prompt = ChatPromptTemplate.from_messages(
+            [
+                ("human", constraint_template),
+                ("ai", SERIALIZED_LAYOUT),
+            ]
+        )
+        # The few-shot examples are formatted with `example_prompt` and inserted
+        # as messages, as `FewShotChatMessagePromptTemplate` does
+        prompt = ChatPromptTemplate.from_messages(
+            [
+                SystemMessagePromptTemplate.from_template(template=system_template),
+                MessagesPlaceholder(variable_name=FEW_SHOT_EXAMPLES_KEY),
+                HumanMessagePromptTemplate.from_template(template=query_template),
+            ]
+        )
+        self._prompt_templates = (key, example_prompt, prompt)
+        return example_prompt, prompt
+
+    def _get_prompt_variables(self, query: ProcessedLayoutData) -> Dict[str, Any]:
+        """Return the variables of the system and query templates."""
+        return {
+            "canvas_width": query.canvas_size.width,
+            "canvas_height": query.canvas_size.height,
+            "task_description": self.task_type,
+            "layout_domain": self.layout_domain,
+            **self._get_constraint_variables(query),
+        }
+
+    def _pack_candidates(
+        self,
+        input: LayoutSerializerInput,
+        schema: Type[LayoutSerializedData],
+        token_budget: int,
+        serialization_format: SerializationFormat = "json",
+    ) -> List[ProcessedLayoutData]:
+        """Greedily pack the highest-scoring candidates whose examples fit in the budget.
+
+        The packed candidates keep their order in `input.candidates`.
+        """
+        constraint_template = self._get_constraint_template()
+        prompt_variables = self._get_prompt_variables(input.query)
+
+        # The system message and the query are always part of the prompt
+        num_tokens = (
+            2 * TOKENS_PER_MESSAGE
+            + estimate_num_tokens(
+                self._get_system_template().format(**prompt_variables)
+            )
+            + estimate_num_tokens(self._get_query_template().format(**prompt_variables))
+        )
+
+        candidates = input.candidates
+        scores = input.candidate_scores
+        assert scores is None or len(scores) == len(candidates)
+        # A stable sort, so that ties and missing scores keep the order of the candidates
+        ranks = (
+            sorted(range(len(candidates)), key=lambda i: -scores[i])
+            if scores is not None
+            else range(len(candidates))
+        )
+
+        is_packed = [False] * len(candidates)
+        for i in ranks:
+            variables = self._get_example_variables(
+                candidates[i], schema=schema, serialization_format=serialization_format
+            )
+            num_example_tokens = (
+                2 * TOKENS_PER_MESSAGE
+                + estimate_num_tokens(constraint_template.format(**variables))
+                + estimate_num_tokens(SERIALIZED_LAYOUT.format(**variables))
+            )
+            # Candidates that do not fit are skipped, as a shorter one may still fit
+            if num_tokens + num_example_tokens <= token_budget:
+                num_tokens += num_example_tokens
+                is_packed[i] = True
+
+        packed = [candidates[i] for i in range(len(candidates)) if is_packed[i]]
+        if len(packed) < len(candidates):
+            logger.debug(
+                f"Packed {len(packed)} of {len(candidates)} candidates into "
+                f"~{num_tokens} tokens (budget: {token_budget})."
+            )
+        return packed
+
+    def _get_candidates(
+        self, input: LayoutSerializerInput, conf: LayoutSerializerConfig
+    ) -> List[ProcessedLayoutData]:
+        """Return the candidates to use as few-shot examples under the configuration."""
+        if conf.token_budget is None:
+            return input.candidates
+        return self._pack_candidates(
+            input,
+            schema=conf.input_schema,
+            token_budget=conf.token_budget,
+            serialization_format=conf.serialization_format,
+        )
+
+    def _order_candidates(
+        self,
+        candidates: List[ProcessedLayoutData],
+        schema: Type[LayoutSerializedData],
+        serialization_format: SerializationFormat = "json",
+    ) -> List[ProcessedLayoutData]:
+        """Order the candidates canonically, independent of the selection order.
+
+        The order depends only on the candidates themselves and the frozen
+        `example_frequencies`, so that the same candidates always render the same
+        prompt, across requests and processes. The more frequent examples come first,
+        and ties are broken by the serialized example.
+        """
+        frequencies = self.example_frequencies or {}
+
+        def get_frequency(candidate: ProcessedLayoutData) -> int:
+            return frequencies.get(candidate.idx, 0) if candidate.idx is not None else 0
+
+        return sorted(
+            candidates,
+            key=lambda candidate: (
+                -get_frequency(candidate),
+                sorted(
+                    self._get_example_variables(
+                        candidate,
+                        schema=schema,
+                        serialization_format=serialization_format,
+                    ).items()
+                ),
+            ),
+        )
+
+    def _format_prompt(
+        self,
+        query: ProcessedLayoutData,
+        candidates: List[ProcessedLayoutData],
+        schema: Type[LayoutSerializedData],
+        serialization_format: SerializationFormat = "json",
+    ) -> ChatPromptValue:
+        """Format the few-shot prompt of the query with the candidates as examples."""
+        if self.prompt_ordering == "prefix_cache":
+            candidates = self._order_candidates(
+                candidates, schema=schema, serialization_format=serialization_format
+            )
+
+        if self.render_mode == "direct":
+            return self._render_prompt(
+                query,
+                candidates,
+                schema=schema,
+                serialization_format=serialization_format,
+            )
+
+        example_prompt, prompt = self._get_prompt_templates()
+
+        few_shot_messages = [
+            message
+            for candidate in candidates
+            for message in example_prompt.format_messages(
+                **self._get_example_variables(
+                    candidate,
+                    schema=schema,
+                    serialization_format=serialization_format,
+                )
+            )
+        ]
+        final_prompt = prompt.format_prompt(
+            **{FEW_SHOT_EXAMPLES_KEY: few_shot_messages},
+            **self._get_prompt_variables(query),
+        )
+        assert isinstance(final_prompt, ChatPromptValue)
+        return final_prompt
+
+    def _render_prompt(
+        self,
+        query: ProcessedLayoutData,
+        candidates: List[ProcessedLayoutData],
+        schema: Type[LayoutSerializedData],
+        serialization_format: SerializationFormat = "json",
+    ) -> ChatPromptValue:
+        """Build the messages of the prompt directly, without the LangChain templates.
+
+        The templates only substitute the variables, so `str.format` on the same
+        template strings renders identical messages.
+        """
+        constraint_template = self._get_constraint_template()
+        prompt_variables = self._get_prompt_variables(query)
+
+        messages: List[BaseMessage] = [
+            SystemMessage(
+                content=self._get_system_template().format(**prompt_variables)
+            )
+        ]
+        for candidate in candidates:
+            variables = self._get_example_variables(
+                candidate, schema=schema, serialization_format=serialization_format
+            )
+            messages.append(
+                HumanMessage(content=constraint_template.format(**variables))
+            )
+            messages.append(AIMessage(content=SERIALIZED_LAYOUT.format(**variables)))
+        messages.append(
+            HumanMessage(content=self._get_query_template().format(**prompt_variables))
+        )
+        return ChatPromptValue(messages=messages)
 
     @abc.abstractmethod
     def invoke(
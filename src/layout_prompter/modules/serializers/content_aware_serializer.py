@@ -1,13 +1,7 @@
 import json
-from typing import Any, Final, Optional
+from typing import Any, Dict, Final, Optional
 
 from langchain_core.prompt_values import ChatPromptValue
-from langchain_core.prompts import (
-    ChatPromptTemplate,
-    FewShotChatMessagePromptTemplate,
-    HumanMessagePromptTemplate,
-    SystemMessagePromptTemplate,
-)
 from langchain_core.runnables.config import RunnableConfig
 from loguru import logger
 
@@ -15,7 +9,11 @@ from layout_prompter.models import (
     ProcessedLayoutData,
 )
 
-from .base import LayoutSerializer, LayoutSerializerConfig, LayoutSerializerInput
+from .base import (
+    LayoutSerializer,
+    LayoutSerializerConfig,
+    LayoutSerializerInput,
+)
 
 CONTENT_AWARE_CONSTRAINT: Final[str] = """\
 # Constraints
@@ -27,9 +25,6 @@ CONTENT_AWARE_CONSTRAINT: Final[str] = """\
 
 # Serialized Layout"""
 
-SERIALIZED_LAYOUT: Final[str] = """\
-{serialized_layout}"""
-
 
 class ContentAwareSerializer(LayoutSerializer):
     task_type: str = (
@@ -52,6 +47,15 @@ class ContentAwareSerializer(LayoutSerializer):
         )
         return self._convert_to_double_bracket(type_constraint)
 
+    def _get_constraint_template(self) -> str:
+        return CONTENT_AWARE_CONSTRAINT
+
+    def _get_constraint_variables(self, data: ProcessedLayoutData) -> Dict[str, str]:
+        return {
+            "content_constraint": self._get_content_constraint(data),
+            "type_constraint": self._get_type_constraint(data),
+        }
+
     def invoke(
         self,
         input: LayoutSerializerInput,
@@ -62,57 +66,11 @@ class ContentAwareSerializer(LayoutSerializer):
 
         conf = LayoutSerializerConfig.from_runnable_config(config)
 
-        example_prompt = ChatPromptTemplate.from_messages(
-            [
-                CONTENT_AWARE_CONSTRAINT,
-                SERIALIZED_LAYOUT,
-            ]
-        )
-        example_prompt = ChatPromptTemplate.from_messages(
-            [
-                ("human", CONTENT_AWARE_CONSTRAINT),
-                ("ai", SERIALIZED_LAYOUT),
-            ]
-        )
-        examples = [
-            {
-                "content_constraint": self._get_content_constraint(candidate),
-                "type_constraint": self._get_type_constraint(candidate),
-                "serialized_layout": self._get_serialized_layout(
-                    candidate, schema=conf.input_schema
-                ),
-            }
-            for candidate in input.candidates
-        ]
-
-        few_shot_prompt = FewShotChatMessagePromptTemplate(
-            examples=examples,
-            example_prompt=example_prompt,
-        )
-        system_prompt = SystemMessagePromptTemplate.from_template(
-            template=self.system_prompt,
-        )
-        human_prompt = HumanMessagePromptTemplate.from_template(
-            template=CONTENT_AWARE_CONSTRAINT
-        )
-
-        prompt = ChatPromptTemplate.from_messages(
-            [
-                system_prompt,
-                few_shot_prompt,
-                human_prompt,
-            ]
-        )
-
-        final_prompt = prompt.invoke(
-            {
-                "canvas_width": input.query.canvas_size.width,
-                "canvas_height": input.query.canvas_size.height,
-                "task_description": self.task_type,
-                "layout_domain": self.layout_domain,
-                "content_constraint": self._get_content_constraint(input.query),
-                "type_constraint": self._get_type_constraint(input.query),
-            }
+        final_prompt = self._format_prompt(
+            query=input.query,
+            candidates=self._get_candidates(input, conf),
+            schema=conf.input_schema,
+            serialization_format=conf.serialization_format,
         )
         assert isinstance(final_prompt, ChatPromptValue)
 
@@ -0,0 +1,180 @@
+import csv
+import html
+import io
+import json
+import re
+from typing import Any, Dict, Final, List, Literal, Sequence, Type, get_args
+
+from layout_prompter.models import LayoutSerializedData, LayoutSerializedOutputData
+
+# Output formats of the serialized layouts:
+# - "json": `[{"class_name": "text", "bbox": {"left": 0, ...}}, ...]`
+# - "sequence": `text 0 12 30 5 | logo 10 20 30 40`, as in the original LayoutPrompter
+# - "csv": a `class_name,left,top,width,height` header followed by one row per element
+# - "html": one absolutely positioned `<div>` per element
+SerializationFormat = Literal["json", "sequence", "csv", "html"]
+
+SERIALIZATION_FORMATS: Final[tuple] = get_args(SerializationFormat)
+
+BBOX_FIELDS: Final[List[str]] = ["left", "top", "width", "height"]
+
+SEQUENCE_ELEMENT_SEP: Final[str] = " | "
+
+CSV_HEADER: Final[List[str]] = ["class_name", *BBOX_FIELDS]
+
+HTML_ELEMENT: Final[str] = (
+    '<div class="{class_name}" '
+    'style="left: {left}px; top: {top}px; width: {width}px; height: {height}px"></div>'
+)
+HTML_ELEMENT_PATTERN: Final[re.Pattern] = re.compile(
+    r'<div\s+class="(?P<class_name>[^"]*)"\s+style="(?P<style>[^"]*)"'
+)
+HTML_STYLE_PATTERN: Final[re.Pattern] = re.compile(r"([a-z]+)\s*:\s*(-?\d+)px")
+
+CODE_FENCE_PATTERN: Final[re.Pattern] = re.compile(r"^```[\w-]*\n(.*?)\n?```$", re.S)
+
+
+def _serialize_json(elements: Sequence[LayoutSerializedData]) -> str:
+    return json.dumps([element.model_dump() for element in elements])
+
+
+def _serialize_sequence(elements: Sequence[LayoutSerializedData]) -> str:
+    return SEQUENCE_ELEMENT_SEP.join(
+        " ".join(map(str, (element.class_name, *element.bbox.to_ltwh())))
+        for element in elements
+    )
+
+
+def _serialize_csv(elements: Sequence[LayoutSerializedData]) -> str:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(CSV_HEADER)
+    writer.writerows(
+        (element.class_name, *element.bbox.to_ltwh()) for element in elements
+    )
+    return buffer.getvalue().rstrip("\n")
+
+
+def _serialize_html(elements: Sequence[LayoutSerializedData]) -> str:
+    divs = [
+        HTML_ELEMENT.format(
+            class_name=html.escape(element.class_name),
+            **element.bbox.model_dump(),
+        )
+        for element in elements
+    ]
+    return "\n".join(["<html>", "<body>", *divs, "</body>", "</html>"])
+
+
+def serialize_layout(
+    elements: Sequence[LayoutSerializedData],
+    serialization_format: SerializationFormat = "json",
+) -> str:
+    """Serialize the elements of a layout into the given format.
+
+    Args:
+        elements (Sequence[LayoutSerializedData]): The elements of the layout.
+        serialization_format (SerializationFormat): The output format.
+
+    Returns:
+        str: The serialized layout.
+    """
+    if serialization_format == "json":
+        return _serialize_json(elements)
+    elif serialization_format == "sequence":
+        return _serialize_sequence(elements)
+    elif serialization_format == "csv":
+        return _serialize_csv(elements)
+    elif serialization_format == "html":
+        return _serialize_html(elements)
+    else:
+        raise ValueError(f"Unsupported serialization format: {serialization_format}")
+
+
+def _to_element(class_name: str, ltwh: Sequence[Any]) -> Dict[str, Any]:
+    return {
+        "class_name": class_name.strip(),
+        "bbox": dict(zip(BBOX_FIELDS, (int(v) for v in ltwh))),
+    }
+
+
+def _parse_json(text: str) -> List[Dict[str, Any]]:
+    parsed = json.loads(text)
+    # Accept both the bare list of elements and the structured output object
+    return parsed["layouts"] if isinstance(parsed, dict) else parsed
+
+
+def _parse_sequence(text: str) -> List[Dict[str, Any]]:
+    elements = []
+    for chunk in text.split("|"):
+        if not chunk.strip():
+            continue
+        # Split from the right, as class names may contain spaces (e.g., "Text Button")
+        class_name, *ltwh = chunk.strip().rsplit(maxsplit=4)
+        if len(ltwh) != 4:
+            raise ValueError(f"Invalid sequence element: {chunk!r}")
+        elements.append(_to_element(class_name, ltwh))
+    return elements
+
+
+def _parse_csv(text: str) -> List[Dict[str, Any]]:
+    rows = [row for row in csv.reader(io.StringIO(text)) if row]
+    if rows and rows[0] == CSV_HEADER:
+        rows = rows[1:]
+
+    elements = []
+    for row in rows:
+        if len(row) != len(CSV_HEADER):
+            raise ValueError(f"Invalid CSV row: {row!r}")
+        class_name, *ltwh = row
+        elements.append(_to_element(class_name, ltwh))
+    return elements
+
+
+def _parse_html(text: str) -> List[Dict[str, Any]]:
+    elements = []
+    for match in HTML_ELEMENT_PATTERN.finditer(text):
+        style = dict(HTML_STYLE_PATTERN.findall(match.group("style")))
+        if any(field not in style for field in BBOX_FIELDS):
+            raise ValueError(f"Invalid HTML element: {match.group()!r}")
+        elements.append(
+            _to_element(
+                html.unescape(match.group("class_name")),
+                [style[field] for field in BBOX_FIELDS],
+            )
+        )
+    return elements
+
+
+def parse_layout(
+    text: str,
+    schema: Type[LayoutSerializedOutputData],
+    serialization_format: SerializationFormat = "json",
+) -> LayoutSerializedOutputData:
+    """Parse a layout serialized in the given format, e.g., an LLM response.
+
+    Args:
+        text (str): The serialized layout, optionally wrapped in a Markdown code block.
+        schema (Type[LayoutSerializedOutputData]): The output schema to validate against.
+        serialization_format (SerializationFormat): The format of the text.
+
+    Returns:
+        LayoutSerializedOutputData: The parsed layout.
+    """
+    text = text.strip()
+    match = CODE_FENCE_PATTERN.match(text)
+    if match is not None:
+        text = match.group(1).strip()
+
+    if serialization_format == "json":
+        elements = _parse_json(text)
+    elif serialization_format == "sequence":
+        elements = _parse_sequence(text)
+    elif serialization_format == "csv":
+        elements = _parse_csv(text)
+    elif serialization_format == "html":
+        elements = _parse_html(text)
+    else:
+        raise ValueError(f"Unsupported serialization format: {serialization_format}")
+
+    return schema.model_validate({"layouts": elements})
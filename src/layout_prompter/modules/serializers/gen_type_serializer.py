@@ -1,13 +1,7 @@
 import json
-from typing import Any, Final, Optional
+from typing import Any, Dict, Final, Optional
 
 from langchain_core.prompt_values import ChatPromptValue
-from langchain_core.prompts import (
-    ChatPromptTemplate,
-    FewShotChatMessagePromptTemplate,
-    HumanMessagePromptTemplate,
-    SystemMessagePromptTemplate,
-)
 from langchain_core.runnables.config import RunnableConfig
 from loguru import logger
 
@@ -15,7 +9,11 @@ from layout_prompter.models import (
     ProcessedLayoutData,
 )
 
-from .base import LayoutSerializer, LayoutSerializerConfig, LayoutSerializerInput
+from .base import (
+    LayoutSerializer,
+    LayoutSerializerConfig,
+    LayoutSerializerInput,
+)
 
 GEN_TYPE_CONSTRAINT: Final[str] = """\
 # Constraints
@@ -24,9 +22,6 @@ GEN_TYPE_CONSTRAINT: Final[str] = """\
 
 # Serialized Layout"""
 
-SERIALIZED_LAYOUT: Final[str] = """\
-{serialized_layout}"""
-
 
 class GenTypeSerializer(LayoutSerializer):
     task_type: str = "generation conditioned on given element types"
@@ -39,6 +34,12 @@ class GenTypeSerializer(LayoutSerializer):
         )
         return self._convert_to_double_bracket(type_constraint)
 
+    def _get_constraint_template(self) -> str:
+        return GEN_TYPE_CONSTRAINT
+
+    def _get_constraint_variables(self, data: ProcessedLayoutData) -> Dict[str, str]:
+        return {"type_constraint": self._get_type_constraint(data)}
+
     def invoke(
         self,
         input: LayoutSerializerInput,
@@ -47,55 +48,11 @@ class GenTypeSerializer(LayoutSerializer):
     ) -> Any:
         conf = LayoutSerializerConfig.from_runnable_config(config)
 
-        example_prompt = ChatPromptTemplate.from_messages(
-            [
-                GEN_TYPE_CONSTRAINT,
-                SERIALIZED_LAYOUT,
-            ]
-        )
-        example_prompt = ChatPromptTemplate.from_messages(
-            [
-                ("human", GEN_TYPE_CONSTRAINT),
-                ("ai", SERIALIZED_LAYOUT),
-            ]
-        )
-        examples = [
-            {
-                "type_constraint": self._get_type_constraint(candidate),
-                "serialized_layout": self._get_serialized_layout(
-                    candidate, schema=conf.input_schema
-                ),
-            }
-            for candidate in input.candidates
-        ]
-
-        few_shot_prompt = FewShotChatMessagePromptTemplate(
-            examples=examples,
-            example_prompt=example_prompt,
-        )
-        system_prompt = SystemMessagePromptTemplate.from_template(
-            template=self.system_prompt,
-        )
-        human_prompt = HumanMessagePromptTemplate.from_template(
-            template=GEN_TYPE_CONSTRAINT
-        )
-
-        prompt = ChatPromptTemplate.from_messages(
-            [
-                system_prompt,
-                few_shot_prompt,
-                human_prompt,
-            ]
-        )
-
-        final_prompt = prompt.invoke(
-            {
-                "canvas_width": input.query.canvas_size.width,
-                "canvas_height": input.query.canvas_size.height,
-                "task_description": self.task_type,
-                "layout_domain": self.layout_domain,
-                "type_constraint": self._get_type_constraint(input.query),
-            }
+        final_prompt = self._format_prompt(
+            query=input.query,
+            candidates=self._get_candidates(input, conf),
+            schema=conf.input_schema,
+            serialization_format=conf.serialization_format,
         )
         assert isinstance(final_prompt, ChatPromptValue)
 
@@ -1,16 +1,34 @@
-from .bbox import normalize_bboxes
+from .bbox import compute_union_areas, normalize_bboxes
 from .configuration import Configuration
 from .image import base64_to_pil, generate_color_palette, pil_to_base64
-from .metrics import compute_alignment, compute_overlap
+from .metrics import (
+    AlignmentMethod,
+    compute_alignment,
+    compute_alignment_batch,
+    compute_overlap,
+    compute_overlap_batch,
+    compute_pairwise_iou,
+)
+from .prompt_cache import compute_shared_prefix_lengths, compute_shared_prefix_rate
+from .tokens import estimate_num_message_tokens, estimate_num_tokens
 from .workers import get_num_workers
 
 __all__ = [
     "normalize_bboxes",
+    "compute_union_areas",
     "base64_to_pil",
     "pil_to_base64",
     "generate_color_palette",
     "Configuration",
+    "AlignmentMethod",
     "compute_alignment",
     "compute_overlap",
+    "compute_alignment_batch",
+    "compute_overlap_batch",
+    "compute_pairwise_iou",
     "get_num_workers",
+    "estimate_num_tokens",
+    "estimate_num_message_tokens",
+    "compute_shared_prefix_lengths",
+    "compute_shared_prefix_rate",
 ]
@@ -11,3 +11,28 @@ def normalize_bboxes(bboxes: np.ndarray, w: int, h: int) -> np.ndarray:
     bboxes[:, 0::2] /= w
     bboxes[:, 1::2] /= h
     return bboxes
+
+
+def compute_union_areas(rects: np.ndarray) -> np.ndarray:
+    """Compute the exact area of the union of rectangles by coordinate compression.
+
+    Args:
+        rects (np.ndarray): Half-open `[left, right) x [top, bottom)` rectangles in LTRB format of shape (..., K, 4). Empty rectangles (e.g., all zeros) can be used as padding.
+
+    Returns:
+        np.ndarray: The union area of the K rectangles, of shape (...).
+    """
+    assert rects.shape[-1] == 4, "rects should be of shape (..., K, 4)"
+
+    # The sorted edges split the plane into cells that are either fully covered
+    # by a rectangle or not covered at all. Duplicated edges yield empty cells.
+    xs = np.sort(np.concatenate([rects[..., 0], rects[..., 2]], axis=-1), axis=-1)
+    ys = np.sort(np.concatenate([rects[..., 1], rects[..., 3]], axis=-1), axis=-1)
+
+    left, top, right, bottom = (rects[..., i, None] for i in range(4))
+    in_x = (left <= xs[..., None, :-1]) & (xs[..., None, 1:] <= right)
+    in_y = (top <= ys[..., None, :-1]) & (ys[..., None, 1:] <= bottom)
+    covered = (in_y[..., :, :, None] & in_x[..., :, None, :]).any(axis=-3)
+
+    cell_areas = np.diff(ys, axis=-1)[..., :, None] * np.diff(xs, axis=-1)[..., None, :]
+    return (cell_areas * covered).sum(axis=(-2, -1))
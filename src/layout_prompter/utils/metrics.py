@@ -1,7 +1,66 @@
+from typing import Literal, Optional
+
 import numpy as np
 
+# Implementations of the nearest alignment partner search of the alignment metrics:
+# - "pairwise": materialize the (B, 6, N, N) pairwise distances, O(N^2)
+# - "sorted": sort the values of each coordinate and take the gaps between
+#   neighbors, O(N log N). The results are identical.
+AlignmentMethod = Literal["pairwise", "sorted"]
+
+
+def _compute_nearest_distances(
+    X: np.ndarray, partner_mask: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """Compute the distance of each value to its nearest other value along the last
+    axis by sorting, i.e., the nearest neighbor in 1D is adjacent in sorted order.
+
+    Args:
+        X (np.ndarray): The values of shape (..., N).
+        partner_mask (Optional[np.ndarray]): The mask of shape (..., N) of the
+            values that can be the nearest partner. All values by default.
+
+    Returns:
+        np.ndarray: The distances of shape (..., N), inf if there is no partner.
+    """
+    if partner_mask is not None:
+        # The excluded values are sorted to the end, and their gaps are inf
+        X = np.where(partner_mask, X, np.inf)
+
+    order = np.argsort(X, axis=-1, kind="stable")
+    X_sorted = np.take_along_axis(X, order, axis=-1)
+    with np.errstate(invalid="ignore"):
+        gaps = np.diff(X_sorted, axis=-1)
+    gaps[np.isnan(gaps)] = np.inf
+
+    inf = np.full((*gaps.shape[:-1], 1), np.inf, dtype=gaps.dtype)
+    nearest_sorted = np.minimum(
+        np.concatenate([inf, gaps], axis=-1), np.concatenate([gaps, inf], axis=-1)
+    )
+
+    nearest = np.empty_like(nearest_sorted)
+    np.put_along_axis(nearest, order, nearest_sorted, axis=-1)
+    return nearest
+
+
+def _compute_alignment_scores(
+    bbox: np.ndarray,
+    mask: np.ndarray,
+    partner_mask: np.ndarray,
+    method: AlignmentMethod,
+) -> np.ndarray:
+    """Compute the alignment score of each layout of a padded batch.
 
-def compute_alignment(bbox: np.ndarray, mask: np.ndarray) -> float:
+    Args:
+        bbox (np.ndarray): The LTRB bboxes of shape (B, N, 4).
+        mask (np.ndarray): The mask of shape (B, N) of the elements to score.
+        partner_mask (np.ndarray): The mask of shape (B, N) of the elements that can
+            be the alignment partner of the others.
+        method (AlignmentMethod): The implementation of the nearest partner search.
+
+    Returns:
+        np.ndarray: The alignment scores of shape (B,).
+    """
     # Attribute-conditioned Layout GAN
     # 3.6.4 Alignment Loss
 
@@ -11,43 +70,165 @@ def compute_alignment(bbox: np.ndarray, mask: np.ndarray) -> float:
     yc = (yt + yb) / 2
     X = np.stack([xl, xc, xr, yt, yc, yb], axis=1)
 
-    X = X[:, :, :, None] - X[:, :, None, :]
-    idx = np.arange(X.shape[2])
-    X[:, :, idx, idx] = 1.0
-    X = np.abs(X).transpose(0, 2, 1, 3)
-    X[~mask] = 1.0
-    X = X.min(-1).min(-1)
+    if method == "sorted":
+        # The distance of an element to itself is 1.0 in the pairwise computation
+        X = _compute_nearest_distances(X, partner_mask=partner_mask[:, None, :])
+        X = np.minimum(X.min(1), 1.0)
+        X[~mask] = 1.0
+    else:
+        X = np.abs(X[:, :, :, None] - X[:, :, None, :])
+        idx = np.arange(X.shape[2])
+        X[:, :, idx, idx] = 1.0
+        X = np.where(partner_mask[:, None, None, :], X, np.inf)
+        X = X.transpose(0, 2, 1, 3)
+        X[~mask] = 1.0
+        X = X.min(-1).min(-1)
     X[X == 1.0] = 0.0
 
-    X = -np.log(1 - X)
-    score = np.nan_to_num((X.sum(-1) / mask.astype(float).sum(-1)))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        X = -np.log(1 - X)
+        return np.nan_to_num(X.sum(-1) / mask.astype(float).sum(-1))
+
 
+def compute_alignment(
+    bbox: np.ndarray, mask: np.ndarray, method: AlignmentMethod = "pairwise"
+) -> float:
+    # The padded elements are also the alignment partners of the other elements
+    score = _compute_alignment_scores(
+        bbox, mask, partner_mask=np.ones_like(mask, dtype=bool), method=method
+    )
     return score.mean().item()
 
 
-def compute_overlap(bbox: np.ndarray, mask: np.ndarray) -> float:
+def _compute_overlap_scores(
+    bbox: np.ndarray,
+    mask: np.ndarray,
+    partner_mask: np.ndarray,
+    block_size: Optional[int],
+) -> np.ndarray:
+    """Compute the overlap score of each layout of a padded batch, computing the
+    pairs of `block_size` elements (rows) at a time to bound the memory to
+    O(B * block_size * N). All the pairs are computed at once by default.
+
+    Args:
+        bbox (np.ndarray): The LTRB bboxes of shape (B, N, 4).
+        mask (np.ndarray): The mask of shape (B, N) of the elements to score.
+        partner_mask (np.ndarray): The mask of shape (B, N) of the elements whose
+            pairs are included.
+        block_size (Optional[int]): The number of elements (rows) per block.
+
+    Returns:
+        np.ndarray: The overlap scores of shape (B,).
+    """
     # Attribute-conditioned Layout GAN
     # 3.6.3 Overlapping Loss
 
-    bbox[bbox == ~mask[:, :, None]] = 0
     bbox = bbox.transpose(2, 0, 1)
-
-    l1, t1, r1, b1 = bbox[:, :, :, None]
+    num_elements = bbox.shape[-1]
+    if block_size is None:
+        block_size = max(num_elements, 1)
     l2, t2, r2, b2 = bbox[:, :, None, :]
-    a1 = (r1 - l1) * (b1 - t1)
-
-    # intersection
-    l_max = np.maximum(l1, l2)
-    r_min = np.minimum(r1, r2)
-    t_max = np.maximum(t1, t2)
-    b_min = np.minimum(b1, b2)
-    cond = (l_max < r_min) & (t_max < b_min)
-    ai = np.where(cond, (r_min - l_max) * (b_min - t_max), np.zeros_like(a1[0]))
-
-    diag_mask = np.eye(a1.shape[1], dtype=bool)
-    ai = ai * ~diag_mask
-
-    ar = ai / a1
-    ar = np.nan_to_num(ar)
-    score = np.nan_to_num((ar.sum(axis=(1, 2)) / mask.astype(float).sum(-1)))
+
+    ratio_sum = np.zeros(bbox.shape[1])
+    for start in range(0, num_elements, block_size):
+        rows = np.arange(start, min(start + block_size, num_elements))
+        l1, t1, r1, b1 = bbox[:, :, rows, None]
+        a1 = (r1 - l1) * (b1 - t1)
+
+        # intersection
+        l_max = np.maximum(l1, l2)
+        r_min = np.minimum(r1, r2)
+        t_max = np.maximum(t1, t2)
+        b_min = np.minimum(b1, b2)
+        cond = (l_max < r_min) & (t_max < b_min)
+        ai = np.where(cond, (r_min - l_max) * (b_min - t_max), 0)
+
+        # Exclude the pairs of an element with itself and with the non-partners
+        pair_mask = (rows[:, None] != np.arange(num_elements)[None, :]) & (
+            partner_mask[:, rows, None] & partner_mask[:, None, :]
+        )
+        ai = ai * pair_mask
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratio_sum += np.nan_to_num(ai / a1).sum(axis=(1, 2))
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.nan_to_num(ratio_sum / mask.astype(float).sum(-1))
+
+
+def compute_overlap(
+    bbox: np.ndarray, mask: np.ndarray, block_size: Optional[int] = None
+) -> float:
+    bbox[bbox == ~mask[:, :, None]] = 0
+    score = _compute_overlap_scores(
+        bbox, mask, partner_mask=np.ones_like(mask, dtype=bool), block_size=block_size
+    )
     return score.mean().item()
+
+
+def compute_alignment_batch(
+    bbox: np.ndarray, mask: np.ndarray, method: AlignmentMethod = "pairwise"
+) -> np.ndarray:
+    """Compute the alignment score of each layout of a padded batch at once.
+
+    Unlike `compute_alignment`, the padded elements are also excluded as the
+    alignment partners of the other elements, so that the score of each layout
+    equals its score computed alone.
+
+    Args:
+        bbox (np.ndarray): The LTRB bboxes of shape (B, N, 4), padded to N elements.
+        mask (np.ndarray): The mask of shape (B, N), True for the actual elements.
+        method (AlignmentMethod): The implementation of the nearest partner search.
+            "sorted" runs in O(N log N) time and O(N) memory per layout.
+
+    Returns:
+        np.ndarray: The alignment scores of shape (B,).
+    """
+    return _compute_alignment_scores(
+        bbox.astype(np.float64), mask, partner_mask=mask, method=method
+    )
+
+
+def compute_overlap_batch(
+    bbox: np.ndarray, mask: np.ndarray, block_size: Optional[int] = None
+) -> np.ndarray:
+    """Compute the overlap score of each layout of a padded batch at once.
+
+    Args:
+        bbox (np.ndarray): The LTRB bboxes of shape (B, N, 4), padded to N elements.
+        mask (np.ndarray): The mask of shape (B, N), True for the actual elements.
+        block_size (Optional[int]): If given, the pairs of elements are computed for
+            `block_size` elements at a time, which bounds the memory of the
+            intermediate arrays to O(B * block_size * N) instead of O(B * N^2).
+
+    Returns:
+        np.ndarray: The overlap scores of shape (B,).
+    """
+    return _compute_overlap_scores(
+        np.where(mask[:, :, None], bbox, 0),
+        mask,
+        partner_mask=mask,
+        block_size=block_size,
+    )
+
+
+def compute_pairwise_iou(bbox1: np.ndarray, bbox2: np.ndarray) -> np.ndarray:
+    """Compute the IoU of every pair of bboxes, broadcasting over leading dimensions.
+
+    Args:
+        bbox1 (np.ndarray): The LTRB bboxes of shape (..., N, 4).
+        bbox2 (np.ndarray): The LTRB bboxes of shape (..., M, 4).
+
+    Returns:
+        np.ndarray: The IoU matrix of shape (..., N, M). Pairs with an empty union
+            have an IoU of 0.
+    """
+    l1, t1, r1, b1 = np.moveaxis(bbox1[..., :, None, :].astype(np.float64), -1, 0)
+    l2, t2, r2, b2 = np.moveaxis(bbox2[..., None, :, :].astype(np.float64), -1, 0)
+
+    iw = np.clip(np.minimum(r1, r2) - np.maximum(l1, l2), 0, None)
+    ih = np.clip(np.minimum(b1, b2) - np.maximum(t1, t2), 0, None)
+    ai = iw * ih
+    au = (r1 - l1) * (b1 - t1) + (r2 - l2) * (b2 - t2) - ai
+
+    return np.divide(ai, au, out=np.zeros_like(ai), where=au > 0)
@@ -0,0 +1,55 @@
+from typing import List, Sequence, Union
+
+from langchain_core.prompt_values import PromptValue
+
+
+def _common_prefix_length(a: str, b: str) -> int:
+    """Length of the common prefix of two strings by binary search on slices."""
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _to_text(prompt: Union[str, PromptValue]) -> str:
+    return prompt if isinstance(prompt, str) else prompt.to_string()
+
+
+def compute_shared_prefix_lengths(
+    prompts: Sequence[Union[str, PromptValue]],
+) -> List[int]:
+    """Compute the length of the prefix of each prompt shared with an earlier prompt.
+
+    This is the number of leading characters that a provider with prompt (prefix)
+    caching could reuse if the prompts of the batch were sent in order.
+
+    Args:
+        prompts (Sequence[Union[str, PromptValue]]): The prompts of the batch.
+
+    Returns:
+        List[int]: The shared prefix length of each prompt (0 for the first one).
+    """
+    texts = [_to_text(prompt) for prompt in prompts]
+    return [
+        max((_common_prefix_length(text, earlier) for earlier in texts[:i]), default=0)
+        for i, text in enumerate(texts)
+    ]
+
+
+def compute_shared_prefix_rate(prompts: Sequence[Union[str, PromptValue]]) -> float:
+    """Compute the fraction of the characters of a batch of prompts in shared prefixes.
+
+    Args:
+        prompts (Sequence[Union[str, PromptValue]]): The prompts of the batch.
+
+    Returns:
+        float: The total shared prefix length divided by the total prompt length.
+    """
+    total_length = sum(len(_to_text(prompt)) for prompt in prompts)
+    if total_length == 0:
+        return 0.0
+    return sum(compute_shared_prefix_lengths(prompts)) / total_length
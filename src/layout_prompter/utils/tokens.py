@@ -0,0 +1,58 @@
+import math
+import re
+from typing import Final, Sequence
+
+from langchain_core.messages import BaseMessage
+
+# Pre-tokenization similar to that of BPE tokenizers such as cl100k_base:
+# words with an optional leading space, runs of up to 3 digits, punctuation runs and whitespace.
+PRETOKENIZE_PATTERN: Final[re.Pattern] = re.compile(
+    r" ?[^\W\d_]+| ?\d{1,3}| ?[^\s\w]+|_+|\s+"
+)
+
+# Approximate number of characters per token within a pre-token
+CHARS_PER_WORD_TOKEN: Final[int] = 4
+CHARS_PER_SYMBOL_TOKEN: Final[int] = 2
+
+# Tokens added per chat message for the role and the separators
+TOKENS_PER_MESSAGE: Final[int] = 4
+
+
+def estimate_num_tokens(text: str) -> int:
+    """Estimate the number of tokens of a text without a tokenizer.
+
+    The text is split as a BPE tokenizer would before merging, and long words and
+    symbol runs are assumed to be split into chunks of a few characters.
+
+    Args:
+        text (str): The text to estimate the number of tokens of.
+
+    Returns:
+        int: The approximate number of tokens.
+    """
+    num_tokens = 0
+    for match in PRETOKENIZE_PATTERN.finditer(text):
+        pretoken = match.group().lstrip(" ") or match.group()
+        if pretoken.isspace():
+            num_tokens += 1
+        elif pretoken[0].isalpha():
+            num_tokens += math.ceil(len(pretoken) / CHARS_PER_WORD_TOKEN)
+        elif pretoken[0].isdigit():
+            num_tokens += 1
+        else:
+            num_tokens += math.ceil(len(pretoken) / CHARS_PER_SYMBOL_TOKEN)
+    return num_tokens
+
+
+def estimate_num_message_tokens(messages: Sequence[BaseMessage]) -> int:
+    """Estimate the number of prompt tokens of chat messages.
+
+    Args:
+        messages (Sequence[BaseMessage]): The chat messages of the prompt.
+
+    Returns:
+        int: The approximate number of tokens, including the per-message overhead.
+    """
+    return sum(
+        TOKENS_PER_MESSAGE + estimate_num_tokens(message.text()) for message in messages
+    )
@@ -1,8 +1,9 @@
 import pathlib
 import pickle
-from typing import Dict, List
+from typing import Callable, Dict, List
 
 import datasets as ds
+import numpy as np
 import pytest
 from loguru import logger
 from tqdm.auto import tqdm
@@ -13,7 +14,9 @@ from layout_prompter.datasets import (
     load_raw_rico,
     load_rico25,
 )
-from layout_prompter.models import LayoutData
+from layout_prompter.models import LayoutData, NormalizedBbox, ProcessedLayoutData
+from layout_prompter.settings import PosterLayoutSettings
+from layout_prompter.transforms import DiscretizeBboxes
 
 
 @pytest.fixture(autouse=True)
@@ -139,3 +142,60 @@ def rico25_dataset(
         pickle.dump(layout_dataset, wf)
 
     return layout_dataset
+
+
+def generate_synthetic_poster_layouts(
+    num_layouts: int, seed: int = 0
+) -> List[ProcessedLayoutData]:
+    """Generate random discretized poster layouts that do not require the dataset."""
+    rng = np.random.default_rng(seed)
+    settings = PosterLayoutSettings()
+
+    def random_bboxes(num_bboxes: int) -> List[NormalizedBbox]:
+        ltwh = rng.uniform(0.0, 0.6, size=(num_bboxes, 4))
+        return [
+            NormalizedBbox(
+                left=float(left),
+                top=float(top),
+                width=float(width),
+                height=float(height),
+            )
+            for left, top, width, height in ltwh
+        ]
+
+    layouts = []
+    for idx in range(num_layouts):
+        num_elements = int(rng.integers(1, 6))
+        layouts.append(
+            LayoutData(
+                idx=idx,
+                bboxes=random_bboxes(num_elements),
+                labels=rng.choice(settings.labels, size=num_elements).tolist(),
+                canvas_size=settings.canvas_size,
+                encoded_image=None,
+                content_bboxes=random_bboxes(int(rng.integers(1, 4))),
+            )
+        )
+
+    return DiscretizeBboxes().batch(
+        layouts,
+        config={"configurable": {"target_canvas_size": settings.canvas_size}},
+    )
+
+
+@pytest.fixture(scope="session")
+def synthetic_poster_layouts_factory() -> Callable[..., List[ProcessedLayoutData]]:
+    """Return the factory of synthetic processed poster layouts, e.g., for benchmarks."""
+    return generate_synthetic_poster_layouts
+
+
+@pytest.fixture(scope="session")
+def synthetic_poster_layouts() -> List[ProcessedLayoutData]:
+    """Return synthetic processed poster layouts used as candidate examples."""
+    return generate_synthetic_poster_layouts(num_layouts=500, seed=0)
+
+
+@pytest.fixture(scope="session")
+def synthetic_poster_queries() -> List[ProcessedLayoutData]:
+    """Return synthetic processed poster layouts used as queries."""
+    return generate_synthetic_poster_layouts(num_layouts=20, seed=1)
@@ -1,17 +1,32 @@
-from typing import Dict, List, Type
+import asyncio
+import pathlib
+from typing import Any, Dict, List, Optional, Sequence, Type
 
+import numpy as np
 import pytest
 from langchain.chat_models import init_chat_model
 from langchain.smith.evaluation.progress import ProgressBarCallback
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.runnables import Runnable, RunnableConfig, RunnableSequence
+from langchain_core.utils.function_calling import convert_to_openai_tool
+from pydantic import PrivateAttr
 from pytest_lazy_fixtures import lf
 
+import layout_prompter.layout_prompter as layout_prompter_module
 from layout_prompter import LayoutPrompter
+from layout_prompter.layout_prompter import (
+    LayoutPrompterOutput,
+    LayoutPrompterStreamEvent,
+)
 from layout_prompter.models import (
     LayoutData,
     LayoutSerializedData,
     LayoutSerializedOutputData,
     PosterLayoutSerializedData,
     PosterLayoutSerializedOutputData,
+    ProcessedLayoutData,
     Rico25SerializedData,
     Rico25SerializedOutputData,
 )
@@ -19,6 +34,12 @@ from layout_prompter.modules import (
     ContentAwareSelector,
     ContentAwareSerializer,
     LayoutPrompterRanker,
+    SQLiteGenerationCache,
+)
+from layout_prompter.modules.serializers import (
+    SerializationFormat,
+    parse_layout,
+    serialize_layout,
 )
 from layout_prompter.preprocessors import ContentAwareProcessor
 from layout_prompter.settings import PosterLayoutSettings, Rico25Settings, TaskSettings
@@ -28,6 +49,101 @@ from layout_prompter.utils.testing import LayoutPrompterTestCase
 from layout_prompter.visualizers import ContentAwareVisualizer
 
 
+class FakeLayoutChatModel(BaseChatModel):
+    """Chat model that answers every prompt with random poster layouts as tool calls,
+    or as plain text in `text_format` if no tool is bound.
+
+    Like OpenAI, it returns `n` completions per call if `supports_n` is True.
+    """
+
+    supports_n: bool = True
+    seed: int = 0
+    num_calls: int = 0
+    text_format: SerializationFormat = "json"
+
+    _rng: np.random.Generator = PrivateAttr()
+    _received_messages: List[List[BaseMessage]] = PrivateAttr(default_factory=list)
+
+    def model_post_init(self, __context: Any) -> None:
+        self._rng = np.random.default_rng(self.seed)
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-layout"
+
+    def bind_tools(  # type: ignore[override]
+        self,
+        tools: Sequence[Any],
+        *,
+        tool_choice: Optional[Any] = None,
+        **kwargs: Any,
+    ) -> Runnable:
+        return self.bind(
+            tools=[convert_to_openai_tool(tool) for tool in tools],
+            tool_choice=tool_choice,
+            **kwargs,
+        )
+
+    def _random_layout(self) -> Dict[str, Any]:
+        num_elements = int(self._rng.integers(1, 6))
+        ltwh = self._rng.integers(1, 50, size=(num_elements, 4))
+        return {
+            "layouts": [
+                {
+                    "class_name": str(self._rng.choice(["text", "logo", "underlay"])),
+                    "bbox": dict(zip(("left", "top", "width", "height"), bbox)),
+                }
+                for bbox in ltwh.tolist()
+            ]
+        }
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[Any] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        self.num_calls += 1
+        self._received_messages.append(messages)
+        n = kwargs.get("n", 1) if self.supports_n else 1
+        if "tools" not in kwargs:
+            return ChatResult(
+                generations=[
+                    ChatGeneration(
+                        message=AIMessage(
+                            content=serialize_layout(
+                                PosterLayoutSerializedOutputData.model_validate(
+                                    self._random_layout()
+                                ).layouts,
+                                serialization_format=self.text_format,
+                            )
+                        )
+                    )
+                    for _ in range(n)
+                ]
+            )
+
+        tool_name = kwargs["tools"][0]["function"]["name"]
+        return ChatResult(
+            generations=[
+                ChatGeneration(
+                    message=AIMessage(
+                        content="",
+                        tool_calls=[
+                            {
+                                "name": tool_name,
+                                "args": self._random_layout(),
+                                "id": f"call_{i}",
+                            }
+                        ],
+                    )
+                )
+                for i in range(n)
+            ]
+        )
+
+
 class TestLayoutPrompter(LayoutPrompterTestCase):
     @pytest.fixture
     def num_prompt(self) -> int:
@@ -200,3 +316,624 @@ class TestContentAgnosticGeneration(LayoutPrompterTestCase):
     @pytest.fixture
     def model_id(self) -> str:
         return "gpt-4o"
+
+
+class TestLayoutPrompterWithFakeLLM(LayoutPrompterTestCase):
+    @pytest.fixture
+    def num_return(self) -> int:
+        return 10
+
+    @pytest.fixture
+    def llm(self) -> FakeLayoutChatModel:
+        return FakeLayoutChatModel()
+
+    @pytest.fixture
+    def layout_prompter(
+        self,
+        synthetic_poster_layouts: List[ProcessedLayoutData],
+        llm: FakeLayoutChatModel,
+    ) -> LayoutPrompter:
+        return LayoutPrompter(
+            selector=ContentAwareSelector(examples=synthetic_poster_layouts),
+            serializer=ContentAwareSerializer(
+                layout_domain=PosterLayoutSettings().domain
+            ),
+            llm=llm,
+            ranker=LayoutPrompterRanker(),
+        )
+
+    def get_config(self, **configurable: Any) -> RunnableConfig:
+        return {
+            "configurable": {
+                "input_schema": PosterLayoutSerializedData,
+                "output_schema": PosterLayoutSerializedOutputData,
+                **configurable,
+            }
+        }
+
+    def invoke(
+        self,
+        layout_prompter: LayoutPrompter,
+        query: ProcessedLayoutData,
+        **configurable: Any,
+    ) -> LayoutPrompterOutput:
+        return layout_prompter.invoke(
+            input=query, config=self.get_config(**configurable)
+        )
+
+    def test_fan_out_generation(
+        self,
+        layout_prompter: LayoutPrompter,
+        llm: FakeLayoutChatModel,
+        synthetic_poster_queries: List[ProcessedLayoutData],
+        num_return: int,
+    ):
+        output = self.invoke(
+            layout_prompter,
+            synthetic_poster_queries[0],
+            num_return=num_return,
+            max_concurrency=2,
+        )
+        assert len(output.ranked_outputs) == num_return
+        assert llm.num_calls == num_return
+
+    def test_n_completions_generation(
+        self,
+        layout_prompter: LayoutPrompter,
+        llm: FakeLayoutChatModel,
+        synthetic_poster_queries: List[ProcessedLayoutData],
+        num_return: int,
+    ):
+        output = self.invoke(
+            layout_prompter,
+            synthetic_poster_queries[0],
+            num_return=num_return,
+            generation_mode="n_completions",
+        )
+        assert len(output.ranked_outputs) == num_return
+        assert all(
+            isinstance(ranked_output, PosterLayoutSerializedOutputData)
+            for ranked_output in output.ranked_outputs
+        )
+        assert llm.num_calls == 1
+
+    @pytest.mark.parametrize(
+        argnames="serialization_format", argvalues=("sequence", "csv", "html")
+    )
+    @pytest.mark.parametrize(
+        argnames="generation_mode", argvalues=("fan_out", "n_completions")
+    )
+    def test_plain_text_generation(
+        self,
+        layout_prompter: LayoutPrompter,
+        llm: FakeLayoutChatModel,
+        synthetic_poster_queries: List[ProcessedLayoutData],
+        num_return: int,
+        serialization_format: SerializationFormat,
+        generation_mode: str,
+    ):
+        llm.text_format = serialization_format
+        output = self.invoke(
+            layout_prompter,
+            synthetic_poster_queries[0],
+            num_return=num_return,
+            generation_mode=generation_mode,
+            serialization_format=serialization_format,
+        )
+        assert len(output.ranked_outputs) == num_return
+        assert all(
+            isinstance(ranked_output, PosterLayoutSerializedOutputData)
+            and ranked_output.layouts
+            for ranked_output in output.ranked_outputs
+        )
+
+        # The few-shot examples are in the same format as the generated layouts
+        example_messages = [
+            message
+            for message in llm._received_messages[0]
+            if isinstance(message, AIMessage)
+        ]
+        assert example_messages
+        for message in example_messages:
+            assert isinstance(message.content, str)
+            parse_layout(
+                message.content,
+                schema=PosterLayoutSerializedOutputData,
+                serialization_format=serialization_format,
+            )
+
+    def test_n_completions_falls_back_to_fan_out(
+        self,
+        layout_prompter: LayoutPrompter,
+        llm: FakeLayoutChatModel,
+        synthetic_poster_queries: List[ProcessedLayoutData],
+        num_return: int,
+    ):
+        llm.supports_n = False
+        output = self.invoke(
+            layout_prompter,
+            synthetic_poster_queries[0],
+            num_return=num_return,
+            generation_mode="n_completions",
+        )
+        assert len(output.ranked_outputs) == num_return
+        assert llm.num_calls == num_return
+
+    @pytest.mark.parametrize(
+        argnames="generation_mode", argvalues=("fan_out", "n_completions")
+    )
+    def test_ainvoke(
+        self,
+        layout_prompter: LayoutPrompter,
+        llm: FakeLayoutChatModel,
+        synthetic_poster_queries: List[ProcessedLayoutData],
+        num_return: int,
+        generation_mode: str,
+    ):
+        output = asyncio.run(
+            layout_prompter.ainvoke(
+                input=synthetic_poster_queries[0],
+                config=self.get_config(
+                    num_return=num_return,
+                    generation_mode=generation_mode,
+                    return_candidates=True,
+                ),
+            )
+        )
+        assert len(output.ranked_outputs) == num_return
+        assert output.selected_candidates is not None
+        assert len(output.selected_candidates) == layout_prompter.selector.num_prompt
+        assert llm.num_calls == (
+            1 if generation_mode == "n_completions" else num_return
+        )
+
+    def test_abatch(
+        self,
+        layout_prompter: LayoutPrompter,
+        llm: FakeLayoutChatModel,
+        synthetic_poster_queries: List[ProcessedLayoutData],
+        num_return: int,
+    ):
+        queries = synthetic_poster_queries[:5]
+        layout_prompter.selector.is_shuffle = False
+        outputs = asyncio.run(
+            layout_prompter.abatch(
+                queries,
+                config={
+                    **self.get_config(num_return=num_return, return_candidates=True),
+                    "max_concurrency": 2,
+                },
+            )
+        )
+        assert len(outputs) == len(queries)
+        assert llm.num_calls == len(queries) * num_return
+        for query, output in zip(queries, outputs):
+            assert len(output.ranked_outputs) == num_return
+            assert (
+                output.selected_candidates
+                == layout_prompter.selector.select_examples(query).selected_examples
+            )
+
+    def test_abatch_return_exceptions(
+        self,
+        layout_prompter: LayoutPrompter,
+        synthetic_poster_queries: List[ProcessedLayoutData],
+    ):
+        configs = [
+            self.get_config(num_return=2),
+            # Fails in the serializer, as the input schema is missing
+            {"configurable": {"output_schema": PosterLayoutSerializedOutputData}},
+        ]
+        outputs = asyncio.run(
+            layout_prompter.abatch(
+                synthetic_poster_queries[:2], config=configs, return_exceptions=True
+            )
+        )
+        assert isinstance(outputs[0], LayoutPrompterOutput)
+        assert isinstance(outputs[1], Exception)
+
+    @pytest.mark.parametrize(
+        argnames="generation_mode", argvalues=("fan_out", "n_completions")
+    )
+    def test_batch(
+        self,
+        layout_prompter: LayoutPrompter,
+        llm: FakeLayoutChatModel,
+        synthetic_poster_queries: List[ProcessedLayoutData],
+        generation_mode: str,
+    ):
+        queries = synthetic_poster_queries[:4]
+        num_returns = [1, 3, 5, 2]
+        layout_prompter.selector.is_shuffle = False
+
+        outputs = layout_prompter.batch(
+            queries,
+            config=[
+                self.get_config(
+                    num_return=num_return,
+                    generation_mode=generation_mode,
+                    return_candidates=True,
+                )
+                for num_return in num_returns
+            ],
+        )
+        assert len(outputs) == len(queries)
+        assert llm.num_calls == (
+            len(queries) if generation_mode == "n_completions" else sum(num_returns)
+        )
+        for query, output, num_return in zip(queries, outputs, num_returns):
+            assert len(output.ranked_outputs) == num_return
+            assert (
+                output.selected_candidates
+                == layout_prompter.selector.select_examples(query).selected_examples
+            )
+
+    def test_batch_uses_single_llm_batch(
+        self,
+        layout_prompter: LayoutPrompter,
+        synthetic_poster_queries: List[ProcessedLayoutData],
+        num_return: int,
+        monkeypatch: pytest.MonkeyPatch,
+    ):
+        batch_sizes: List[int] = []
+        original_batch = RunnableSequence.batch
+
+        def batch(self, inputs, *args, **kwargs):
+            batch_sizes.append(len(inputs))
+            return original_batch(self, inputs, *args, **kwargs)
+
+        monkeypatch.setattr(RunnableSequence, "batch", batch)
+
+        queries = synthetic_poster_queries[:3]
+        outputs = layout_prompter.batch(
+            queries, config=self.get_config(num_return=num_return)
+        )
+        assert len(outputs) == len(queries)
+        assert batch_sizes == [len(queries) * num_return]
+
+    def test_batch_max_concurrency_per_config(
+        self,
+        layout_prompter: LayoutPrompter,
+        synthetic_poster_queries: List[ProcessedLayoutData],
+        monkeypatch: pytest.MonkeyPatch,
+    ):
+        batch_limits: List[Optional[int]] = []
+        original_batch = RunnableSequence.batch
+
+        def batch(self, inputs, config=None, *args, **kwargs):
+            batch_limits.append(config["max_concurrency"])
+            return original_batch(self, inputs, config, *args, **kwargs)
+
+        monkeypatch.setattr(RunnableSequence, "batch", batch)
+
+        outputs = layout_prompter.batch(
+            synthetic_poster_queries[:3],
+            config=[
+                self.get_config(num_return=2, max_concurrency=max_concurrency)
+                for max_concurrency in (1, 3, 1)
+            ],
+        )
+        assert len(outputs) == 3
+        assert sorted(batch_limits) == [1, 3]
+
+    def test_abatch_max_concurrency_per_config(
+        self,
+        layout_prompter: LayoutPrompter,
+        synthetic_poster_queries: List[ProcessedLayoutData],
+        monkeypatch: pytest.MonkeyPatch,
+    ):
+        group_sizes: Dict[Optional[int], int] = {}
+
+        async def gather_with_concurrency(n, *coros):
+            group_sizes[n] = len(coros)
+            return await asyncio.gather(*coros)
+
+        monkeypatch.setattr(
+            layout_prompter_module, "gather_with_concurrency", gather_with_concurrency
+        )
+
+        queries = synthetic_poster_queries[:3]
+        configs: List[RunnableConfig] = [
+            {**self.get_config(num_return=2), "max_concurrency": max_concurrency}
+            for max_concurrency in (1, 2, 1)
+        ]
+        outputs = asyncio.run(layout_prompter.abatch(queries, config=configs))
+        assert all(isinstance(output, LayoutPrompterOutput) for output in outputs)
+        assert group_sizes == {1: 2, 2: 1}
+
+    @pytest.mark.parametrize(
+        argnames="generation_mode", argvalues=("fan_out", "n_completions")
+    )
+    def test_stream(
+        self,
+        layout_prompter: LayoutPrompter,
+        llm: FakeLayoutChatModel,
+        synthetic_poster_queries: List[ProcessedLayoutData],
+        num_return: int,
+        generation_mode: str,
+    ):
+        events = []
+        num_calls_at_first_event = None
+        for event in layout_prompter.stream(
+            synthetic_poster_queries[0],
+            config=self.get_config(
+                num_return=num_return,
+                generation_mode=generation_mode,
+                max_concurrency=1,
+            ),
+        ):
+            if num_calls_at_first_event is None:
+                num_calls_at_first_event = llm.num_calls
+            events.append(event)
+
+        assert len(events) == num_return + 1
+        assert all(not event.is_final for event in events[:-1])
+        assert events[-1].is_final and events[-1].final_output is not None
+
+        generated_outputs = [event.generated_output for event in events[:-1]]
+        ranked_outputs = events[-1].final_output.ranked_outputs
+        assert sorted(map(id, ranked_outputs)) == sorted(map(id, generated_outputs))
+
+        # The first layout is yielded before all the generations are completed
+        if generation_mode == "fan_out":
+            assert num_calls_at_first_event is not None
+            assert num_calls_at_first_event < num_return
+
+    def test_astream(
+        self,
+        layout_prompter: LayoutPrompter,
+        synthetic_poster_queries: List[ProcessedLayoutData],
+        num_return: int,
+    ):
+        async def collect() -> List[LayoutPrompterStreamEvent]:
+            return [
+                event
+                async for event in layout_prompter.astream(
+                    synthetic_poster_queries[0],
+                    config=self.get_config(num_return=num_return),
+                )
+            ]
+
+        events = asyncio.run(collect())
+        assert len(events) == num_return + 1
+        assert all(event.generated_output is not None for event in events[:-1])
+        assert events[-1].final_output is not None
+        assert len(events[-1].final_output.ranked_outputs) == num_return
+
+    def test_early_exit(
+        self,
+        layout_prompter: LayoutPrompter,
+        llm: FakeLayoutChatModel,
+        synthetic_poster_queries: List[ProcessedLayoutData],
+        num_return: int,
+    ):
+        # Without thresholds, every non-empty layout is acceptable
+        output = self.invoke(
+            layout_prompter,
+            synthetic_poster_queries[0],
+            num_return=num_return,
+            max_concurrency=1,
+            early_exit_num_layouts=2,
+        )
+        assert len(output.ranked_outputs) == 2
+        assert llm.num_calls < num_return
+
+    def test_early_exit_unsatisfied(
+        self,
+        layout_prompter: LayoutPrompter,
+        llm: FakeLayoutChatModel,
+        synthetic_poster_queries: List[ProcessedLayoutData],
+        num_return: int,
+    ):
+        # No layout can satisfy a negative overlap threshold
+        output = self.invoke(
+            layout_prompter,
+            synthetic_poster_queries[0],
+            num_return=num_return,
+            early_exit_num_layouts=1,
+            early_exit_max_overlap=-1.0,
+        )
+        assert len(output.ranked_outputs) == num_return
+        assert llm.num_calls == num_return
+
+    def test_early_exit_async(
+        self,
+        layout_prompter: LayoutPrompter,
+        llm: FakeLayoutChatModel,
+        synthetic_poster_queries: List[ProcessedLayoutData],
+        num_return: int,
+    ):
+        output = asyncio.run(
+            layout_prompter.ainvoke(
+                synthetic_poster_queries[0],
+                config=self.get_config(
+                    num_return=num_return,
+                    max_concurrency=1,
+                    early_exit_num_layouts=3,
+                ),
+            )
+        )
+        assert len(output.ranked_outputs) == 3
+        assert llm.num_calls < num_return
+
+    def test_early_exit_stream(
+        self,
+        layout_prompter: LayoutPrompter,
+        llm: FakeLayoutChatModel,
+        synthetic_poster_queries: List[ProcessedLayoutData],
+        num_return: int,
+    ):
+        config = self.get_config(
+            num_return=num_return, max_concurrency=1, early_exit_num_layouts=2
+        )
+        events = list(layout_prompter.stream(synthetic_poster_queries[0], config))
+        assert len(events) == 3
+        assert events[-1].final_output is not None
+        assert len(events[-1].final_output.ranked_outputs) == 2
+        assert llm.num_calls < num_return
+
+        async def collect() -> List[LayoutPrompterStreamEvent]:
+            return [
+                event
+                async for event in layout_prompter.astream(
+                    synthetic_poster_queries[0], config
+                )
+            ]
+
+        events = asyncio.run(collect())
+        assert len(events) == 3
+        assert events[-1].final_output is not None
+        assert len(events[-1].final_output.ranked_outputs) == 2
+
+    def test_early_exit_requires_fan_out(
+        self,
+        layout_prompter: LayoutPrompter,
+        synthetic_poster_queries: List[ProcessedLayoutData],
+        num_return: int,
+    ):
+        with pytest.raises(ValueError, match="early exit"):
+            self.invoke(
+                layout_prompter,
+                synthetic_poster_queries[0],
+                num_return=num_return,
+                generation_mode="n_completions",
+                early_exit_num_layouts=1,
+            )
+
+    def test_early_exit_batch(
+        self,
+        layout_prompter: LayoutPrompter,
+        synthetic_poster_queries: List[ProcessedLayoutData],
+        num_return: int,
+    ):
+        outputs = layout_prompter.batch(
+            synthetic_poster_queries[:2],
+            config=[
+                self.get_config(num_return=num_return, early_exit_num_layouts=1),
+                self.get_config(num_return=num_return),
+            ],
+        )
+        assert len(outputs[0].ranked_outputs) < num_return
+        assert len(outputs[1].ranked_outputs) == num_return
+
+    @pytest.fixture
+    def generation_cache(self, tmp_path: pathlib.Path) -> SQLiteGenerationCache:
+        return SQLiteGenerationCache(database_path=tmp_path / "generations.sqlite")
+
+    @pytest.fixture
+    def cached_layout_prompter(
+        self,
+        synthetic_poster_layouts: List[ProcessedLayoutData],
+        llm: FakeLayoutChatModel,
+        generation_cache: SQLiteGenerationCache,
+    ) -> LayoutPrompter:
+        # The prompts must be deterministic to be served from the cache
+        return LayoutPrompter(
+            selector=ContentAwareSelector(
+                examples=synthetic_poster_layouts, is_shuffle=False
+            ),
+            serializer=ContentAwareSerializer(
+                layout_domain=PosterLayoutSettings().domain
+            ),
+            llm=llm,
+            ranker=LayoutPrompterRanker(),
+            generation_cache=generation_cache,
+        )
+
+    @pytest.mark.parametrize(
+        argnames="generation_mode", argvalues=("fan_out", "n_completions")
+    )
+    def test_generation_cache(
+        self,
+        cached_layout_prompter: LayoutPrompter,
+        llm: FakeLayoutChatModel,
+        generation_cache: SQLiteGenerationCache,
+        synthetic_poster_queries: List[ProcessedLayoutData],
+        num_return: int,
+        generation_mode: str,
+    ):
+        query = synthetic_poster_queries[0]
+        output = self.invoke(
+            cached_layout_prompter,
+            query,
+            num_return=num_return,
+            generation_mode=generation_mode,
+        )
+        num_calls = llm.num_calls
+        assert (generation_cache.hits, generation_cache.misses) == (0, num_return)
+
+        # The re-run is served from the cache without any LLM call
+        cached_output = self.invoke(
+            cached_layout_prompter,
+            query,
+            num_return=num_return,
+            generation_mode=generation_mode,
+        )
+        assert llm.num_calls == num_calls
+        assert generation_cache.hits == num_return
+        assert cached_output.ranked_outputs == output.ranked_outputs
+
+        # Only the samples missing from the cache are generated
+        output = self.invoke(
+            cached_layout_prompter,
+            query,
+            num_return=num_return + 3,
+            generation_mode=generation_mode,
+        )
+        assert len(output.ranked_outputs) == num_return + 3
+        assert llm.num_calls == num_calls + (3 if generation_mode == "fan_out" else 1)
+
+    def test_generation_cache_batch_and_stream(
+        self,
+        cached_layout_prompter: LayoutPrompter,
+        llm: FakeLayoutChatModel,
+        generation_cache: SQLiteGenerationCache,
+        synthetic_poster_queries: List[ProcessedLayoutData],
+        num_return: int,
+    ):
+        queries = synthetic_poster_queries[:2]
+        outputs = cached_layout_prompter.batch(
+            queries, config=self.get_config(num_return=num_return)
+        )
+        assert llm.num_calls == len(queries) * num_return
+
+        events = list(
+            cached_layout_prompter.stream(
+                queries[0], config=self.get_config(num_return=num_return)
+            )
+        )
+        final_output = events[-1].final_output
+        assert final_output is not None
+        assert final_output.ranked_outputs == outputs[0].ranked_outputs
+
+        async_outputs = asyncio.run(
+            cached_layout_prompter.abatch(
+                queries, config=self.get_config(num_return=num_return)
+            )
+        )
+        assert [output.ranked_outputs for output in async_outputs] == [
+            output.ranked_outputs for output in outputs
+        ]
+        assert llm.num_calls == len(queries) * num_return
+        assert generation_cache.hit_rate == pytest.approx(0.6)
+
+    def test_generation_cache_early_exit(
+        self,
+        cached_layout_prompter: LayoutPrompter,
+        generation_cache: SQLiteGenerationCache,
+        synthetic_poster_queries: List[ProcessedLayoutData],
+        num_return: int,
+    ):
+        config = self.get_config(
+            num_return=num_return, max_concurrency=1, early_exit_num_layouts=2
+        )
+        output = cached_layout_prompter.invoke(synthetic_poster_queries[0], config)
+        assert len(generation_cache) == len(output.ranked_outputs)
+
+        # The cached layouts are enough for the early exit, so nothing is generated.
+        # The LLM calls are not counted, as a cancelled fan-out may still be finishing.
+        cached_output = cached_layout_prompter.invoke(
+            synthetic_poster_queries[0], config
+        )
+        assert len(generation_cache) == len(output.ranked_outputs)
+        assert cached_output.ranked_outputs == output.ranked_outputs
@@ -0,0 +1,75 @@
+import pathlib
+from typing import List
+
+import pytest
+
+from layout_prompter.modules.caches import SQLiteGenerationCache
+from layout_prompter.utils.testing import LayoutPrompterTestCase
+
+
+class TestSQLiteGenerationCache(LayoutPrompterTestCase):
+    @pytest.fixture
+    def database_path(self, tmp_path: pathlib.Path) -> pathlib.Path:
+        return tmp_path / "cache" / "generations.sqlite"
+
+    def test_lookup_and_update(self, database_path: pathlib.Path):
+        cache = SQLiteGenerationCache(database_path=database_path)
+        assert cache.lookup(["a", "b"]) == [None, None]
+
+        cache.update({"a": "1", "b": "2"})
+        assert cache.lookup(["b", "c", "a"]) == ["2", None, "1"]
+        assert len(cache) == 2
+
+        assert (cache.hits, cache.misses) == (2, 3)
+        assert cache.hit_rate == pytest.approx(0.4)
+
+    def test_lru_eviction(self, database_path: pathlib.Path):
+        cache = SQLiteGenerationCache(database_path=database_path, max_entries=2)
+        cache.update({"a": "1"})
+        cache.update({"b": "2"})
+
+        # "a" is used more recently than "b", so "b" is evicted
+        assert cache.lookup(["a"]) == ["1"]
+        cache.update({"c": "3"})
+        assert len(cache) == 2
+        assert cache.lookup(["a", "b", "c"]) == ["1", None, "3"]
+
+    def test_update_existing_keys(self, database_path: pathlib.Path):
+        cache = SQLiteGenerationCache(database_path=database_path, max_entries=2)
+        cache.update({"a": "1", "b": "2"})
+
+        statements: List[str] = []
+        cache.connection.set_trace_callback(statements.append)
+        # Overwriting the existing keys neither evicts nor counts the entries
+        cache.update({"a": "3", "b": "4"})
+        cache.connection.set_trace_callback(None)
+
+        assert not any("COUNT" in statement for statement in statements)
+        assert not any("DELETE" in statement for statement in statements)
+        assert len(cache) == 2
+        assert cache.lookup(["a", "b"]) == ["3", "4"]
+
+    def test_eviction_after_reopening(self, database_path: pathlib.Path):
+        cache = SQLiteGenerationCache(database_path=database_path, max_entries=3)
+        cache.update({"a": "1", "b": "2", "c": "3"})
+        cache.close()
+
+        # The number of entries is restored from the database
+        reopened = SQLiteGenerationCache(database_path=database_path, max_entries=3)
+        reopened.update({"d": "4", "e": "5"})
+        assert len(reopened) == 3
+        assert reopened.lookup(["d", "e"]) == ["4", "5"]
+
+    def test_persistence(self, database_path: pathlib.Path):
+        cache = SQLiteGenerationCache(database_path=database_path)
+        cache.update({f"key-{i}": str(i) for i in range(2000)})
+        cache.close()
+
+        reopened = SQLiteGenerationCache(database_path=database_path)
+        keys = [f"key-{i}" for i in range(2000)]
+        assert reopened.lookup(keys) == [str(i) for i in range(2000)]
+
+        reopened.clear()
+        assert len(reopened) == 0
+        # The counters are kept
+        assert reopened.hits == 2000
@@ -0,0 +1,177 @@
+from typing import List, Sequence, Tuple
+
+import numpy as np
+import pytest
+from PIL import Image
+from pydantic import ValidationError
+
+from layout_prompter.models import ProcessedLayoutData
+from layout_prompter.models.layout_data import Bbox
+from layout_prompter.models.serialized_data import (
+    PosterLayoutSerializedData,
+    PosterLayoutSerializedOutputData,
+)
+from layout_prompter.modules.rankers import ContentAwareRanker
+from layout_prompter.utils import pil_to_base64
+
+
+def to_output_data(
+    elements: Sequence[Tuple[str, Tuple[int, int, int, int]]],
+) -> PosterLayoutSerializedOutputData:
+    return PosterLayoutSerializedOutputData(
+        layouts=[
+            PosterLayoutSerializedData(
+                class_name=class_name,
+                bbox=Bbox(left=left, top=top, width=width, height=height),
+            )
+            for class_name, (left, top, width, height) in elements
+        ]
+    )
+
+
+@pytest.fixture
+def content_bbox() -> Bbox:
+    return Bbox(left=0, top=0, width=50, height=60)
+
+
+@pytest.fixture
+def query(
+    synthetic_poster_queries: List[ProcessedLayoutData], content_bbox: Bbox
+) -> ProcessedLayoutData:
+    """Create a query whose left-top region of the canvas is salient."""
+    return synthetic_poster_queries[0].model_copy(
+        update={"discrete_content_bboxes": [content_bbox], "encoded_image": None}
+    )
+
+
+@pytest.fixture
+def random_serialized_data() -> List[PosterLayoutSerializedOutputData]:
+    """Create random layouts with varying numbers of elements."""
+    rng = np.random.default_rng(0)
+    return [
+        to_output_data(
+            [
+                (
+                    str(rng.choice(["text", "logo", "underlay"])),
+                    tuple(int(v) for v in ltwh),
+                )
+                for ltwh in rng.integers(0, 80, size=(int(rng.integers(1, 11)), 4))
+            ]
+        )
+        for _ in range(100)
+    ]
+
+
+class TestContentAwareRanker:
+    def test_ranker_initialization(self):
+        """Test ranker can be initialized with default parameters."""
+        ranker = ContentAwareRanker()
+        assert ranker.name == "content-aware-ranker"
+
+        with pytest.raises(ValidationError):
+            ContentAwareRanker(lam_occ=0.5, lam_uti=0.5, lam_und=0.5, lam_rea=0.5)
+
+    def test_occlusion_and_utility(self, query, content_bbox, random_serialized_data):
+        """Test the occlusion and the utility against a per-pixel computation."""
+        ranker = ContentAwareRanker()
+        metrics = ranker.calculate_metrics_batch(random_serialized_data, query)
+        assert metrics.shape == (len(random_serialized_data), 4)
+
+        canvas_size = query.canvas_size
+        saliency_map = np.zeros((canvas_size.height, canvas_size.width), dtype=bool)
+        saliency_map[
+            content_bbox.top : content_bbox.bottom,
+            content_bbox.left : content_bbox.right,
+        ] = True
+        for data, (occ, uti, _, rea) in zip(random_serialized_data, metrics):
+            mask = np.zeros_like(saliency_map)
+            for layout in data.layouts:
+                mask[
+                    layout.bbox.top : layout.bbox.bottom,
+                    layout.bbox.left : layout.bbox.right,
+                ] = True
+            assert occ == pytest.approx(
+                (mask & saliency_map).sum() / saliency_map.sum()
+            )
+            assert uti == pytest.approx(
+                (mask & ~saliency_map).sum() / (~saliency_map).sum()
+            )
+            # The readability requires the image
+            assert rea == 0.0
+
+        # The results do not depend on the batch size
+        np.testing.assert_allclose(
+            ContentAwareRanker(batch_size=7).calculate_metrics_batch(
+                random_serialized_data, query
+            ),
+            metrics,
+        )
+
+    def test_underlay_effectiveness(self, query):
+        """Test that underlays are effective when they contain other elements."""
+        ranker = ContentAwareRanker()
+        data_list = [
+            # The underlay contains the text
+            to_output_data([("underlay", (0, 0, 40, 40)), ("text", (10, 10, 10, 10))]),
+            # The underlay contains half of the text
+            to_output_data([("underlay", (0, 0, 15, 40)), ("text", (10, 10, 10, 10))]),
+            # The underlay is disjoint from the text
+            to_output_data([("underlay", (0, 0, 5, 5)), ("text", (10, 10, 10, 10))]),
+            # No underlay
+            to_output_data([("text", (10, 10, 10, 10))]),
+        ]
+        metrics = ranker.calculate_metrics_batch(data_list, query)
+        np.testing.assert_allclose(metrics[:, 2], [1.0, 0.5, 0.0, 1.0])
+
+    def test_readability(self, query):
+        """Test that texts on busy backgrounds are less readable."""
+        canvas_size = query.canvas_size
+        image = np.zeros((canvas_size.height, canvas_size.width), dtype=np.uint8)
+        # Noise on the right half, flat on the left half
+        rng = np.random.default_rng(0)
+        image[:, canvas_size.width // 2 :] = rng.integers(
+            0,
+            256,
+            size=(canvas_size.height, canvas_size.width - canvas_size.width // 2),
+        )
+        query = query.model_copy(
+            update={"encoded_image": pil_to_base64(Image.fromarray(image))}
+        )
+
+        ranker = ContentAwareRanker()
+        data_list = [
+            to_output_data([("text", (10, 70, 20, 20))]),
+            to_output_data([("text", (70, 70, 20, 20))]),
+            # Only the texts are considered
+            to_output_data([("logo", (70, 70, 20, 20))]),
+        ]
+        rea = ranker.calculate_metrics_batch(data_list, query)[:, 3]
+        assert rea[0] == 0.0
+        assert 0.0 < rea[1] <= 1.0
+        assert rea[2] == 0.0
+
+    def test_invoke(self, query, content_bbox, random_serialized_data):
+        """Test that the layouts are ranked by the occlusion, stably for ties."""
+        ranker = ContentAwareRanker(lam_occ=1.0, lam_uti=0.0, lam_und=0.0, lam_rea=0.0)
+        occluding_data = to_output_data(
+            [("text", (0, 0, content_bbox.width, content_bbox.height))]
+        )
+        outside_data = to_output_data([("text", (60, 80, 20, 20))])
+
+        candidates = [outside_data, *random_serialized_data, occluding_data]
+        result = ranker.invoke(candidates, query=query)
+        assert len(result) == len(candidates)
+        assert result[0] is outside_data
+        assert result[-1] is occluding_data
+
+    def test_invoke_requires_query(self, random_serialized_data):
+        """Test that the query is required."""
+        with pytest.raises(ValueError, match="requires the query"):
+            ContentAwareRanker().invoke(random_serialized_data)
+
+    def test_empty_layouts(self, query):
+        """Test that empty layouts are rejected."""
+        with pytest.raises(ValueError, match="empty layouts"):
+            ContentAwareRanker().calculate_metrics_batch(
+                [PosterLayoutSerializedOutputData(layouts=[])], query
+            )
@@ -1,7 +1,12 @@
+import time
+from typing import List
 from unittest.mock import Mock
 
+import numpy as np
 import pytest
+from loguru import logger
 
+from layout_prompter.models import CanvasSize, ProcessedLayoutData
 from layout_prompter.models.layout_data import Bbox
 from layout_prompter.models.serialized_data import (
     PosterLayoutSerializedData,
@@ -39,6 +44,34 @@ def sample_serialized_data(sample_layouts):
     ]
 
 
+@pytest.fixture
+def random_serialized_data() -> List[PosterLayoutSerializedOutputData]:
+    """Create random layouts with varying numbers of elements."""
+    rng = np.random.default_rng(0)
+    data = []
+    for _ in range(1000):
+        num_elements = int(rng.integers(1, 11))
+        data.append(
+            PosterLayoutSerializedOutputData(
+                layouts=[
+                    PosterLayoutSerializedData(
+                        class_name=str(rng.choice(["text", "logo", "underlay"])),
+                        bbox=Bbox(
+                            left=int(left),
+                            top=int(top),
+                            width=int(width),
+                            height=int(height),
+                        ),
+                    )
+                    for left, top, width, height in rng.integers(
+                        0, 100, size=(num_elements, 4)
+                    )
+                ]
+            )
+        )
+    return data
+
+
 class TestLayoutPrompterRanker:
     def test_ranker_initialization(self):
         """Test ranker can be initialized with default parameters."""
@@ -185,3 +218,252 @@ class TestLayoutPrompterRanker:
         # All inputs have empty layouts, should raise ValueError
         with pytest.raises(ValueError):
             ranker.invoke([empty_data1, empty_data2])
+
+    def test_calculate_metrics_batch(self, random_serialized_data):
+        """Test that the batched metrics equal the metrics of each layout."""
+        ranker = LayoutPrompterRanker(batch_size=64)
+        expected = np.array(
+            [ranker.calculate_metrics(data) for data in random_serialized_data]
+        )
+
+        metrics = ranker.calculate_metrics_batch(random_serialized_data)
+        assert metrics.shape == (len(random_serialized_data), 2)
+        np.testing.assert_allclose(metrics, expected, rtol=1e-12)
+
+        # The sorted alignment and the blocked overlap give the same metrics
+        ranker = LayoutPrompterRanker(
+            batch_size=64, alignment_method="sorted", overlap_block_size=3
+        )
+        np.testing.assert_allclose(
+            ranker.calculate_metrics_batch(random_serialized_data), metrics, rtol=1e-12
+        )
+        np.testing.assert_allclose(
+            ranker.calculate_metrics(random_serialized_data[0]),
+            expected[0],
+            rtol=1e-12,
+        )
+
+    def test_calculate_metrics_normalized(self, sample_serialized_data):
+        """Test that the metrics are computed on the bboxes normalized by the canvas."""
+        ranker = LayoutPrompterRanker()
+        data = sample_serialized_data[0]
+        canvas_size = CanvasSize(width=200, height=150)
+
+        # The distances between the elements in pixels are all >= 1
+        ali_score, ove_score = ranker.calculate_metrics(data)
+        assert ali_score == 0.0
+
+        normalized_ali_score, normalized_ove_score = ranker.calculate_metrics(
+            data, canvas_size=canvas_size
+        )
+        assert normalized_ali_score > 0.0
+        # The overlap is a ratio of areas, so it does not depend on the scale
+        assert normalized_ove_score == pytest.approx(ove_score)
+
+    def test_calculate_metrics_batch_empty_layouts(self, sample_layouts):
+        """Test that the batched metrics reject empty layouts as well."""
+        ranker = LayoutPrompterRanker()
+        with pytest.raises(ValueError, match="empty layouts"):
+            ranker.calculate_metrics_batch(
+                [
+                    PosterLayoutSerializedOutputData(layouts=sample_layouts),
+                    PosterLayoutSerializedOutputData(layouts=[]),
+                ]
+            )
+
+    def test_batch_ranking_benchmark(self, random_serialized_data):
+        """Report the time of the per-layout metrics and the batched metrics."""
+        ranker = LayoutPrompterRanker()
+
+        start = time.perf_counter()
+        for data in random_serialized_data:
+            ranker.calculate_metrics(data)
+        per_layout_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        ranker.calculate_metrics_batch(random_serialized_data)
+        batch_time = time.perf_counter() - start
+
+        logger.info(
+            f"Metrics of {len(random_serialized_data)} layouts: "
+            f"{per_layout_time * 1e3:.1f} ms (per layout) -> "
+            f"{batch_time * 1e3:.1f} ms (batched)"
+        )
+
+    def to_output_data(self, labels, bboxes) -> PosterLayoutSerializedOutputData:
+        return PosterLayoutSerializedOutputData(
+            layouts=[
+                PosterLayoutSerializedData(class_name=label, bbox=bbox)
+                for label, bbox in zip(labels, bboxes)
+            ]
+        )
+
+    @pytest.fixture
+    def query(
+        self, synthetic_poster_queries: List[ProcessedLayoutData]
+    ) -> ProcessedLayoutData:
+        return synthetic_poster_queries[0]
+
+    @pytest.fixture
+    def hand_built_data(self) -> List[PosterLayoutSerializedOutputData]:
+        """Create a few layouts in the lower right of the canvas."""
+        return [
+            self.to_output_data(
+                ["text", "logo"],
+                [
+                    Bbox(left=60, top=100, width=20, height=10),
+                    Bbox(left=60, top=120, width=30, height=20),
+                ],
+            ),
+            self.to_output_data(
+                ["underlay", "text"],
+                [
+                    Bbox(left=55, top=95, width=40, height=40),
+                    Bbox(left=60, top=100, width=20, height=10),
+                ],
+            ),
+            self.to_output_data(
+                ["logo"], [Bbox(left=70, top=110, width=15, height=15)]
+            ),
+        ]
+
+    def test_iou_with_constant_metrics(self, query):
+        """Test that constant metrics do not prevent the ranking by the IoU term."""
+        content_bbox = Bbox(left=0, top=0, width=50, height=50)
+        query = query.model_copy(update={"discrete_content_bboxes": [content_bbox]})
+        ranker = LayoutPrompterRanker()
+
+        # Single elements have no alignment partner and no overlap
+        occluding_data = self.to_output_data(
+            ["text"], [Bbox(left=0, top=0, width=50, height=25)]
+        )
+        outside_data = self.to_output_data(
+            ["text"], [Bbox(left=60, top=80, width=20, height=20)]
+        )
+        np.testing.assert_array_equal(
+            ranker.calculate_metrics_batch([occluding_data, outside_data]),
+            np.zeros((2, 2)),
+        )
+        iou = ranker.calculate_iou_batch([occluding_data, outside_data], query)
+        assert iou is not None
+        assert iou[0] == pytest.approx(0.5)
+        assert iou[1] == 0.0
+
+        assert ranker.invoke([occluding_data, outside_data], query=query) == [
+            outside_data,
+            occluding_data,
+        ]
+        assert ranker.invoke([outside_data, occluding_data], query=query) == [
+            outside_data,
+            occluding_data,
+        ]
+
+    def test_iou_with_gold_bboxes(self, query, hand_built_data):
+        """Test that the layout matching the gold bboxes ranks first if opted in."""
+        assert query.labels is not None and query.discrete_gold_bboxes is not None
+        ranker = LayoutPrompterRanker(iou_target="gold")
+        gold_data = self.to_output_data(query.labels, query.discrete_gold_bboxes)
+        # The labels must match as well
+        assert "text" not in query.labels
+        mislabeled_data = self.to_output_data(
+            ["text"] * len(query.labels), query.discrete_gold_bboxes
+        )
+
+        iou = ranker.calculate_iou_batch(
+            [gold_data, mislabeled_data, *hand_built_data], query
+        )
+        assert iou is not None and iou.shape == (5,)
+        assert iou[0] == pytest.approx(1.0)
+        assert iou[1] == 0.0
+        assert np.all((0.0 <= iou) & (iou <= 1.0))
+
+        candidates = [*hand_built_data, gold_data]
+        result = ranker.invoke(candidates, query=query)
+        assert result[0] is gold_data
+        # Without the query, the IoU term is not used
+        assert ranker.invoke(candidates) == LayoutPrompterRanker(
+            lam_ali=0.2, lam_ove=0.2, lam_iou=0.6
+        ).invoke(candidates)
+
+    def test_iou_with_content_bboxes(self, query, hand_built_data):
+        """Test that the layout occluding the content bboxes ranks last."""
+        content_bbox = Bbox(left=0, top=0, width=50, height=50)
+        query = query.model_copy(update={"discrete_content_bboxes": [content_bbox]})
+        ranker = LayoutPrompterRanker(lam_ali=0.0, lam_ove=0.0, lam_iou=1.0)
+
+        occluding_data = self.to_output_data(["text"], [content_bbox])
+        outside_data = self.to_output_data(
+            ["text"], [Bbox(left=60, top=80, width=20, height=20)]
+        )
+        iou = ranker.calculate_iou_batch([occluding_data, outside_data], query)
+        assert iou is not None
+        assert iou[0] == pytest.approx(1.0)
+        assert iou[1] == 0.0
+
+        result = ranker.invoke(
+            [occluding_data, outside_data, *hand_built_data], query=query
+        )
+        assert result[-1] is occluding_data
+        assert result.index(outside_data) < result.index(occluding_data)
+
+    def test_iou_without_reference_bboxes(self, query, sample_serialized_data):
+        """Test that the IoU term is skipped if the query has no reference bboxes."""
+        ranker = LayoutPrompterRanker(iou_target="content")
+        query = query.model_copy(update={"discrete_content_bboxes": None})
+        assert ranker.calculate_iou_batch(sample_serialized_data, query) is None
+
+    def test_auto_iou_does_not_use_gold_bboxes(self, query, hand_built_data):
+        """Test that the gold bboxes of the query are not used unless opted in."""
+        assert query.labels is not None and query.discrete_gold_bboxes is not None
+        query = query.model_copy(update={"discrete_content_bboxes": None})
+        ranker = LayoutPrompterRanker()
+        gold_data = self.to_output_data(query.labels, query.discrete_gold_bboxes)
+        candidates = [*hand_built_data, gold_data]
+
+        assert ranker.calculate_iou_batch(candidates, query) is None
+        assert ranker.invoke(candidates, query=query) == ranker.invoke(candidates)
+
+    def test_iou_with_reference_layouts(
+        self, query, synthetic_poster_queries, hand_built_data
+    ):
+        """Test that the layout matching a reference layout ranks first."""
+        reference_layouts = synthetic_poster_queries[1:6]
+        reference = reference_layouts[3]
+        assert reference.labels is not None
+        assert reference.discrete_gold_bboxes is not None
+        reference_data = self.to_output_data(
+            reference.labels, reference.discrete_gold_bboxes
+        )
+        candidates = [*hand_built_data, reference_data]
+
+        # "auto" uses the reference layouts for queries without content
+        query = query.model_copy(update={"discrete_content_bboxes": None})
+        ranker = LayoutPrompterRanker(reference_layouts=reference_layouts)
+        iou = ranker.calculate_iou_batch(candidates, query)
+        assert iou is not None and iou.shape == (4,)
+        assert iou[-1] == pytest.approx(1.0)
+        assert np.all((0.0 <= iou) & (iou <= 1.0))
+
+        # The best reference is used, e.g., a single reference gives lower scores
+        single_ranker = LayoutPrompterRanker(
+            iou_target="reference", reference_layouts=reference_layouts[:1]
+        )
+        single_iou = single_ranker.calculate_iou_batch(candidates)
+        assert single_iou is not None
+        assert np.all(single_iou <= iou)
+
+        # The results do not depend on the batch size
+        np.testing.assert_allclose(
+            LayoutPrompterRanker(
+                reference_layouts=reference_layouts, batch_size=2
+            ).calculate_iou_batch(candidates, query),
+            iou,
+        )
+
+        result = ranker.invoke(candidates, query=query)
+        assert result[0] is reference_data
+
+    def test_reference_iou_target_requires_reference_layouts(self):
+        """Test that the reference IoU target requires the reference layouts."""
+        with pytest.raises(Exception):  # Pydantic raises ValidationError
+            LayoutPrompterRanker(iou_target="reference")
@@ -0,0 +1,197 @@
+import time
+from typing import Callable, List, Set, Tuple, cast
+
+import numpy as np
+import pytest
+from loguru import logger
+
+from layout_prompter.models import ProcessedLayoutData
+from layout_prompter.modules.selectors import ContentAwareSelector, IVFBackend
+from layout_prompter.modules.selectors.ann import compute_occupancy_descriptors
+from layout_prompter.utils.testing import LayoutPrompterTestCase
+
+
+def test_compute_occupancy_descriptors():
+    binary_images = np.zeros((2, 4, 6), dtype=np.uint8)
+    binary_images[0, :2, :3] = 255
+    binary_images[1, :, 5] = 255
+
+    descriptors = compute_occupancy_descriptors(binary_images, grid_size=2)
+
+    assert descriptors.shape == (2, 4)
+    assert descriptors[0].tolist() == [1.0, 0.0, 0.0, 0.0]
+    assert descriptors[1].tolist() == pytest.approx([0.0, 1 / 3, 0.0, 1 / 3])
+
+
+class TestIVFBackend(LayoutPrompterTestCase):
+    @pytest.fixture
+    def descriptors(self) -> np.ndarray:
+        rng = np.random.default_rng(0)
+        return rng.random((300, 16)).astype(np.float32)
+
+    def test_search_probing_all_lists(self, descriptors: np.ndarray):
+        backend = IVFBackend(num_lists=8, num_probes=8)
+        backend.add(descriptors)
+
+        query = descriptors[0] + 0.01
+        distances = ((descriptors - query) ** 2).sum(axis=1)
+
+        # Probing every list is equivalent to the exhaustive search
+        indices = backend.search(query, k=10)
+        assert set(indices.tolist()) == set(np.argsort(distances)[:10].tolist())
+
+    def test_add_after_training(self, descriptors: np.ndarray):
+        backend = IVFBackend(num_lists=8, num_probes=8)
+        backend.add(descriptors[:200])
+        backend.train()
+        assert backend.is_trained
+
+        backend.add(descriptors[200:])
+        assert len(backend) == len(descriptors)
+        assert set(backend.search(descriptors[250], k=1).tolist()) == {250}
+
+    def test_search_empty(self):
+        backend = IVFBackend()
+        assert backend.search(np.zeros((16,)), k=10).shape == (0,)
+
+
+class TestANNContentAwareSelector(LayoutPrompterTestCase):
+    @pytest.fixture
+    def num_prompt(self) -> int:
+        return 10
+
+    def test_exhaustive_probing_matches_exhaustive_selector(
+        self,
+        synthetic_poster_layouts: List[ProcessedLayoutData],
+        synthetic_poster_queries: List[ProcessedLayoutData],
+        num_prompt: int,
+    ):
+        exhaustive_selector = ContentAwareSelector(
+            examples=synthetic_poster_layouts, num_prompt=num_prompt, is_shuffle=False
+        )
+        ann_selector = ContentAwareSelector(
+            examples=synthetic_poster_layouts,
+            num_prompt=num_prompt,
+            is_shuffle=False,
+            ann_backend=IVFBackend(
+                num_lists=4,
+                num_probes=4,
+                shortlist_size=len(synthetic_poster_layouts),
+            ),
+        )
+        for query in synthetic_poster_queries:
+            assert (
+                ann_selector.select_examples(query).selected_examples
+                == exhaustive_selector.select_examples(query).selected_examples
+            )
+
+    def test_register_in_blocks(
+        self,
+        synthetic_poster_layouts: List[ProcessedLayoutData],
+        num_prompt: int,
+    ):
+        selector = ContentAwareSelector(
+            examples=synthetic_poster_layouts,
+            num_prompt=num_prompt,
+            ann_backend=IVFBackend(),
+        )
+        # The examples are rasterized and embedded a few at a time
+        blocked_selector = ContentAwareSelector(
+            examples=synthetic_poster_layouts,
+            num_prompt=num_prompt,
+            ann_backend=IVFBackend(),
+            batch_block_size=7,
+        )
+        assert selector.ann_backend is not None
+        assert blocked_selector.ann_backend is not None
+        np.testing.assert_array_equal(
+            blocked_selector.ann_backend._descriptors, selector.ann_backend._descriptors
+        )
+        assert selector._saliency_index is not None
+        assert blocked_selector._saliency_index is not None
+        np.testing.assert_array_equal(
+            blocked_selector._saliency_index.masks, selector._saliency_index.masks
+        )
+
+    def test_small_shortlist(
+        self,
+        synthetic_poster_layouts: List[ProcessedLayoutData],
+        synthetic_poster_queries: List[ProcessedLayoutData],
+        num_prompt: int,
+    ):
+        # The probed lists are smaller than the number of examples to select
+        ann_selector = ContentAwareSelector(
+            examples=synthetic_poster_layouts,
+            num_prompt=num_prompt,
+            is_shuffle=False,
+            ann_backend=IVFBackend(num_lists=100, num_probes=1, shortlist_size=1),
+        )
+        scores = ann_selector._score_examples(synthetic_poster_queries[0])
+        for query in synthetic_poster_queries:
+            output = ann_selector.select_examples(query)
+            assert len(output.selected_examples) == num_prompt
+            assert output.selected_scores is not None
+            assert np.isfinite(output.selected_scores).all()
+
+        # Without enough valid examples in the shortlist, all the examples are scored
+        assert ann_selector.ann_backend is not None
+        ann_selector.ann_backend.shortlist_size = 0
+        ann_selector.num_prompt = len(synthetic_poster_layouts)
+        np.testing.assert_array_equal(
+            ann_selector._score_shortlist(synthetic_poster_queries[0]), scores
+        )
+
+    @pytest.mark.parametrize(argnames="iou_method", argvalues=("mask", "analytic"))
+    def test_benchmark_against_exhaustive(
+        self,
+        synthetic_poster_layouts_factory: Callable[..., List[ProcessedLayoutData]],
+        synthetic_poster_queries: List[ProcessedLayoutData],
+        num_prompt: int,
+        iou_method: str,
+    ):
+        examples = synthetic_poster_layouts_factory(num_layouts=5000, seed=2)
+
+        exhaustive_selector = ContentAwareSelector(
+            examples=examples,
+            num_prompt=num_prompt,
+            is_shuffle=False,
+            iou_method=iou_method,
+        )
+        ann_selector = ContentAwareSelector(
+            examples=examples,
+            num_prompt=num_prompt,
+            is_shuffle=False,
+            iou_method=iou_method,
+            ann_backend=IVFBackend(num_lists=64, num_probes=8, shortlist_size=256),
+        )
+        # Warm up (e.g., training the coarse quantizer)
+        ann_selector.select_examples(synthetic_poster_queries[0])
+
+        def benchmark(selector: ContentAwareSelector) -> Tuple[float, List[Set[int]]]:
+            start = time.perf_counter()
+            outputs = [
+                selector.select_examples(query) for query in synthetic_poster_queries
+            ]
+            elapsed = (time.perf_counter() - start) / len(synthetic_poster_queries)
+            selected_indices = [
+                {cast(int, example.idx) for example in output.selected_examples}
+                for output in outputs
+            ]
+            return elapsed, selected_indices
+
+        ann_latency, ann_indices = benchmark(ann_selector)
+        exhaustive_latency, exhaustive_indices = benchmark(exhaustive_selector)
+
+        recall = np.mean(
+            [
+                len(ann & exhaustive) / len(exhaustive)
+                for ann, exhaustive in zip(ann_indices, exhaustive_indices)
+            ]
+        )
+        logger.info(
+            f"[{iou_method}] {len(examples)} examples, "
+            f"ANN: {ann_latency * 1000:.2f} ms/query, "
+            f"exhaustive: {exhaustive_latency * 1000:.2f} ms/query, "
+            f"recall@{num_prompt}: {recall:.3f}"
+        )
+        assert recall >= 0.8
@@ -1,11 +1,15 @@
-from typing import Dict, List, cast
+import random
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, cast
 
+import numpy as np
 import pytest
 from langchain.smith.evaluation.progress import ProgressBarCallback
 from pytest_lazy_fixtures import lf
 
-from layout_prompter.models import LayoutData, ProcessedLayoutData
+from layout_prompter.models import CanvasSize, LayoutData, ProcessedLayoutData
 from layout_prompter.modules.selectors import ContentAwareSelector
+from layout_prompter.modules.selectors.content_aware_selector import calculate_iou
 from layout_prompter.preprocessors import ContentAwareProcessor
 from layout_prompter.settings import PosterLayoutSettings, TaskSettings
 from layout_prompter.transforms import DiscretizeBboxes
@@ -85,3 +89,543 @@ class TestContentAwareSelector(LayoutPrompterTestCase):
         selector_output = selector.select_examples(processed_test_data)
 
         assert len(selector_output.selected_examples) == num_prompt
+
+    def test_index_scores_match_calculate_iou(
+        self,
+        synthetic_poster_layouts: List[ProcessedLayoutData],
+        synthetic_poster_queries: List[ProcessedLayoutData],
+    ):
+        selector = ContentAwareSelector(examples=synthetic_poster_layouts)
+        assert selector._saliency_index is not None
+        assert len(selector._saliency_index) == len(synthetic_poster_layouts)
+
+        for query in synthetic_poster_queries:
+            query_saliency_map = selector._get_saliency_map(query)
+            expected = [
+                calculate_iou(
+                    query_saliency_map=query_saliency_map,
+                    candidate_saliency_map=selector._get_saliency_map(candidate),
+                )
+                for candidate in synthetic_poster_layouts
+            ]
+            scores = selector._saliency_index.score(query_saliency_map)
+            assert scores.tolist() == pytest.approx(expected)
+
+    def test_add_example_updates_index(
+        self,
+        synthetic_poster_layouts: List[ProcessedLayoutData],
+    ):
+        selector = ContentAwareSelector(examples=synthetic_poster_layouts[:10])
+        selector.add_example(synthetic_poster_layouts[10])
+
+        assert selector._saliency_index is not None
+        assert len(selector._saliency_index) == 11
+        assert np.array_equal(
+            selector._saliency_index.unpack(10),
+            selector._get_saliency_map(synthetic_poster_layouts[10]),
+        )
+
+    @pytest.mark.parametrize(argnames="iou_method", argvalues=("mask", "analytic"))
+    def test_assign_examples_rebuilds_index(
+        self,
+        synthetic_poster_layouts: List[ProcessedLayoutData],
+        synthetic_poster_queries: List[ProcessedLayoutData],
+        num_prompt: int,
+        iou_method: str,
+    ):
+        selector = ContentAwareSelector(
+            examples=synthetic_poster_layouts[:10],
+            num_prompt=num_prompt,
+            is_shuffle=False,
+            iou_method=iou_method,
+        )
+        query = synthetic_poster_queries[0]
+        selector.select_examples(query)
+
+        selector.examples = synthetic_poster_layouts[10:]
+        expected = ContentAwareSelector(
+            examples=synthetic_poster_layouts[10:],
+            num_prompt=num_prompt,
+            is_shuffle=False,
+            iou_method=iou_method,
+        )
+        assert (
+            selector.select_examples(query).selected_examples
+            == expected.select_examples(query).selected_examples
+        )
+
+    @pytest.mark.parametrize(argnames="iou_method", argvalues=("mask", "analytic"))
+    def test_mutate_examples_rebuilds_index(
+        self,
+        synthetic_poster_layouts: List[ProcessedLayoutData],
+        synthetic_poster_queries: List[ProcessedLayoutData],
+        num_prompt: int,
+        iou_method: str,
+    ):
+        selector = ContentAwareSelector(
+            examples=synthetic_poster_layouts[:10],
+            num_prompt=num_prompt,
+            is_shuffle=False,
+            iou_method=iou_method,
+        )
+        selector.select_examples_batch(synthetic_poster_queries)
+
+        # Appended directly instead of with `add_example`
+        selector.examples.extend(synthetic_poster_layouts[10:])
+        expected = ContentAwareSelector(
+            examples=synthetic_poster_layouts,
+            num_prompt=num_prompt,
+            is_shuffle=False,
+            iou_method=iou_method,
+        )
+        outputs = selector.select_examples_batch(synthetic_poster_queries)
+        for query, output in zip(synthetic_poster_queries, outputs):
+            assert (
+                output.selected_examples
+                == expected.select_examples(query).selected_examples
+            )
+
+    def test_return_saliency_maps(
+        self,
+        synthetic_poster_layouts: List[ProcessedLayoutData],
+        synthetic_poster_queries: List[ProcessedLayoutData],
+        num_prompt: int,
+    ):
+        selector = ContentAwareSelector(
+            examples=synthetic_poster_layouts,
+            num_prompt=num_prompt,
+            return_saliency_maps=True,
+        )
+        query = synthetic_poster_queries[0]
+        selector_output = selector.select_examples(query)
+
+        assert selector_output.query_saliency_map is not None
+        assert selector_output.candidate_saliency_maps is not None
+        assert np.array_equal(
+            selector_output.query_saliency_map, selector._get_saliency_map(query)
+        )
+        for example, saliency_map in zip(
+            selector_output.selected_examples,
+            selector_output.candidate_saliency_maps,
+        ):
+            assert np.array_equal(saliency_map, selector._get_saliency_map(example))
+
+    def test_analytic_iou_matches_mask_iou(
+        self,
+        synthetic_poster_layouts: List[ProcessedLayoutData],
+        synthetic_poster_queries: List[ProcessedLayoutData],
+    ):
+        mask_selector = ContentAwareSelector(
+            examples=synthetic_poster_layouts, iou_method="mask"
+        )
+        analytic_selector = ContentAwareSelector(
+            examples=synthetic_poster_layouts, iou_method="analytic"
+        )
+        assert analytic_selector._saliency_index is None
+        assert analytic_selector._content_bbox_index is not None
+
+        for query in synthetic_poster_queries:
+            assert np.allclose(
+                analytic_selector._score_examples(query),
+                mask_selector._score_examples(query),
+            )
+
+    def test_analytic_iou_without_content_bboxes(
+        self,
+        synthetic_poster_layouts: List[ProcessedLayoutData],
+        synthetic_poster_queries: List[ProcessedLayoutData],
+    ):
+        examples = [
+            example.model_copy(update={"discrete_content_bboxes": []})
+            for example in synthetic_poster_layouts[:10]
+        ]
+        query = synthetic_poster_queries[0].model_copy(
+            update={"discrete_content_bboxes": []}
+        )
+        mask_selector = ContentAwareSelector(examples=examples, iou_method="mask")
+        analytic_selector = ContentAwareSelector(
+            examples=examples, iou_method="analytic"
+        )
+
+        scores = analytic_selector._score_examples(query)
+        assert np.allclose(scores, mask_selector._score_examples(query))
+        assert np.allclose(scores, 1.0)
+
+    def test_analytic_select_examples(
+        self,
+        synthetic_poster_layouts: List[ProcessedLayoutData],
+        synthetic_poster_queries: List[ProcessedLayoutData],
+        num_prompt: int,
+    ):
+        mask_selector = ContentAwareSelector(
+            examples=synthetic_poster_layouts,
+            num_prompt=num_prompt,
+            is_shuffle=False,
+            iou_method="mask",
+        )
+        analytic_selector = ContentAwareSelector(
+            examples=synthetic_poster_layouts[:-1],
+            num_prompt=num_prompt,
+            is_shuffle=False,
+            iou_method="analytic",
+            return_saliency_maps=True,
+        )
+        analytic_selector.add_example(synthetic_poster_layouts[-1])
+
+        query = synthetic_poster_queries[0]
+        analytic_output = analytic_selector.select_examples(query)
+        mask_output = mask_selector.select_examples(query)
+
+        assert analytic_output.selected_examples == mask_output.selected_examples
+        assert analytic_output.candidate_saliency_maps is not None
+        assert len(analytic_output.candidate_saliency_maps) == num_prompt
+
+    def test_analytic_canvas_size_mismatch(
+        self,
+        synthetic_poster_layouts: List[ProcessedLayoutData],
+        synthetic_poster_queries: List[ProcessedLayoutData],
+    ):
+        selector = ContentAwareSelector(
+            examples=synthetic_poster_layouts, iou_method="analytic"
+        )
+        query = synthetic_poster_queries[0].model_copy(
+            update={"canvas_size": CanvasSize(width=90, height=160)}
+        )
+        with pytest.raises(ValueError, match="canvas size"):
+            selector.select_examples(query)
+
+    def test_valid_mask(
+        self,
+        synthetic_poster_layouts: List[ProcessedLayoutData],
+    ):
+        selector = ContentAwareSelector(examples=synthetic_poster_layouts[:-1])
+        selector.add_example(synthetic_poster_layouts[-1])
+
+        expected = [
+            not selector._is_filter(example) for example in synthetic_poster_layouts
+        ]
+        assert selector.valid_mask.tolist() == expected
+        # Make sure the synthetic data contains examples to be filtered out
+        assert not all(expected)
+
+    @pytest.mark.parametrize(argnames="num_prompt", argvalues=(1, 10, 1000))
+    def test_retrieve_examples_matches_full_sort(
+        self,
+        synthetic_poster_layouts: List[ProcessedLayoutData],
+        num_prompt: int,
+    ):
+        selector = ContentAwareSelector(
+            examples=synthetic_poster_layouts,
+            num_prompt=num_prompt,
+            is_shuffle=False,
+        )
+        # Use coarse scores so that there are many ties to be broken
+        rng = np.random.default_rng(0)
+        scores = rng.integers(0, 5, size=len(synthetic_poster_layouts)) / 4
+
+        # Reference implementation with a stable full sort
+        expected = [
+            idx
+            for idx, _ in sorted(enumerate(scores), key=lambda x: x[1], reverse=True)
+            if not selector._is_filter(synthetic_poster_layouts[idx])
+        ][:num_prompt]
+
+        candidates = selector._retrieve_examples(scores)
+        assert [idx for idx, _ in candidates] == expected
+
+    @pytest.mark.parametrize(argnames="iou_method", argvalues=("mask", "analytic"))
+    @pytest.mark.parametrize(argnames="batch_block_size", argvalues=(1, 7, 256))
+    def test_select_examples_batch(
+        self,
+        synthetic_poster_layouts: List[ProcessedLayoutData],
+        synthetic_poster_queries: List[ProcessedLayoutData],
+        num_prompt: int,
+        iou_method: str,
+        batch_block_size: int,
+    ):
+        selector = ContentAwareSelector(
+            examples=synthetic_poster_layouts,
+            num_prompt=num_prompt,
+            is_shuffle=False,
+            iou_method=iou_method,
+            batch_block_size=batch_block_size,
+            return_saliency_maps=True,
+            cache_size=0,
+        )
+        outputs = selector.select_examples_batch(synthetic_poster_queries)
+
+        assert len(outputs) == len(synthetic_poster_queries)
+        for query, output in zip(synthetic_poster_queries, outputs):
+            expected = selector.select_examples(query)
+            assert output.selected_examples == expected.selected_examples
+            assert np.array_equal(
+                output.query_saliency_map, expected.query_saliency_map
+            )
+
+    def test_output_cache(
+        self,
+        synthetic_poster_layouts: List[ProcessedLayoutData],
+        synthetic_poster_queries: List[ProcessedLayoutData],
+        num_prompt: int,
+    ):
+        selector = ContentAwareSelector(
+            examples=synthetic_poster_layouts[:-1],
+            num_prompt=num_prompt,
+            is_shuffle=False,
+            return_saliency_maps=True,
+            cache_size=2,
+        )
+        query = synthetic_poster_queries[0]
+
+        output = selector.select_examples(query)
+        assert (selector.cache_hits, selector.cache_misses) == (0, 1)
+
+        # Queries with the same content hit the cache, whatever their other fields
+        cached_output = selector.select_examples(query.model_copy(update={"idx": -1}))
+        assert (selector.cache_hits, selector.cache_misses) == (1, 1)
+        assert cached_output.selected_examples == output.selected_examples
+        assert cached_output.candidate_saliency_maps is not None
+        assert output.candidate_saliency_maps is not None
+        for cached_map, saliency_map in zip(
+            cached_output.candidate_saliency_maps, output.candidate_saliency_maps
+        ):
+            assert np.array_equal(cached_map, saliency_map)
+
+        # The least recently used output is evicted
+        selector.select_examples(synthetic_poster_queries[1])
+        selector.select_examples(synthetic_poster_queries[2])
+        selector.select_examples(query)
+        assert (selector.cache_hits, selector.cache_misses) == (1, 4)
+
+        # Adding an example clears the cache
+        selector.add_example(synthetic_poster_layouts[-1])
+        selector.select_examples(query)
+        assert (selector.cache_hits, selector.cache_misses) == (1, 5)
+
+    def test_output_cache_copies_saliency_maps(
+        self,
+        synthetic_poster_layouts: List[ProcessedLayoutData],
+        synthetic_poster_queries: List[ProcessedLayoutData],
+        num_prompt: int,
+    ):
+        selector = ContentAwareSelector(
+            examples=synthetic_poster_layouts,
+            num_prompt=num_prompt,
+            return_saliency_maps=True,
+        )
+        query = synthetic_poster_queries[0]
+        expected = selector._get_saliency_map(query)
+
+        # Mutating the arrays of the returned outputs does not corrupt the cache
+        for _ in range(2):
+            output = selector.select_examples(query)
+            assert output.query_saliency_map is not None
+            assert output.candidate_saliency_maps is not None
+            assert np.array_equal(output.query_saliency_map, expected)
+            output.query_saliency_map[...] = 0
+            for saliency_map in output.candidate_saliency_maps:
+                saliency_map[...] = 0
+        assert (selector.cache_hits, selector.cache_misses) == (1, 1)
+
+        output = selector.select_examples(query)
+        assert output.candidate_saliency_maps is not None
+        for example, saliency_map in zip(
+            output.selected_examples, output.candidate_saliency_maps
+        ):
+            assert np.array_equal(saliency_map, selector._get_saliency_map(example))
+
+    def test_output_cache_shuffles_once(
+        self,
+        synthetic_poster_layouts: List[ProcessedLayoutData],
+        synthetic_poster_queries: List[ProcessedLayoutData],
+        num_prompt: int,
+        monkeypatch: pytest.MonkeyPatch,
+    ):
+        selector = ContentAwareSelector(
+            examples=synthetic_poster_layouts, num_prompt=num_prompt
+        )
+        num_shuffles = 0
+        original_shuffle = random.shuffle
+
+        def shuffle(x: List[Any]) -> None:
+            nonlocal num_shuffles
+            num_shuffles += 1
+            original_shuffle(x)
+
+        monkeypatch.setattr(random, "shuffle", shuffle)
+
+        query = synthetic_poster_queries[0]
+        selector.select_examples(query)
+        assert num_shuffles == 1
+        selector.select_examples(query)
+        assert num_shuffles == 2
+        selector.select_examples_batch(synthetic_poster_queries[1:3])
+        assert num_shuffles == 4
+
+    def test_output_cache_settings(
+        self,
+        synthetic_poster_layouts: List[ProcessedLayoutData],
+        synthetic_poster_queries: List[ProcessedLayoutData],
+        num_prompt: int,
+    ):
+        selector = ContentAwareSelector(
+            examples=synthetic_poster_layouts, num_prompt=num_prompt, is_shuffle=False
+        )
+        query = synthetic_poster_queries[0]
+        assert selector.select_examples(query).candidate_saliency_maps is None
+
+        # Changing the settings that affect the output misses the cache
+        selector.return_saliency_maps = True
+        output = selector.select_examples(query)
+        assert output.candidate_saliency_maps is not None
+        assert (selector.cache_hits, selector.cache_misses) == (0, 2)
+        assert selector.select_examples(query).candidate_saliency_maps is not None
+        assert (selector.cache_hits, selector.cache_misses) == (1, 2)
+
+    def test_output_cache_threads(
+        self,
+        synthetic_poster_layouts: List[ProcessedLayoutData],
+        synthetic_poster_queries: List[ProcessedLayoutData],
+        num_prompt: int,
+    ):
+        selector = ContentAwareSelector(
+            examples=synthetic_poster_layouts,
+            num_prompt=num_prompt,
+            is_shuffle=False,
+            cache_size=2,
+        )
+        expected = [
+            selector.select_examples(query).selected_examples
+            for query in synthetic_poster_queries[:4]
+        ]
+        queries = synthetic_poster_queries[:4] * 25
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            outputs = list(executor.map(selector.select_examples, queries))
+
+        assert selector.cache_hits + selector.cache_misses == 4 + len(queries)
+        assert [output.selected_examples for output in outputs] == expected * 25
+
+    def test_selected_scores(
+        self,
+        synthetic_poster_layouts: List[ProcessedLayoutData],
+        synthetic_poster_queries: List[ProcessedLayoutData],
+        num_prompt: int,
+    ):
+        selector = ContentAwareSelector(
+            examples=synthetic_poster_layouts, num_prompt=num_prompt, is_shuffle=False
+        )
+        shuffled_selector = ContentAwareSelector(
+            examples=synthetic_poster_layouts, num_prompt=num_prompt
+        )
+        query = synthetic_poster_queries[0]
+        scores = selector._score_examples(query)
+
+        output = selector.select_examples(query)
+        assert (
+            output.selected_scores
+            == (sorted(scores[selector.valid_mask], reverse=True)[:num_prompt])
+        )
+        for example, score in zip(output.selected_examples, output.selected_scores):
+            assert score == scores[synthetic_poster_layouts.index(example)]
+
+        # The scores are shuffled together with the examples, also when cached
+        for _ in range(2):
+            shuffled_output = shuffled_selector.select_examples(query)
+            assert shuffled_output.selected_scores is not None
+            assert sorted(shuffled_output.selected_scores, reverse=True) == (
+                output.selected_scores
+            )
+            for example, score in zip(
+                shuffled_output.selected_examples, shuffled_output.selected_scores
+            ):
+                assert score == scores[synthetic_poster_layouts.index(example)]
+
+    def test_output_cache_batch(
+        self,
+        synthetic_poster_layouts: List[ProcessedLayoutData],
+        synthetic_poster_queries: List[ProcessedLayoutData],
+        num_prompt: int,
+    ):
+        selector = ContentAwareSelector(
+            examples=synthetic_poster_layouts, num_prompt=num_prompt, is_shuffle=False
+        )
+        expected = [
+            output.selected_examples
+            for output in selector.select_examples_batch(synthetic_poster_queries[:5])
+        ]
+        outputs = selector.select_examples_batch(synthetic_poster_queries[:10])
+
+        assert selector.cache_hits == 5
+        assert selector.cache_misses == 10
+        assert [output.selected_examples for output in outputs[:5]] == expected
+
+    def test_score_batch_matches_score(
+        self,
+        synthetic_poster_layouts: List[ProcessedLayoutData],
+        synthetic_poster_queries: List[ProcessedLayoutData],
+    ):
+        selector = ContentAwareSelector(examples=synthetic_poster_layouts)
+        assert selector._saliency_index is not None
+
+        query_saliency_maps = [
+            selector._get_saliency_map(query) for query in synthetic_poster_queries
+        ]
+        scores = selector._saliency_index.score_batch(
+            query_saliency_maps, block_size=64
+        )
+        assert scores.shape == (
+            len(synthetic_poster_queries),
+            len(synthetic_poster_layouts),
+        )
+        for query_saliency_map, query_scores in zip(query_saliency_maps, scores):
+            assert np.array_equal(
+                query_scores, selector._saliency_index.score(query_saliency_map)
+            )
+
+    def test_process_execution(
+        self,
+        synthetic_poster_layouts: List[ProcessedLayoutData],
+        synthetic_poster_queries: List[ProcessedLayoutData],
+        num_prompt: int,
+    ):
+        serial_selector = ContentAwareSelector(
+            examples=synthetic_poster_layouts, num_prompt=num_prompt, is_shuffle=False
+        )
+        process_selector = ContentAwareSelector(
+            examples=synthetic_poster_layouts[:-1],
+            num_prompt=num_prompt,
+            is_shuffle=False,
+            execution="process",
+            max_workers=3,
+        )
+        try:
+            query = synthetic_poster_queries[0]
+            process_selector.select_examples(query)
+
+            # Adding an example must be reflected in the shared memory of the workers
+            process_selector.add_example(synthetic_poster_layouts[-1])
+            assert process_selector._sharded_scorer is None
+
+            for query in synthetic_poster_queries:
+                assert (
+                    process_selector.select_examples(query).selected_examples
+                    == serial_selector.select_examples(query).selected_examples
+                )
+
+            outputs = process_selector.select_examples_batch(synthetic_poster_queries)
+            expected = serial_selector.select_examples_batch(synthetic_poster_queries)
+            assert [output.selected_examples for output in outputs] == [
+                output.selected_examples for output in expected
+            ]
+        finally:
+            process_selector.close()
+
+    def test_process_execution_requires_mask(
+        self, synthetic_poster_layouts: List[ProcessedLayoutData]
+    ):
+        with pytest.raises(ValueError, match="process execution"):
+            ContentAwareSelector(
+                examples=synthetic_poster_layouts,
+                execution="process",
+                iou_method="analytic",
+            )
@@ -0,0 +1,174 @@
+import pathlib
+from typing import List
+
+import numpy as np
+import pytest
+
+from layout_prompter.models import ProcessedLayoutData
+from layout_prompter.modules.selectors import ContentAwareSelector, IVFBackend
+from layout_prompter.modules.selectors.persistence import LazyExamples
+from layout_prompter.utils.testing import LayoutPrompterTestCase
+
+
+class TestSelectorIndexPersistence(LayoutPrompterTestCase):
+    @pytest.fixture
+    def index_dir(self, tmp_path: pathlib.Path) -> pathlib.Path:
+        return tmp_path / "index"
+
+    def test_examples_round_trip(
+        self,
+        synthetic_poster_layouts: List[ProcessedLayoutData],
+        index_dir: pathlib.Path,
+    ):
+        selector = ContentAwareSelector(examples=synthetic_poster_layouts)
+        selector.save_index(index_dir)
+
+        loaded = ContentAwareSelector.load_index(index_dir)
+        assert isinstance(loaded.examples, LazyExamples)
+        assert len(loaded.examples) == len(synthetic_poster_layouts)
+        assert loaded.valid_mask.tolist() == selector.valid_mask.tolist()
+
+        for i in (0, 1, len(synthetic_poster_layouts) - 1):
+            assert loaded.examples[i] == synthetic_poster_layouts[i]
+
+    @pytest.mark.parametrize(
+        argnames="iou_method",
+        argvalues=("mask", "analytic"),
+    )
+    def test_select_examples_matches_original(
+        self,
+        synthetic_poster_layouts: List[ProcessedLayoutData],
+        synthetic_poster_queries: List[ProcessedLayoutData],
+        index_dir: pathlib.Path,
+        iou_method: str,
+    ):
+        # The index is saved from a mask-based selector and loaded with either method
+        ContentAwareSelector(examples=synthetic_poster_layouts).save_index(index_dir)
+
+        selector = ContentAwareSelector(
+            examples=synthetic_poster_layouts, iou_method=iou_method, is_shuffle=False
+        )
+        loaded = ContentAwareSelector.load_index(
+            index_dir, iou_method=iou_method, is_shuffle=False
+        )
+        assert isinstance(loaded._saliency_index, type(selector._saliency_index))
+        assert isinstance(
+            loaded._content_bbox_index, type(selector._content_bbox_index)
+        )
+
+        for query in synthetic_poster_queries:
+            np.testing.assert_array_equal(
+                loaded._score_examples(query), selector._score_examples(query)
+            )
+            assert (
+                loaded.select_examples(query).selected_examples
+                == selector.select_examples(query).selected_examples
+            )
+
+    def test_add_example_after_loading(
+        self,
+        synthetic_poster_layouts: List[ProcessedLayoutData],
+        synthetic_poster_queries: List[ProcessedLayoutData],
+        index_dir: pathlib.Path,
+    ):
+        ContentAwareSelector(examples=synthetic_poster_layouts[:-1]).save_index(
+            index_dir
+        )
+        loaded = ContentAwareSelector.load_index(index_dir, is_shuffle=False)
+        loaded.add_example(synthetic_poster_layouts[-1])
+
+        selector = ContentAwareSelector(
+            examples=synthetic_poster_layouts, is_shuffle=False
+        )
+        assert len(loaded.examples) == len(synthetic_poster_layouts)
+        assert loaded.examples[-1] == synthetic_poster_layouts[-1]
+        assert loaded.valid_mask.tolist() == selector.valid_mask.tolist()
+
+        query = synthetic_poster_queries[0]
+        assert (
+            loaded.select_examples(query).selected_examples
+            == selector.select_examples(query).selected_examples
+        )
+
+    def test_load_with_ann_backend(
+        self,
+        synthetic_poster_layouts: List[ProcessedLayoutData],
+        index_dir: pathlib.Path,
+    ):
+        ContentAwareSelector(examples=synthetic_poster_layouts).save_index(index_dir)
+
+        selector = ContentAwareSelector(
+            examples=synthetic_poster_layouts, ann_backend=IVFBackend()
+        )
+        loaded = ContentAwareSelector.load_index(index_dir, ann_backend=IVFBackend())
+
+        assert loaded.ann_backend is not None and selector.ann_backend is not None
+        np.testing.assert_allclose(
+            loaded.ann_backend._descriptors, selector.ann_backend._descriptors
+        )
+
+    def test_unsupported_format_version(
+        self,
+        synthetic_poster_layouts: List[ProcessedLayoutData],
+        index_dir: pathlib.Path,
+    ):
+        ContentAwareSelector(examples=synthetic_poster_layouts[:10]).save_index(
+            index_dir
+        )
+        metadata_path = index_dir / "metadata.json"
+        metadata_path.write_text(
+            metadata_path.read_text().replace(
+                '"format_version": 1', '"format_version": 0'
+            )
+        )
+
+        with pytest.raises(ValueError, match="Unsupported index format version"):
+            ContentAwareSelector.load_index(index_dir)
+
+    def test_selector_mismatch(
+        self,
+        synthetic_poster_layouts: List[ProcessedLayoutData],
+        index_dir: pathlib.Path,
+    ):
+        ContentAwareSelector(examples=synthetic_poster_layouts[:10]).save_index(
+            index_dir
+        )
+        metadata_path = index_dir / "metadata.json"
+        metadata_path.write_text(
+            metadata_path.read_text().replace(
+                '"selector": "ContentAwareSelector"', '"selector": "OtherSelector"'
+            )
+        )
+
+        with pytest.raises(ValueError, match="saved by OtherSelector"):
+            ContentAwareSelector.load_index(index_dir)
+
+    def test_num_examples_mismatch(
+        self,
+        synthetic_poster_layouts: List[ProcessedLayoutData],
+        index_dir: pathlib.Path,
+    ):
+        ContentAwareSelector(examples=synthetic_poster_layouts[:10]).save_index(
+            index_dir
+        )
+        metadata_path = index_dir / "metadata.json"
+        metadata_path.write_text(
+            metadata_path.read_text().replace(
+                '"num_examples": 10', '"num_examples": 11'
+            )
+        )
+
+        with pytest.raises(ValueError, match="metadata records 11"):
+            ContentAwareSelector.load_index(index_dir)
+
+    def test_candidate_size_is_rejected(
+        self,
+        synthetic_poster_layouts: List[ProcessedLayoutData],
+        index_dir: pathlib.Path,
+    ):
+        ContentAwareSelector(examples=synthetic_poster_layouts[:10]).save_index(
+            index_dir
+        )
+
+        with pytest.raises(ValueError, match="candidate_size"):
+            ContentAwareSelector.load_index(index_dir, candidate_size=5)
@@ -0,0 +1,136 @@
+import numpy as np
+import pytest
+
+from layout_prompter.models import Bbox, CanvasSize
+from layout_prompter.modules.selectors.saliency_index import (
+    ContentBboxIndex,
+    SaliencyMaskIndex,
+    bboxes_to_pixel_rects,
+    count_bits,
+)
+
+
+class TestSaliencyMaskIndex:
+    @pytest.fixture
+    def canvas_size(self) -> CanvasSize:
+        # The number of pixels is deliberately not a multiple of 8
+        return CanvasSize(width=7, height=5)
+
+    @pytest.fixture
+    def binary_images(self, canvas_size: CanvasSize) -> np.ndarray:
+        rng = np.random.default_rng(0)
+        shape = (10, canvas_size.height, canvas_size.width)
+        return (rng.random(shape) > 0.5).astype(np.uint8) * 255
+
+    def test_count_bits(self):
+        packed = np.array([[0b00000000, 0b11111111, 0b10100101]], dtype=np.uint8)
+        assert count_bits(packed).tolist() == [12]
+
+    def test_pack_and_unpack(self, canvas_size: CanvasSize, binary_images):
+        index = SaliencyMaskIndex(canvas_size=canvas_size)
+        index.add(list(binary_images))
+
+        assert len(index) == len(binary_images)
+        assert index.masks.shape == (len(binary_images), 5)
+        for idx, binary_image in enumerate(binary_images):
+            assert np.array_equal(index.unpack(idx), binary_image)
+            assert index.areas[idx] == np.count_nonzero(binary_image)
+
+    def test_incremental_add(self, canvas_size: CanvasSize, binary_images):
+        index = SaliencyMaskIndex(canvas_size=canvas_size)
+        for binary_image in binary_images:
+            index.add([binary_image])
+
+        expected = SaliencyMaskIndex(canvas_size=canvas_size)
+        expected.add(list(binary_images))
+        assert np.array_equal(index.masks, expected.masks)
+        assert np.array_equal(index.areas, expected.areas)
+
+    def test_score(self, canvas_size: CanvasSize, binary_images):
+        index = SaliencyMaskIndex(canvas_size=canvas_size)
+        index.add(list(binary_images[1:]))
+
+        query = binary_images[0]
+        scores = index.score(query)
+
+        intersections = np.logical_and(query > 0, binary_images[1:] > 0).sum((1, 2))
+        unions = np.logical_or(query > 0, binary_images[1:] > 0).sum((1, 2))
+        expected = (intersections * 255 + 1) / (unions * 255 + 1)
+        assert np.allclose(scores, expected)
+
+    def test_score_empty_index(self, canvas_size: CanvasSize, binary_images):
+        index = SaliencyMaskIndex(canvas_size=canvas_size)
+        assert index.score(binary_images[0]).shape == (0,)
+
+    def test_canvas_size_mismatch(self, canvas_size: CanvasSize):
+        index = SaliencyMaskIndex(canvas_size=canvas_size)
+        with pytest.raises(ValueError, match="must be of shape"):
+            index.add([np.zeros((canvas_size.width, canvas_size.height))])
+
+
+class TestContentBboxIndex:
+    @pytest.fixture
+    def canvas_size(self) -> CanvasSize:
+        return CanvasSize(width=20, height=30)
+
+    def test_bboxes_to_pixel_rects(self, canvas_size: CanvasSize):
+        bboxes = [
+            Bbox(left=2, top=3, width=4, height=5),
+            Bbox(left=15, top=25, width=10, height=10),
+            Bbox(left=20, top=0, width=0, height=0),
+        ]
+        rects = bboxes_to_pixel_rects(bboxes, canvas_size=canvas_size)
+        assert rects.tolist() == [[2, 3, 7, 9], [15, 25, 20, 30], [20, 0, 20, 1]]
+
+    def test_score(self, canvas_size: CanvasSize):
+        index = ContentBboxIndex(canvas_size=canvas_size)
+        index.add(
+            [
+                [Bbox(left=0, top=0, width=9, height=9)],
+                [
+                    Bbox(left=0, top=0, width=4, height=4),
+                    Bbox(left=10, top=10, width=4, height=4),
+                ],
+            ]
+        )
+        assert index.rects.shape == (2, 2, 4)
+        assert index.areas.tolist() == [100, 50]
+
+        scores = index.score([Bbox(left=0, top=0, width=4, height=4)])
+        expected = np.array([25 * 255 + 1, 25 * 255 + 1]) / np.array(
+            [100 * 255 + 1, 50 * 255 + 1]
+        )
+        assert np.allclose(scores, expected)
+
+    def test_incremental_add(self, canvas_size: CanvasSize):
+        rng = np.random.default_rng(0)
+        bboxes_list = [
+            [
+                Bbox(left=int(left), top=int(top), width=int(width), height=int(height))
+                for left, top, width, height in rng.integers(
+                    0, 10, size=(int(rng.integers(0, 4)), 4)
+                )
+            ]
+            for _ in range(100)
+        ]
+        index = ContentBboxIndex(canvas_size=canvas_size)
+        capacities = set()
+        for bboxes in bboxes_list:
+            index.add([bboxes])
+            capacities.add(len(index._rects))
+
+        expected = ContentBboxIndex(canvas_size=canvas_size)
+        expected.add(bboxes_list)
+        assert len(index) == len(expected) == 100
+        assert np.array_equal(index.rects, expected.rects)
+        assert np.array_equal(index.areas, expected.areas)
+        # The buffers grow geometrically rather than on every call
+        assert len(capacities) <= 8
+
+    def test_score_empty_bboxes(self, canvas_size: CanvasSize):
+        index = ContentBboxIndex(canvas_size=canvas_size)
+        index.add([[], []])
+
+        # The smoothed IoU of two empty saliency maps is 1.0, as with the masks
+        assert index.score([]).tolist() == [1.0, 1.0]
+        assert index.score([], indices=np.array([1])).tolist() == [1.0]
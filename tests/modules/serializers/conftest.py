@@ -0,0 +1,69 @@
+from typing import Callable, List, Type
+
+import pytest
+from langchain_core.prompt_values import ChatPromptValue
+from langchain_core.prompts import (
+    ChatPromptTemplate,
+    FewShotChatMessagePromptTemplate,
+    HumanMessagePromptTemplate,
+    SystemMessagePromptTemplate,
+)
+
+from layout_prompter.models import LayoutSerializedData, ProcessedLayoutData
+from layout_prompter.modules.serializers import LayoutSerializer
+from layout_prompter.modules.serializers.base import SERIALIZED_LAYOUT
+
+
+def build_prompt_without_cache(
+    serializer: LayoutSerializer,
+    query: ProcessedLayoutData,
+    candidates: List[ProcessedLayoutData],
+    schema: Type[LayoutSerializedData],
+) -> ChatPromptValue:
+    """Build the prompt by constructing the whole template graph, as on every invoke
+    before the templates were cached. This is the reference for equivalence tests.
+    """
+    constraint_template = serializer._get_constraint_template()
+    example_prompt = ChatPromptTemplate.from_messages(
+        [
+            ("human", constraint_template),
+            ("ai", SERIALIZED_LAYOUT),
+        ]
+    )
+    examples = [
+        {
+            **serializer._get_constraint_variables(candidate),
+            "serialized_layout": serializer._get_serialized_layout(
+                candidate, schema=schema
+            ),
+        }
+        for candidate in candidates
+    ]
+    prompt = ChatPromptTemplate.from_messages(
+        [
+            SystemMessagePromptTemplate.from_template(
+                template=serializer.system_prompt
+            ),
+            FewShotChatMessagePromptTemplate(
+                examples=examples, example_prompt=example_prompt
+            ),
+            HumanMessagePromptTemplate.from_template(template=constraint_template),
+        ]
+    )
+    final_prompt = prompt.invoke(
+        {
+            "canvas_width": query.canvas_size.width,
+            "canvas_height": query.canvas_size.height,
+            "task_description": serializer.task_type,
+            "layout_domain": serializer.layout_domain,
+            **serializer._get_constraint_variables(query),
+        }
+    )
+    assert isinstance(final_prompt, ChatPromptValue)
+    return final_prompt
+
+
+@pytest.fixture
+def reference_prompt_builder() -> Callable[..., ChatPromptValue]:
+    """Return the reference implementation of the prompt construction."""
+    return build_prompt_without_cache
@@ -1,7 +1,11 @@
-from typing import Dict, List, Type, cast
+import time
+from typing import Callable, Dict, List, Optional, Type, cast
 
 import pytest
 from langchain.smith.evaluation.progress import ProgressBarCallback
+from langchain_core.prompt_values import ChatPromptValue
+from langchain_core.runnables import RunnableConfig
+from loguru import logger
 from pytest_lazy_fixtures import lf
 
 from layout_prompter.models import (
@@ -18,7 +22,11 @@ from layout_prompter.modules.serializers import (
 from layout_prompter.preprocessors import ContentAwareProcessor
 from layout_prompter.settings import PosterLayoutSettings, TaskSettings
 from layout_prompter.transforms import DiscretizeBboxes
-from layout_prompter.utils import get_num_workers
+from layout_prompter.utils import (
+    compute_shared_prefix_rate,
+    estimate_num_message_tokens,
+    get_num_workers,
+)
 from layout_prompter.utils.testing import LayoutPrompterTestCase
 
 
@@ -103,3 +111,342 @@ class TestContentAwareSerializer(LayoutPrompterTestCase):
         )
         for message in prompt.to_messages():
             message.pretty_print()
+
+    @pytest.mark.parametrize(argnames="render_mode", argvalues=("template", "direct"))
+    def test_prompt_matches_reference(
+        self,
+        synthetic_poster_layouts: List[ProcessedLayoutData],
+        synthetic_poster_queries: List[ProcessedLayoutData],
+        reference_prompt_builder: Callable[..., ChatPromptValue],
+        render_mode: str,
+    ):
+        serializer = ContentAwareSerializer(
+            layout_domain="poster", render_mode=render_mode
+        )
+        candidates = synthetic_poster_layouts[:10]
+
+        for query in synthetic_poster_queries:
+            prompt = serializer.invoke(
+                input=LayoutSerializerInput(query=query, candidates=candidates),
+                config={"configurable": {"input_schema": PosterLayoutSerializedData}},
+            )
+            expected = reference_prompt_builder(
+                serializer, query, candidates, schema=PosterLayoutSerializedData
+            )
+            assert prompt == expected
+            # The rendered messages are byte-identical
+            assert [
+                (type(message), message.model_dump_json())
+                for message in prompt.to_messages()
+            ] == [
+                (type(message), message.model_dump_json())
+                for message in expected.to_messages()
+            ]
+
+    def test_prompt_build_benchmark(
+        self,
+        synthetic_poster_layouts: List[ProcessedLayoutData],
+        synthetic_poster_queries: List[ProcessedLayoutData],
+        reference_prompt_builder: Callable[..., ChatPromptValue],
+    ):
+        serializer = ContentAwareSerializer(layout_domain="poster")
+        candidates = synthetic_poster_layouts[:10]
+        queries = synthetic_poster_queries * 5
+
+        start = time.perf_counter()
+        for query in queries:
+            reference_prompt_builder(
+                serializer, query, candidates, schema=PosterLayoutSerializedData
+            )
+        uncached_time = (time.perf_counter() - start) / len(queries)
+
+        start = time.perf_counter()
+        for query in queries:
+            serializer._format_prompt(
+                query, candidates, schema=PosterLayoutSerializedData
+            )
+        cached_time = (time.perf_counter() - start) / len(queries)
+
+        direct_serializer = ContentAwareSerializer(
+            layout_domain="poster", render_mode="direct"
+        )
+        start = time.perf_counter()
+        for query in queries:
+            direct_serializer._format_prompt(
+                query, candidates, schema=PosterLayoutSerializedData
+            )
+        direct_time = (time.perf_counter() - start) / len(queries)
+
+        logger.info(
+            f"Prompt build time per invoke: {uncached_time * 1e3:.3f} ms (uncached) "
+            f"-> {cached_time * 1e3:.3f} ms (cached templates) "
+            f"-> {direct_time * 1e3:.3f} ms (direct rendering)"
+        )
+
+    def test_fragment_cache(
+        self,
+        synthetic_poster_layouts: List[ProcessedLayoutData],
+        synthetic_poster_queries: List[ProcessedLayoutData],
+    ):
+        serializer = ContentAwareSerializer(
+            layout_domain="poster", fragment_cache_size=15
+        )
+        uncached_serializer = ContentAwareSerializer(
+            layout_domain="poster", fragment_cache_size=0
+        )
+        config: RunnableConfig = {
+            "configurable": {"input_schema": PosterLayoutSerializedData}
+        }
+
+        for i, query in enumerate(synthetic_poster_queries):
+            serializer_input = LayoutSerializerInput(
+                query=query, candidates=synthetic_poster_layouts[i : i + 10]
+            )
+            assert serializer.invoke(serializer_input, config=config) == (
+                uncached_serializer.invoke(serializer_input, config=config)
+            )
+            # The cache is bounded and the queries are never cached
+            assert len(serializer._fragment_cache) <= 15
+
+        assert len(uncached_serializer._fragment_cache) == 0
+
+        # The fragments of the same example are reused
+        candidate = synthetic_poster_layouts[-1]
+        variables = serializer._get_example_variables(
+            candidate, schema=PosterLayoutSerializedData
+        )
+        assert (
+            serializer._get_example_variables(
+                candidate.model_copy(), schema=PosterLayoutSerializedData
+            )
+            is variables
+        )
+
+    def test_token_budget(
+        self,
+        synthetic_poster_layouts: List[ProcessedLayoutData],
+        synthetic_poster_queries: List[ProcessedLayoutData],
+    ):
+        selector = ContentAwareSelector(
+            examples=synthetic_poster_layouts, num_prompt=20
+        )
+        serializer = ContentAwareSerializer(layout_domain="poster")
+        query = synthetic_poster_queries[0]
+        selector_output = selector.select_examples(query)
+        assert selector_output.selected_scores is not None
+        serializer_input = LayoutSerializerInput(
+            query=query,
+            candidates=selector_output.selected_examples,
+            candidate_scores=selector_output.selected_scores,
+        )
+
+        def invoke(token_budget: Optional[int]) -> ChatPromptValue:
+            return serializer.invoke(
+                serializer_input,
+                config={
+                    "configurable": {
+                        "input_schema": PosterLayoutSerializedData,
+                        "token_budget": token_budget,
+                    }
+                },
+            )
+
+        unbounded_prompt = invoke(token_budget=None)
+        num_unbounded_tokens = estimate_num_message_tokens(
+            unbounded_prompt.to_messages()
+        )
+        # A large enough budget packs all the candidates
+        assert invoke(token_budget=num_unbounded_tokens) == unbounded_prompt
+
+        token_budget = num_unbounded_tokens // 3
+        prompt = invoke(token_budget=token_budget)
+        messages = prompt.to_messages()
+        assert estimate_num_message_tokens(messages) <= token_budget
+
+        # The packed examples keep their order and are the highest-scoring ones,
+        # except for those skipped because they did not fit
+        packed = serializer._pack_candidates(
+            serializer_input,
+            schema=PosterLayoutSerializedData,
+            token_budget=token_budget,
+        )
+        assert 0 < len(packed) < len(serializer_input.candidates)
+        assert len(messages) == 2 + 2 * len(packed)
+        packed_indices = [
+            i
+            for i, candidate in enumerate(serializer_input.candidates)
+            if any(candidate is example for example in packed)
+        ]
+        assert packed_indices == sorted(packed_indices)
+        max_packed_score = max(
+            selector_output.selected_scores[i] for i in packed_indices
+        )
+        assert max_packed_score == max(selector_output.selected_scores)
+
+        # The query is kept even if no example fits
+        assert len(invoke(token_budget=1).to_messages()) == 2
+
+    @pytest.mark.parametrize(argnames="render_mode", argvalues=("template", "direct"))
+    def test_prefix_cache_ordering(
+        self,
+        synthetic_poster_layouts: List[ProcessedLayoutData],
+        synthetic_poster_queries: List[ProcessedLayoutData],
+        render_mode: str,
+    ):
+        selector = ContentAwareSelector(examples=synthetic_poster_layouts, num_prompt=5)
+        selector_outputs = selector.select_examples_batch(synthetic_poster_queries)
+        config: RunnableConfig = {
+            "configurable": {"input_schema": PosterLayoutSerializedData}
+        }
+
+        def invoke_all(serializer: ContentAwareSerializer) -> List[ChatPromptValue]:
+            return [
+                serializer.invoke(
+                    LayoutSerializerInput(
+                        query=query, candidates=output.selected_examples
+                    ),
+                    config=config,
+                )
+                for query, output in zip(synthetic_poster_queries, selector_outputs)
+            ]
+
+        default_prompts = invoke_all(
+            ContentAwareSerializer(layout_domain="poster", render_mode=render_mode)
+        )
+        prompts = invoke_all(
+            ContentAwareSerializer(
+                layout_domain="poster",
+                render_mode=render_mode,
+                prompt_ordering="prefix_cache",
+            )
+        )
+
+        for prompt, default_prompt in zip(prompts, default_prompts):
+            messages, default_messages = (
+                prompt.to_messages(),
+                default_prompt.to_messages(),
+            )
+            # The system message does not depend on the query
+            assert messages[0] == prompts[0].to_messages()[0]
+            assert "Canvas Size" in messages[-1].text()
+            # The same examples and query constraints, in a canonical order
+            assert sorted(message.text() for message in messages[1:-1]) == sorted(
+                message.text() for message in default_messages[1:-1]
+            )
+            assert messages[-1].text().endswith(default_messages[-1].text())
+
+        default_rate = compute_shared_prefix_rate(default_prompts)
+        rate = compute_shared_prefix_rate(prompts)
+        logger.info(
+            f"Shared prefix rate: {default_rate:.1%} (default) -> {rate:.1%} (prefix cache)"
+        )
+        assert rate > default_rate
+
+    def test_prompt_templates_follow_settings(
+        self,
+        synthetic_poster_layouts: List[ProcessedLayoutData],
+        synthetic_poster_queries: List[ProcessedLayoutData],
+    ):
+        config: RunnableConfig = {
+            "configurable": {"input_schema": PosterLayoutSerializedData}
+        }
+        serializer_input = LayoutSerializerInput(
+            query=synthetic_poster_queries[0], candidates=synthetic_poster_layouts[:3]
+        )
+
+        def get_messages(serializer: ContentAwareSerializer) -> List[str]:
+            prompt = serializer.invoke(serializer_input, config=config)
+            return [message.text() for message in prompt.to_messages()]
+
+        serializer = ContentAwareSerializer(layout_domain="poster")
+        get_messages(serializer)
+
+        # The templates parsed by the first invocation must not be reused
+        serializer.system_prompt = "Custom system prompt for {layout_domain}"
+        assert get_messages(serializer) == get_messages(
+            ContentAwareSerializer(
+                layout_domain="poster",
+                system_prompt="Custom system prompt for {layout_domain}",
+            )
+        )
+        serializer.prompt_ordering = "prefix_cache"
+        serializer.prefix_system_prompt = "Custom prefix prompt"
+        assert get_messages(serializer) == get_messages(
+            ContentAwareSerializer(
+                layout_domain="poster",
+                prompt_ordering="prefix_cache",
+                prefix_system_prompt="Custom prefix prompt",
+            )
+        )
+
+    def test_prefix_cache_ordering_is_stable(
+        self,
+        synthetic_poster_layouts: List[ProcessedLayoutData],
+        synthetic_poster_queries: List[ProcessedLayoutData],
+    ):
+        serializer = ContentAwareSerializer(
+            layout_domain="poster", prompt_ordering="prefix_cache"
+        )
+        config: RunnableConfig = {
+            "configurable": {"input_schema": PosterLayoutSerializedData}
+        }
+        candidates = synthetic_poster_layouts[:5]
+        query = synthetic_poster_queries[0]
+
+        # The selection order does not matter
+        prompt = serializer.invoke(
+            LayoutSerializerInput(query=query, candidates=candidates), config=config
+        )
+        assert prompt == serializer.invoke(
+            LayoutSerializerInput(query=query, candidates=candidates[::-1]),
+            config=config,
+        )
+
+        # The request history does not matter either
+        serializer.invoke(
+            LayoutSerializerInput(
+                query=query, candidates=[synthetic_poster_layouts[5], *candidates]
+            ),
+            config=config,
+        )
+        assert prompt == serializer.invoke(
+            LayoutSerializerInput(query=query, candidates=candidates), config=config
+        )
+        assert prompt == ContentAwareSerializer(
+            layout_domain="poster", prompt_ordering="prefix_cache"
+        ).invoke(
+            LayoutSerializerInput(query=query, candidates=candidates), config=config
+        )
+
+    def test_prefix_cache_ordering_with_example_frequencies(
+        self,
+        synthetic_poster_layouts: List[ProcessedLayoutData],
+        synthetic_poster_queries: List[ProcessedLayoutData],
+    ):
+        candidates = synthetic_poster_layouts[:5]
+        frequent_example = candidates[3]
+        assert frequent_example.idx is not None
+        serializer = ContentAwareSerializer(
+            layout_domain="poster",
+            prompt_ordering="prefix_cache",
+            example_frequencies={frequent_example.idx: 10},
+        )
+        config: RunnableConfig = {
+            "configurable": {"input_schema": PosterLayoutSerializedData}
+        }
+
+        # The most frequent example comes first
+        prompt = serializer.invoke(
+            LayoutSerializerInput(
+                query=synthetic_poster_queries[0], candidates=candidates
+            ),
+            config=config,
+        )
+        assert (
+            prompt.to_messages()[2].text()
+            == (
+                serializer._get_example_variables(
+                    frequent_example, schema=PosterLayoutSerializedData
+                )["serialized_layout"]
+            )
+        )
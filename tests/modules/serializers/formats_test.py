@@ -0,0 +1,237 @@
+from typing import Dict, List, Type, get_args
+
+import numpy as np
+import pytest
+from loguru import logger
+from pytest_lazy_fixtures import lf
+
+from layout_prompter.models import (
+    Bbox,
+    LayoutData,
+    LayoutSerializedData,
+    PosterLayoutSerializedData,
+    PosterLayoutSerializedOutputData,
+    ProcessedLayoutData,
+    Rico25SerializedData,
+    Rico25SerializedOutputData,
+)
+from layout_prompter.models.serialized_data import Rico25ClassNames
+from layout_prompter.modules.serializers import (
+    ContentAwareSerializer,
+    LayoutSerializerInput,
+    parse_layout,
+    serialize_layout,
+)
+from layout_prompter.modules.serializers.formats import SERIALIZATION_FORMATS
+from layout_prompter.settings import PosterLayoutSettings, Rico25Settings, TaskSettings
+from layout_prompter.transforms import DiscretizeBboxes
+from layout_prompter.utils import estimate_num_tokens
+from layout_prompter.utils.testing import LayoutPrompterTestCase
+
+
+def to_serialized_data(
+    layout: ProcessedLayoutData, schema: Type[LayoutSerializedData]
+) -> List[LayoutSerializedData]:
+    assert layout.labels is not None and layout.discrete_bboxes is not None
+    return [
+        schema(class_name=class_name, bbox=bbox)
+        for class_name, bbox in zip(layout.labels, layout.discrete_bboxes)
+    ]
+
+
+def report_num_tokens(
+    layouts: List[ProcessedLayoutData], schema: Type[LayoutSerializedData], name: str
+) -> Dict[str, int]:
+    num_tokens = {
+        serialization_format: sum(
+            estimate_num_tokens(
+                serialize_layout(
+                    to_serialized_data(layout, schema=schema),
+                    serialization_format=serialization_format,
+                )
+            )
+            for layout in layouts
+        )
+        for serialization_format in SERIALIZATION_FORMATS
+    }
+    for serialization_format, count in num_tokens.items():
+        logger.info(
+            f"[{name}] {serialization_format}: {count} tokens "
+            f"({count / num_tokens['json']:.1%} of json, {len(layouts)} layouts)"
+        )
+    return num_tokens
+
+
+class TestSerializationFormats(LayoutPrompterTestCase):
+    @pytest.fixture
+    def rico25_elements(self) -> List[LayoutSerializedData]:
+        rng = np.random.default_rng(0)
+        return [
+            Rico25SerializedData(
+                class_name=class_name,
+                bbox=Bbox(
+                    left=int(left), top=int(top), width=int(width), height=int(height)
+                ),
+            )
+            for class_name, (left, top, width, height) in zip(
+                get_args(Rico25ClassNames),
+                rng.integers(0, 100, size=(len(get_args(Rico25ClassNames)), 4)),
+            )
+        ]
+
+    def test_sequence_format(self):
+        elements = [
+            PosterLayoutSerializedData(
+                class_name="text", bbox=Bbox(left=0, top=12, width=30, height=5)
+            ),
+            PosterLayoutSerializedData(
+                class_name="logo", bbox=Bbox(left=10, top=20, width=30, height=40)
+            ),
+        ]
+        assert (
+            serialize_layout(elements, serialization_format="sequence")
+            == "text 0 12 30 5 | logo 10 20 30 40"
+        )
+
+    @pytest.mark.parametrize(
+        argnames="serialization_format", argvalues=SERIALIZATION_FORMATS
+    )
+    def test_round_trip_poster(
+        self,
+        synthetic_poster_layouts: List[ProcessedLayoutData],
+        serialization_format,
+    ):
+        for layout in synthetic_poster_layouts[:50]:
+            elements = to_serialized_data(layout, schema=PosterLayoutSerializedData)
+            text = serialize_layout(elements, serialization_format=serialization_format)
+            parsed = parse_layout(
+                text,
+                schema=PosterLayoutSerializedOutputData,
+                serialization_format=serialization_format,
+            )
+            assert parsed == PosterLayoutSerializedOutputData(layouts=elements)
+
+    @pytest.mark.parametrize(
+        argnames="serialization_format", argvalues=SERIALIZATION_FORMATS
+    )
+    def test_round_trip_rico25(
+        self, rico25_elements: List[LayoutSerializedData], serialization_format
+    ):
+        # Class names of Rico25 contain spaces and slashes, e.g., "On/Off Switch"
+        text = serialize_layout(
+            rico25_elements, serialization_format=serialization_format
+        )
+        parsed = parse_layout(
+            text,
+            schema=Rico25SerializedOutputData,
+            serialization_format=serialization_format,
+        )
+        assert parsed == Rico25SerializedOutputData(layouts=rico25_elements)
+
+    @pytest.mark.parametrize(
+        argnames="serialization_format", argvalues=SERIALIZATION_FORMATS
+    )
+    def test_parse_code_block(
+        self, rico25_elements: List[LayoutSerializedData], serialization_format
+    ):
+        text = serialize_layout(
+            rico25_elements, serialization_format=serialization_format
+        )
+        parsed = parse_layout(
+            f"```{serialization_format}\n{text}\n```",
+            schema=Rico25SerializedOutputData,
+            serialization_format=serialization_format,
+        )
+        assert parsed.layouts == rico25_elements
+
+    def test_parse_invalid_class_name(self):
+        with pytest.raises(ValueError):
+            parse_layout(
+                "title 0 12 30 5",
+                schema=PosterLayoutSerializedOutputData,
+                serialization_format="sequence",
+            )
+
+    @pytest.mark.parametrize(
+        argnames="serialization_format", argvalues=SERIALIZATION_FORMATS
+    )
+    def test_serializer_serialization_format(
+        self,
+        synthetic_poster_layouts: List[ProcessedLayoutData],
+        synthetic_poster_queries: List[ProcessedLayoutData],
+        serialization_format,
+    ):
+        serializer = ContentAwareSerializer(layout_domain="poster")
+        candidates = synthetic_poster_layouts[:5]
+
+        prompt = serializer.invoke(
+            input=LayoutSerializerInput(
+                query=synthetic_poster_queries[0], candidates=candidates
+            ),
+            config={
+                "configurable": {
+                    "input_schema": PosterLayoutSerializedData,
+                    "serialization_format": serialization_format,
+                }
+            },
+        )
+        # The few-shot examples alternate between the constraints and the layout
+        ai_messages = prompt.to_messages()[2:-1:2]
+        assert [message.text() for message in ai_messages] == [
+            serialize_layout(
+                to_serialized_data(candidate, schema=PosterLayoutSerializedData),
+                serialization_format=serialization_format,
+            )
+            for candidate in candidates
+        ]
+
+    def test_num_tokens_synthetic_poster(
+        self, synthetic_poster_layouts: List[ProcessedLayoutData]
+    ):
+        num_tokens = report_num_tokens(
+            synthetic_poster_layouts,
+            schema=PosterLayoutSerializedData,
+            name="synthetic poster",
+        )
+        # The HTML form is reported but is more verbose than JSON
+        assert num_tokens["sequence"] < num_tokens["csv"] < num_tokens["json"]
+
+    @pytest.mark.parametrize(
+        argnames=("layout_dataset", "settings", "input_schema", "name"),
+        argvalues=(
+            (
+                lf("poster_layout_dataset"),
+                PosterLayoutSettings(),
+                PosterLayoutSerializedData,
+                "poster",
+            ),
+            (
+                lf("rico25_dataset"),
+                Rico25Settings(),
+                Rico25SerializedData,
+                "rico25",
+            ),
+        ),
+    )
+    def test_num_tokens_dataset(
+        self,
+        layout_dataset: Dict[str, List[LayoutData]],
+        settings: TaskSettings,
+        input_schema: Type[LayoutSerializedData],
+        name: str,
+        num_layouts: int = 100,
+    ):
+        layouts = [
+            layout
+            for layout in layout_dataset["train"][:num_layouts]
+            if layout.bboxes is not None and layout.labels is not None
+        ]
+        processed_layouts = DiscretizeBboxes().batch(
+            layouts,
+            config={"configurable": {"target_canvas_size": settings.canvas_size}},
+        )
+        num_tokens = report_num_tokens(
+            processed_layouts, schema=input_schema, name=name
+        )
+        assert num_tokens["sequence"] < num_tokens["json"]
+        assert num_tokens["csv"] < num_tokens["json"]
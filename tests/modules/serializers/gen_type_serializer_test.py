@@ -0,0 +1,42 @@
+from typing import Callable, List
+
+import pytest
+from langchain_core.prompt_values import ChatPromptValue
+
+from layout_prompter.models import PosterLayoutSerializedData, ProcessedLayoutData
+from layout_prompter.modules.serializers import (
+    GenTypeSerializer,
+    LayoutSerializerInput,
+)
+from layout_prompter.utils.testing import LayoutPrompterTestCase
+
+
+class TestGenTypeSerializer(LayoutPrompterTestCase):
+    @pytest.mark.parametrize(argnames="render_mode", argvalues=("template", "direct"))
+    def test_prompt_matches_reference(
+        self,
+        synthetic_poster_layouts: List[ProcessedLayoutData],
+        synthetic_poster_queries: List[ProcessedLayoutData],
+        reference_prompt_builder: Callable[..., ChatPromptValue],
+        render_mode: str,
+    ):
+        serializer = GenTypeSerializer(layout_domain="poster", render_mode=render_mode)
+        candidates = synthetic_poster_layouts[:10]
+
+        for query in synthetic_poster_queries:
+            prompt = serializer.invoke(
+                input=LayoutSerializerInput(query=query, candidates=candidates),
+                config={"configurable": {"input_schema": PosterLayoutSerializedData}},
+            )
+            expected = reference_prompt_builder(
+                serializer, query, candidates, schema=PosterLayoutSerializedData
+            )
+            assert prompt == expected
+            # The rendered messages are byte-identical
+            assert [
+                (type(message), message.model_dump_json())
+                for message in prompt.to_messages()
+            ] == [
+                (type(message), message.model_dump_json())
+                for message in expected.to_messages()
+            ]
@@ -3,6 +3,7 @@ import pytest
 
 from layout_prompter.models.layout_data import Bbox, NormalizedBbox
 from layout_prompter.utils.bbox import (
+    compute_union_areas,
     normalize_bboxes,
 )
 
@@ -158,3 +159,37 @@ class TestBboxUtilsComprehensive:
         assert discrete_bbox.top == 30  # 0.2 * 150
         assert discrete_bbox.width == 30  # 0.3 * 100
         assert discrete_bbox.height == 60  # 0.4 * 150
+
+
+class TestComputeUnionAreas:
+    def test_disjoint_and_overlapping(self):
+        rects = np.array([[0, 0, 2, 2], [1, 1, 3, 3], [10, 10, 11, 12]])
+        assert compute_union_areas(rects) == 4 + 4 - 1 + 2
+
+    def test_nested(self):
+        rects = np.array([[0, 0, 10, 10], [2, 2, 5, 5]])
+        assert compute_union_areas(rects) == 100
+
+    def test_batched_with_padding(self):
+        rects = np.array(
+            [
+                [[0, 0, 2, 2], [0, 0, 0, 0]],
+                [[0, 0, 1, 1], [5, 5, 7, 8]],
+            ]
+        )
+        assert compute_union_areas(rects).tolist() == [4, 7]
+
+    def test_empty(self):
+        assert compute_union_areas(np.zeros((0, 4), dtype=np.int64)) == 0
+
+    def test_matches_rasterization(self):
+        rng = np.random.default_rng(0)
+        for _ in range(20):
+            lt = rng.integers(0, 30, size=(5, 2))
+            wh = rng.integers(0, 20, size=(5, 2))
+            rects = np.concatenate([lt, lt + wh], axis=1)
+
+            canvas = np.zeros((50, 50), dtype=bool)
+            for left, top, right, bottom in rects:
+                canvas[top:bottom, left:right] = True
+            assert compute_union_areas(rects) == canvas.sum()
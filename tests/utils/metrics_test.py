@@ -1,10 +1,19 @@
+import time
+import tracemalloc
+from typing import Optional, Tuple
+
 import numpy as np
 import pytest
+from loguru import logger
+
+from layout_prompter.models.layout_data import Bbox
 from layout_prompter.utils import (
     compute_alignment,
+    compute_alignment_batch,
     compute_overlap,
+    compute_overlap_batch,
+    compute_pairwise_iou,
 )
-from layout_prompter.models.layout_data import Bbox
 
 
 def convert_ltwh_to_ltrb(bboxes: np.ndarray) -> np.ndarray:
@@ -158,3 +167,159 @@ def test_single_bbox():
     assert isinstance(ove_score, float)
     assert ali_score >= 0.0
     assert ove_score >= 0.0
+
+
+def test_batch_metrics_match_per_layout():
+    """Test that the batched metrics of padded layouts equal those of each layout"""
+    rng = np.random.default_rng(0)
+    layouts = []
+    for _ in range(100):
+        num_bboxes = int(rng.integers(1, 8))
+        lt = rng.integers(0, 100, size=(num_bboxes, 2))
+        wh = rng.integers(0, 50, size=(num_bboxes, 2))
+        layouts.append(np.concatenate([lt, lt + wh], axis=1))
+
+    max_num_bboxes = max(len(layout) for layout in layouts)
+    bboxes = np.zeros((len(layouts), max_num_bboxes, 4), dtype=np.int64)
+    padmsk = np.zeros((len(layouts), max_num_bboxes), dtype=bool)
+    for i, layout in enumerate(layouts):
+        bboxes[i, : len(layout)] = layout
+        padmsk[i, : len(layout)] = True
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        expected_ali = [
+            compute_alignment(layout[None].copy(), np.ones((1, len(layout)), bool))
+            for layout in layouts
+        ]
+        expected_ove = [
+            compute_overlap(layout[None].copy(), np.ones((1, len(layout)), bool))
+            for layout in layouts
+        ]
+
+    np.testing.assert_allclose(
+        compute_alignment_batch(bboxes, padmsk), expected_ali, rtol=1e-12
+    )
+    np.testing.assert_allclose(
+        compute_overlap_batch(bboxes, padmsk), expected_ove, rtol=1e-12
+    )
+    # The input is not modified
+    assert padmsk.sum() == sum(len(layout) for layout in layouts)
+
+
+def test_compute_pairwise_iou():
+    """Test the pairwise IoU against a scalar computation, with broadcasting"""
+
+    def iou(a: np.ndarray, b: np.ndarray) -> float:
+        iw = max(0, min(a[2], b[2]) - max(a[0], b[0]))
+        ih = max(0, min(a[3], b[3]) - max(a[1], b[1]))
+        union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - iw * ih
+        return iw * ih / union if union > 0 else 0.0
+
+    rng = np.random.default_rng(0)
+    lt = rng.integers(0, 100, size=(3, 5, 2))
+    bboxes1 = np.concatenate([lt, lt + rng.integers(0, 50, size=(3, 5, 2))], axis=-1)
+    lt = rng.integers(0, 100, size=(4, 2))
+    bboxes2 = np.concatenate([lt, lt + rng.integers(0, 50, size=(4, 2))], axis=-1)
+    # A degenerate bbox
+    bboxes2[0] = [10, 10, 10, 10]
+
+    matrix = compute_pairwise_iou(bboxes1, bboxes2[None])
+    assert matrix.shape == (3, 5, 4)
+    expected = [[[iou(a, b) for b in bboxes2] for a in layout] for layout in bboxes1]
+    np.testing.assert_allclose(matrix, expected)
+    assert np.all(matrix[:, :, 0] == 0.0)
+    np.testing.assert_allclose(
+        np.diagonal(compute_pairwise_iou(bboxes2[1:], bboxes2[1:])), 1.0
+    )
+
+
+@pytest.mark.parametrize("dtype", [np.int64, np.float32, np.float64])
+def test_sorted_alignment_matches_pairwise(dtype):
+    """Test that the O(N log N) alignment equals the pairwise one"""
+    rng = np.random.default_rng(0)
+    num_layouts, max_num_bboxes = 50, 30
+    if dtype == np.int64:
+        # Pixel coordinates, with many exact alignments and unit distances
+        lt = rng.integers(0, 40, size=(num_layouts, max_num_bboxes, 2))
+        wh = rng.integers(0, 20, size=(num_layouts, max_num_bboxes, 2))
+    else:
+        lt = rng.uniform(0, 0.6, size=(num_layouts, max_num_bboxes, 2))
+        wh = rng.uniform(0, 0.4, size=(num_layouts, max_num_bboxes, 2))
+        # Rounded to get some exact alignments
+        lt, wh = lt.round(2), wh.round(2)
+    bboxes = np.concatenate([lt, lt + wh], axis=-1).astype(dtype)
+    num_bboxes = rng.integers(1, max_num_bboxes + 1, size=num_layouts)
+    padmsk = np.arange(max_num_bboxes)[None, :] < num_bboxes[:, None]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        assert compute_alignment(
+            bboxes.copy(), padmsk, method="sorted"
+        ) == pytest.approx(compute_alignment(bboxes.copy(), padmsk), rel=1e-12)
+        np.testing.assert_allclose(
+            compute_alignment_batch(bboxes, padmsk, method="sorted"),
+            compute_alignment_batch(bboxes, padmsk),
+            rtol=1e-12,
+        )
+        for layout, mask in zip(bboxes[:10], padmsk[:10]):
+            assert compute_alignment(
+                layout[None].copy(), mask[None], method="sorted"
+            ) == pytest.approx(
+                compute_alignment(layout[None].copy(), mask[None]), rel=1e-12
+            )
+
+
+def generate_padded_layouts(
+    num_layouts: int, max_num_bboxes: int, seed: int = 0
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Generate random padded layouts in pixel coordinates"""
+    rng = np.random.default_rng(seed)
+    lt = rng.integers(0, 1000, size=(num_layouts, max_num_bboxes, 2))
+    wh = rng.integers(0, 200, size=(num_layouts, max_num_bboxes, 2))
+    bboxes = np.concatenate([lt, lt + wh], axis=-1)
+    num_bboxes = rng.integers(1, max_num_bboxes + 1, size=num_layouts)
+    padmsk = np.arange(max_num_bboxes)[None, :] < num_bboxes[:, None]
+    return bboxes, padmsk
+
+
+@pytest.mark.parametrize("block_size", [1, 7, 64])
+def test_blocked_overlap_matches_pairwise(block_size: int):
+    """Test that the memory-bounded overlap equals the pairwise one"""
+    bboxes, padmsk = generate_padded_layouts(num_layouts=50, max_num_bboxes=30)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        assert compute_overlap(
+            bboxes.copy(), padmsk, block_size=block_size
+        ) == pytest.approx(compute_overlap(bboxes.copy(), padmsk), rel=1e-12)
+    np.testing.assert_allclose(
+        compute_overlap_batch(bboxes, padmsk, block_size=block_size),
+        compute_overlap_batch(bboxes, padmsk),
+        rtol=1e-12,
+    )
+
+
+@pytest.mark.parametrize("max_num_bboxes", [50, 200, 500])
+def test_blocked_overlap_benchmark(max_num_bboxes: int):
+    """Compare the time and the peak memory of the pairwise and blocked overlap"""
+
+    def benchmark(block_size: Optional[int]) -> Tuple[np.ndarray, float, int]:
+        tracemalloc.start()
+        start = time.perf_counter()
+        scores = compute_overlap_batch(bboxes, padmsk, block_size=block_size)
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return scores, elapsed, peak
+
+    bboxes, padmsk = generate_padded_layouts(
+        num_layouts=16, max_num_bboxes=max_num_bboxes
+    )
+    expected, pairwise_time, pairwise_peak = benchmark(None)
+    scores, blocked_time, blocked_peak = benchmark(32)
+
+    logger.info(
+        f"Overlap of 16 layouts with up to {max_num_bboxes} elements: "
+        f"{pairwise_time * 1e3:.1f} ms, {pairwise_peak / 2**20:.1f} MiB (pairwise) -> "
+        f"{blocked_time * 1e3:.1f} ms, {blocked_peak / 2**20:.1f} MiB (blocked)"
+    )
+    np.testing.assert_allclose(scores, expected, rtol=1e-12)
+    assert blocked_peak < pairwise_peak
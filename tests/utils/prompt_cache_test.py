@@ -0,0 +1,30 @@
+import pytest
+from langchain_core.messages import HumanMessage, SystemMessage
+from langchain_core.prompt_values import ChatPromptValue
+
+from layout_prompter.utils import (
+    compute_shared_prefix_lengths,
+    compute_shared_prefix_rate,
+)
+
+
+def test_compute_shared_prefix_lengths():
+    prompts = ["abcdef", "abcxyz", "abcdxy", "zzz", ""]
+    assert compute_shared_prefix_lengths(prompts) == [0, 3, 4, 0, 0]
+
+
+def test_compute_shared_prefix_lengths_prompt_values():
+    prompts = [
+        ChatPromptValue(
+            messages=[SystemMessage(content="system"), HumanMessage(content=query)]
+        )
+        for query in ("query 1", "query 2")
+    ]
+    shared_length = len(prompts[0].to_string()) - 1
+    assert compute_shared_prefix_lengths(prompts) == [0, shared_length]
+
+
+def test_compute_shared_prefix_rate():
+    assert compute_shared_prefix_rate([]) == 0.0
+    assert compute_shared_prefix_rate(["abcd", "abcd"]) == pytest.approx(0.5)
+    assert compute_shared_prefix_rate(["abcd", "wxyz"]) == 0.0
@@ -0,0 +1,43 @@
+import json
+
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+from layout_prompter.utils import estimate_num_message_tokens, estimate_num_tokens
+
+
+@pytest.mark.parametrize(
+    argnames=("text", "expected"),
+    argvalues=(
+        ("", 0),
+        ("text", 1),
+        (" logo", 1),
+        ("underlay", 2),
+        ("1234", 2),
+        ("text 0 12 30 5", 5),
+        ('{"left": 12}', 5),
+    ),
+)
+def test_estimate_num_tokens(text: str, expected: int):
+    assert estimate_num_tokens(text) == expected
+
+
+def test_estimate_num_tokens_is_monotonic():
+    element = {
+        "class_name": "text",
+        "bbox": {"left": 0, "top": 12, "width": 30, "height": 5},
+    }
+    num_tokens = [estimate_num_tokens(json.dumps([element] * n)) for n in range(1, 6)]
+    assert num_tokens == sorted(num_tokens)
+    assert len(set(num_tokens)) == len(num_tokens)
+
+
+def test_estimate_num_message_tokens():
+    messages = [
+        SystemMessage(content="Please generate a layout."),
+        HumanMessage(content="text 0 12 30 5"),
+        AIMessage(content="logo 1 2 3 4"),
+    ]
+    assert estimate_num_message_tokens(messages) == sum(
+        4 + estimate_num_tokens(message.text()) for message in messages
+    )